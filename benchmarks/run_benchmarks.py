@@ -0,0 +1,332 @@
+"""
+Benchmarks of the indexing and search paths, results are written as JSON so that runs can be compared.
+
+    python -m benchmarks.run_benchmarks --pages-dir snapshots --rows 10000 100000 --output bench.json
+
+    - parser: saved listing pages (a snapshot store or .html files) parsed by every backend, cards/s
+    - writer: synthetic listings upserted by SQLWriter (insert, unchanged and update passes), rows/s
+    - queries: a fixed query mix run by SQLQuery on the biggest synthetic table, latency percentiles
+    - search: concurrent POST /search against a stand-in sqlcoder answering canned SQL after `--llm-delay`
+"""
+
+import os
+import sys
+import gzip
+import json
+import time
+import logging
+import random
+import asyncio
+import argparse
+import platform
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, List
+
+import httpx
+from haystack import Document, component
+from haystack.dataclasses import ByteStream, ChatMessage
+
+import main
+from main import TABLE_NAME, TABLE_SCHEMA, TABLE_INDEXES
+from internal_lib.components import SubitoItParser, ListingNormalizer, SQLWriter, SQLQuery, QueryRejectedError
+from internal_lib.macros import REGIONS, PROVINCE_MAP, REAL_ESTATE_STATUS, FLOOR_MAP
+from internal_lib.pipelines import SubitoSearchPipeline
+from internal_lib.schema import GeneratorConfig, IndexJobRequest
+from internal_lib.snapshots import SnapshotStore
+from internal_lib.database import close_pools
+
+
+# Half of the listings are in the region of the default search, with some of its towns,
+# the others anywhere in Italy in the town named like their province
+DEFAULT_REGION = "sardegna"
+TOWNS = {
+    "CA": ["Cagliari", "Quartu Sant'Elena"], "SS": ["Sassari", "Alghero", "Olbia"], "NU": ["Nuoro", "Tortolì"],
+    "OR": ["Oristano"], "SU": ["Carbonia", "Iglesias"]
+}
+PROVINCES = [code for codes in REGIONS.values() for code in codes]
+
+# Floors as the parser extracts them ("Piano" is what is left of "Piano terra")
+FLOORS = list(FLOOR_MAP.values()) + ["Piano"] + [str(n) for n in range(1, 7)]
+
+NORMALIZER = ListingNormalizer()
+
+QUERY_MIX = [
+    f"SELECT * FROM {TABLE_NAME} WHERE city = 'cagliari' AND price <= 200000",
+    f"SELECT * FROM {TABLE_NAME} WHERE province = 'sassari' AND n_rooms >= 3 ORDER BY price",
+    f"SELECT * FROM {TABLE_NAME} WHERE price BETWEEN 100000 AND 150000 AND mq >= 80",
+    f"SELECT * FROM {TABLE_NAME} WHERE city = 'olbia' AND sold = 0 AND is_real_estate_agency = 0",
+    f"SELECT * FROM {TABLE_NAME} WHERE n_rooms = 2 AND floor_code >= 1 ORDER BY mq DESC",
+    f"SELECT city, AVG(price) FROM {TABLE_NAME} WHERE province = 'cagliari' GROUP BY city",
+    f"SELECT * FROM {TABLE_NAME} WHERE content MATCH 'appartamento locali' AND price <= 200000"
+]
+
+SEARCH_QUESTIONS = [
+    "Case con vista mare e giardino",
+    "Appartamenti luminosi vicino al centro storico",
+    "Villette con piscina e posto auto",
+    "Attici panoramici con terrazzo abitabile"
+]
+
+CANNED_SQL = f"SELECT * FROM {TABLE_NAME} WHERE price <= 150000 AND n_rooms >= 2"
+
+
+@component
+class FakeSQLCoder:
+    """
+    Stand-in for the chat generators: answers the canned SQL after `delay` seconds.
+    """
+
+    def __init__(self, sql: str, delay: float) -> None:
+
+        self.sql = sql
+        self.delay = delay
+
+    @component.output_types(replies=List[ChatMessage])
+    def run(self, messages: List[ChatMessage]):
+
+        time.sleep(self.delay)
+
+        return {"replies": [ChatMessage.from_assistant(self.sql)]}
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+
+    if not values:
+        return {}
+
+    values = sorted(values)
+
+    def at(q):
+        return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+    return {
+        "count": len(values),
+        "mean_ms": round(1000 * sum(values) / len(values), 3),
+        "p50_ms": round(1000 * at(0.50), 3),
+        "p95_ms": round(1000 * at(0.95), 3),
+        "p99_ms": round(1000 * at(0.99), 3),
+        "max_ms": round(1000 * values[-1], 3)
+    }
+
+
+def listing(i: int, version: int = 0) -> Document:
+    """
+    Deterministic synthetic listing, `version` changes the price of one listing out of ten.
+    The fields are built as SubitoItParser extracts them and normalized like the indexed listings.
+    """
+
+    rng = random.Random(i)
+    province = rng.choice(REGIONS[DEFAULT_REGION] if rng.random() < 0.5 else PROVINCES)
+    city = rng.choice(TOWNS.get(province, [PROVINCE_MAP[province]]))
+    price = rng.randrange(40000, 600000, 1000) + (1000 * version if i % 10 == 0 else 0)
+
+    meta = NORMALIZER.normalize_meta({
+        "price": price, "link": f"https://www.subito.it/appartamenti/bench-{i}.htm", "sold": rng.random() < 0.1,
+        "city": city, "province": PROVINCE_MAP[province], "is_real_estate_agency": rng.random() < 0.7,
+        "mq": f"{rng.randint(30, 250)} mq", "n_rooms": str(rng.randint(1, 6)), "n_bathrooms": str(rng.randint(1, 3)),
+        "floor": rng.choice(FLOORS), "status": rng.choice(list(REAL_ESTATE_STATUS.values()))
+    })
+
+    return Document(content=f"Appartamento {meta['n_rooms']} locali a {meta['city']}", meta=meta)
+
+
+def load_pages(pages_dir: str) -> List[ByteStream]:
+    """
+    Reads a snapshot store (the latest snapshot of every url) or a directory of .html / .html.gz files,
+    the latter are given the urls of the default search since the parser reads the status from the url.
+    """
+
+    if (Path(pages_dir) / "manifest.db").exists():
+        store = SnapshotStore(root=pages_dir)
+        return list(store.iter_streams(store.urls()))
+
+    base_url = IndexJobRequest().base_url
+    streams = []
+
+    for x, path in enumerate(sorted(Path(pages_dir).rglob("*.html*"))):
+        data = path.read_bytes()
+        if path.suffix == ".gz":
+            data = gzip.decompress(data)
+        streams.append(ByteStream(data=data, meta={"url": base_url + "/?o={x}".format(x=x)}))
+
+    return streams
+
+
+def bench_parser(pages_dir: str, workers: int, repeat: int) -> List[Dict[str, Any]]:
+
+    streams = load_pages(pages_dir)
+    results = []
+
+    for backend in ("html.parser", "lxml"):
+
+        parser = SubitoItParser(backend=backend, workers=workers)
+        cards = 0
+        started = time.perf_counter()
+
+        try:
+            for _ in range(repeat):
+                for documents in parser.iter_parse(streams):
+                    cards += len(documents)
+        finally:
+            parser.close()
+
+        elapsed = time.perf_counter() - started
+        results.append({
+            "backend": backend, "workers": workers, "pages": len(streams) * repeat, "cards": cards,
+            "seconds": round(elapsed, 3), "cards_per_second": round(cards / elapsed, 1) if elapsed else None
+        })
+
+    return results
+
+
+def bench_writer(dbname: str, rows: int, batch_size: int) -> Dict[str, Any]:
+
+    writer = SQLWriter(dbname=dbname, full_text_column="content")
+    writer.ensure_table(TABLE_NAME, TABLE_SCHEMA, create_table=True, table_indexes=TABLE_INDEXES)
+
+    result = {"rows": rows, "batch_size": batch_size}
+
+    # insert: empty table, unchanged: same listings again, update: a price changed in one listing out of ten
+    for name, version in (("insert", 0), ("unchanged", 0), ("update", 1)):
+
+        elapsed = 0.0
+        counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+
+        for start in range(0, rows, batch_size):
+            batch = [listing(i, version) for i in range(start, min(rows, start + batch_size))]
+
+            started = time.perf_counter()
+            for key, count in writer.write_batch(batch, TABLE_NAME, TABLE_SCHEMA).items():
+                counts[key] += count
+            elapsed += time.perf_counter() - started
+
+        result[name] = {**counts, "seconds": round(elapsed, 3), "rows_per_second": round(rows / elapsed, 1) if elapsed else None}
+
+    return result
+
+
+def bench_queries(dbname: str, repeat: int) -> List[Dict[str, Any]]:
+
+    sql_query = SQLQuery(dbname=dbname, table_name=TABLE_NAME, full_text_column="content")
+    results = []
+
+    for query in QUERY_MIX:
+
+        latencies = []
+        rejected = None
+
+        for _ in range(repeat):
+            started = time.perf_counter()
+            try:
+                sql_query.run(queries=[query])
+            except QueryRejectedError as e:
+                rejected = str(e)
+                break
+            latencies.append(time.perf_counter() - started)
+
+        results.append({"query": query, "rejected": rejected, **percentiles(latencies)})
+
+    return results
+
+
+async def _load(client: httpx.AsyncClient, requests: int, concurrency: int) -> Dict[str, Any]:
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def one(i):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.post("/search", json={"query": SEARCH_QUESTIONS[i % len(SEARCH_QUESTIONS)]})
+            if response.status_code == 200:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - started
+
+    return {"requests_per_second": round(requests / elapsed, 2), "errors": errors, **percentiles(latencies)}
+
+
+def bench_search(dbname: str, requests: int, concurrency: int, llm_delay: float) -> Dict[str, Any]:
+
+    # No query cache: every request goes through the pipeline
+    main.pipelines.register(
+        "search",
+        lambda config: SubitoSearchPipeline(config, dbname=dbname, sqlcoder=FakeSQLCoder(CANNED_SQL, llm_delay)),
+        GeneratorConfig(service="local", model="fake-sqlcoder")
+    )
+
+    async def run():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            return await _load(client, requests, concurrency)
+
+    result = asyncio.run(run())
+
+    return {"requests": requests, "concurrency": concurrency, "llm_delay": llm_delay, **result}
+
+
+def main_cli():
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages-dir", help="Directory of saved listing pages, the parser benchmark is skipped without it")
+    parser.add_argument("--parser-workers", type=int, default=1)
+    parser.add_argument("--parser-repeat", type=int, default=3)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000], help="Sizes of the synthetic datasets, e.g. 10000 100000 1000000")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--query-repeat", type=int, default=50)
+    parser.add_argument("--search-requests", type=int, default=200)
+    parser.add_argument("--search-concurrency", type=int, default=16)
+    parser.add_argument("--llm-delay", type=float, default=0.5, help="Seconds taken by the stand-in sqlcoder")
+    parser.add_argument("--skip", nargs="*", default=[], choices=["parser", "writer", "queries", "search"])
+    parser.add_argument("--output", help="JSON file to write, stdout by default")
+    args = parser.parse_args()
+
+    # main configures DEBUG logging, it would weigh on the measures
+    logging.getLogger().setLevel(logging.WARNING)
+
+    report = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "arguments": vars(args)
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        if args.pages_dir and "parser" not in args.skip:
+            report["parser"] = bench_parser(args.pages_dir, args.parser_workers, args.parser_repeat)
+
+        # Queries and searches run on the biggest dataset
+        dbname = os.path.join(tmp, f"bench_{max(args.rows)}.db")
+
+        if "writer" not in args.skip:
+            report["writer"] = [bench_writer(os.path.join(tmp, f"bench_{rows}.db"), rows, args.batch_size) for rows in args.rows]
+        else:
+            bench_writer(dbname, max(args.rows), args.batch_size)
+
+        if "queries" not in args.skip:
+            report["queries"] = bench_queries(dbname, args.query_repeat)
+
+        if "search" not in args.skip:
+            report["search"] = bench_search(dbname, args.search_requests, args.search_concurrency, args.llm_delay)
+
+        close_pools()
+
+    output = json.dumps(report, indent=2)
+
+    if args.output:
+        Path(args.output).write_text(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+
+    main_cli()
@@ -0,0 +1,21 @@
+"""
+Sharded crawl of subito.it over regions x statuses x pages, run by worker processes without the web app.
+"""
+
+import logging
+
+from internal_lib.crawler import main_cli
+from settings import DB_NAME, TABLE_NAME, TABLE_SCHEMA, TABLE_INDEXES, build_scraper_pipeline
+
+
+# Module level: also run by the spawned worker processes
+logging.basicConfig(
+     level=logging.INFO,
+     format= '[%(asctime)s] %(levelname)s - %(message)s',
+     datefmt='%H:%M:%S'
+)
+
+
+if __name__ == "__main__":
+
+    main_cli(build_scraper_pipeline, dbname=DB_NAME, table_name=TABLE_NAME, table_schema=TABLE_SCHEMA, table_indexes=TABLE_INDEXES)
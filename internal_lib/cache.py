@@ -0,0 +1,184 @@
+import re
+import json
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+from internal_lib.database import get_pool
+from internal_lib.metrics import CACHE_REQUESTS
+
+
+class LRUCache:
+    """
+    Thread-safe in-memory cache with least recently used eviction and a time to live.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = None) -> None:
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+
+        with self._lock:
+            entry = self._data.get(key)
+
+            if entry is None or (self.ttl is not None and time.monotonic() - entry[0] > self.ttl):
+                self._data.pop(key, None)
+                self.misses += 1
+                return None
+
+            self._data.move_to_end(key)
+            self.hits += 1
+
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any):
+
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._data)}
+
+
+class SQLiteCache:
+    """
+    Persistent key/value cache stored in a SQLite table, values are JSON encoded.
+    """
+
+    def __init__(self, dbname: str, table_name: str = "cache", ttl: Optional[float] = None) -> None:
+
+        self.table_name = table_name
+        self.ttl = ttl
+        self._pool = get_pool(dbname)
+
+        self.hits = 0
+        self.misses = 0
+
+        with self._pool.writer() as connection:
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table_name} (key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            connection.commit()
+
+    def get(self, key: str) -> Optional[Any]:
+
+        res = self._pool.reader().execute(
+            f"SELECT value, created_at FROM {self.table_name} WHERE key = ?", (key,)
+        ).fetchone()
+
+        if res is None or (self.ttl is not None and time.time() - res[1] > self.ttl):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+
+        return json.loads(res[0])
+
+    def set(self, key: str, value: Any):
+
+        with self._pool.writer() as connection:
+            with connection:
+                connection.execute(
+                    f"INSERT OR REPLACE INTO {self.table_name} (key, value, created_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(value), time.time())
+                )
+
+    def clear(self):
+
+        with self._pool.writer() as connection:
+            with connection:
+                connection.execute(f"DELETE FROM {self.table_name}")
+
+    def stats(self) -> Dict[str, int]:
+
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class QueryCache:
+    """
+    Two-level cache of the search pipeline:
+        - question -> generated SQL and its parameters, in memory (LRU + TTL) backed by a persistent SQLite tier
+        - (index generation, SQL, parameters) -> results, in memory only. SQLWriter bumps the index generation
+          on every write, so results computed on an older index are never returned
+    """
+
+    WHITESPACE_REGEX = re.compile(r"\s+")
+
+    def __init__(self, dbname: str, max_size: int = 1024, ttl: Optional[float] = 3600, persistent_ttl: Optional[float] = 7 * 24 * 3600, max_results: int = 256) -> None:
+
+        self.sql_memory = LRUCache(max_size=max_size, ttl=ttl)
+        self.sql_persistent = SQLiteCache(dbname, table_name="question_sql_cache", ttl=persistent_ttl)
+        self.results = LRUCache(max_size=max_results)
+
+    @classmethod
+    def normalize(cls, question: str) -> str:
+
+        return cls.WHITESPACE_REGEX.sub(" ", question.casefold()).strip(" ?!.")
+
+    def get_sql(self, namespace: str, question: str) -> Optional[Tuple[str, list]]:
+        """
+        Returns the SQL and its parameters generated for the question, None if not cached.
+        """
+
+        key = f"{namespace}:{self.normalize(question)}"
+
+        entry = self.sql_memory.get(key)
+
+        if entry is None:
+            entry = self.sql_persistent.get(key)
+            if entry is not None:
+                self.sql_memory.set(key, entry)
+
+        CACHE_REQUESTS.labels(kind="sql", result="miss" if entry is None else "hit").inc()
+
+        return tuple(entry) if entry is not None else None
+
+    def set_sql(self, namespace: str, question: str, sql: str, parameters: Optional[list] = None):
+
+        key = f"{namespace}:{self.normalize(question)}"
+        entry = [sql, list(parameters or [])]
+
+        self.sql_memory.set(key, entry)
+        self.sql_persistent.set(key, entry)
+
+    @staticmethod
+    def _results_key(generation: int, sql: str, parameters: Optional[list]) -> tuple:
+
+        return generation, sql, json.dumps(list(parameters or []))
+
+    def get_results(self, generation: int, sql: str, parameters: Optional[list] = None) -> Optional[list]:
+
+        results = self.results.get(self._results_key(generation, sql, parameters))
+        CACHE_REQUESTS.labels(kind="results", result="miss" if results is None else "hit").inc()
+
+        return results
+
+    def set_results(self, generation: int, sql: str, parameters: Optional[list], results: list):
+
+        self.results.set(self._results_key(generation, sql, parameters), results)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+
+        return {
+            "sql_memory": self.sql_memory.stats(),
+            "sql_persistent": self.sql_persistent.stats(),
+            "results": self.results.stats()
+        }
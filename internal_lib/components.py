@@ -1,19 +1,346 @@
 import re
+import json
+import math
+import time
+import queue
+import hashlib
+import itertools
+import random
+import asyncio
+import threading
 import sqlite3
+import inspect
 import logging
-from typing import Any, Dict, List, Optional, Union
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+from urllib.parse import urlparse
+
+import httpx
+import numpy as np
 
 from haystack import component
-from haystack.dataclasses import Document, ByteStream, ChatMessage
+from haystack.dataclasses import Document, ByteStream, ChatMessage, StreamingChunk
 from haystack.components.converters.utils import normalize_metadata
 from haystack.components.fetchers import LinkContentFetcher
-from bs4 import BeautifulSoup, Tag
+from bs4 import BeautifulSoup, NavigableString
+from lxml import etree, html as lxml_html
+
+from internal_lib.database import get_pool, bump_generation, read_generation, full_text_table, select_in
+from internal_lib.history import ListingHistory
+from internal_lib.metrics import timed, CARDS, PARSE_FALLBACKS, ROWS
+from internal_lib.macros import REAL_ESTATE_STATUS, FLOOR_MAP, FLOOR_CODES, PROVINCE_MAP, ROOMS_MAP, QUERY_STOPWORDS
+
+
+class HostRateLimiter:
+    """
+    Spaces out requests to the same host so that at most `requests_per_second`
+    are started per host. A non positive rate disables the limit.
+    """
+
+    def __init__(self, requests_per_second: float) -> None:
+
+        self._interval = 1 / requests_per_second if requests_per_second > 0 else 0
+        self._next_slot = defaultdict(float)
+        self._locks = defaultdict(asyncio.Lock)
 
-from internal_lib.macros import REAL_ESTATE_STATUS, FLOOR_MAP, PROVINCE_MAP
+    async def wait(self, host: str):
+
+        if not self._interval:
+            return
+
+        async with self._locks[host]:
+            loop = asyncio.get_running_loop()
+            delay = self._next_slot[host] - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next_slot[host] = max(loop.time(), self._next_slot[host]) + self._interval
+
+
+@component
+class AsyncLinkContentFetcher:
+    """
+    Drop-in replacement of haystack `LinkContentFetcher` that downloads the urls concurrently
+    on a pooled `httpx.AsyncClient`.
+    The number of in-flight requests is capped by `max_concurrency`, each host is limited to
+    `requests_per_second` and failed requests (network errors, 429 and 5xx) are retried with
+    exponential backoff.
+    A custom `transport` (e.g. `httpx.MockTransport`) can be passed to serve saved pages locally.
+
+    With a `validator_store` the requests are conditional (If-None-Match / If-Modified-Since):
+    unchanged pages come back as empty streams with `not_modified` in their meta, and the
+    validators of the fetched pages are returned in the meta to be saved once the page is indexed.
+
+    The client, its event loop and the rate limits are kept between the calls, so that repeated crawls
+    reuse the open connections, until `close()`.
+    """
+
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+    def __init__(
+        self,
+        user_agents: Optional[List[str]] = None,
+        max_concurrency: int = 8,
+        requests_per_second: float = 2.0,
+        retry_attempts: int = 3,
+        backoff_factor: float = 0.5,
+        timeout: int = 10,
+        raise_on_failure: bool = False,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+        validator_store: Optional[Any] = None
+    ) -> None:
+
+        self.user_agents = user_agents or ["haystack/AsyncLinkContentFetcher"]
+        self.max_concurrency = max_concurrency
+        self.requests_per_second = requests_per_second
+        self.retry_attempts = retry_attempts
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.raise_on_failure = raise_on_failure
+        self.transport = transport
+        self.validator_store = validator_store
+
+        self._loop = None
+        self._loop_thread = None
+        self._shared_client = None
+        self._rate_limiter = None
+        self._session_lock = threading.Lock()
+
+    def _session(self) -> Tuple[asyncio.AbstractEventLoop, httpx.AsyncClient, HostRateLimiter]:
+        """
+        Event loop (on its own thread), client and rate limiter shared by the calls, started at the first one.
+        """
+
+        with self._session_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._loop_thread = threading.Thread(target=self._loop.run_forever, name="fetcher-loop", daemon=True)
+                self._loop_thread.start()
+                self._shared_client = self._client()
+                self._rate_limiter = HostRateLimiter(self.requests_per_second)
+
+            return self._loop, self._shared_client, self._rate_limiter
+
+    def close(self):
+
+        with self._session_lock:
+            if self._loop is None:
+                return
+
+            asyncio.run_coroutine_threadsafe(self._shared_client.aclose(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop_thread.join()
+            self._loop.close()
+
+            self._loop = self._loop_thread = self._shared_client = self._rate_limiter = None
+
+    def _client(self) -> httpx.AsyncClient:
+
+        limits = httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency)
+
+        return httpx.AsyncClient(
+            limits=limits, timeout=self.timeout, follow_redirects=True, transport=self.transport
+        )
+
+    def _backoff(self, attempt: int, response: Optional[httpx.Response] = None) -> float:
+
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+
+        return self.backoff_factor * (2 ** attempt) + random.uniform(0, self.backoff_factor)
+
+    async def _fetch(self, client: httpx.AsyncClient, url: str, semaphore: asyncio.Semaphore, rate_limiter: HostRateLimiter) -> Optional[ByteStream]:
+
+        host = urlparse(url).netloc
+        headers = {}
+
+        if self.validator_store is not None:
+            etag, last_modified = self.validator_store.get(url)
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        for attempt in range(self.retry_attempts + 1):
+
+            response = None
+
+            async with semaphore:
+                await rate_limiter.wait(host)
+                try:
+                    with timed("fetcher"):
+                        response = await client.get(url, headers={**headers, "User-Agent": random.choice(self.user_agents)})
+                    if response.status_code == 304:
+                        return ByteStream(data=b"", meta={"url": url, "not_modified": True})
+                    if response.status_code not in self.RETRY_STATUS_CODES:
+                        response.raise_for_status()
+                        content_type = response.headers.get("Content-Type", "text/html").split(";")[0]
+                        meta = {
+                            "url": url, "content_type": content_type,
+                            "etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")
+                        }
+                        return ByteStream(data=response.content, meta=meta, mime_type=content_type)
+                    error = httpx.HTTPStatusError(f"Status {response.status_code}", request=response.request, response=response)
+                except httpx.HTTPStatusError as e:
+                    # Client errors other than 429 won't get better retrying
+                    error = e
+                    break
+                except httpx.TransportError as e:
+                    error = e
+
+            if attempt < self.retry_attempts:
+                delay = self._backoff(attempt, response)
+                logging.debug(f"Retrying {url} in {delay:.2f}s ({error})")
+                await asyncio.sleep(delay)
+
+        if self.raise_on_failure:
+            raise error
+
+        logging.warning(f"Could not fetch {url}: {error}")
+
+        return None
+
+    async def _fetch_all(self, client: httpx.AsyncClient, rate_limiter: HostRateLimiter, urls: List[str]) -> List[ByteStream]:
+
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        streams = await asyncio.gather(*[self._fetch(client, url, semaphore, rate_limiter) for url in urls])
+
+        return [stream for stream in streams if stream is not None]
+
+    def iter_streams(self, urls: List[str]) -> Iterator[ByteStream]:
+        """
+        Yields the pages as soon as they are downloaded (not in input order).
+        At most `max_concurrency` pages are kept in memory waiting to be consumed,
+        the download is paused until the consumer catches up.
+        """
+
+        buffer = queue.Queue(maxsize=self.max_concurrency)
+        stop = threading.Event()
+        done = object()
+        loop, client, rate_limiter = self._session()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        async def produce():
+            semaphore = asyncio.Semaphore(self.max_concurrency)
+            window = asyncio.Semaphore(self.max_concurrency)
+
+            async def fetch(url):
+                async with window:
+                    if stop.is_set():
+                        return
+                    stream = await self._fetch(client, url, semaphore, rate_limiter)
+                    if stream is not None:
+                        await asyncio.to_thread(put, stream)
+
+            await asyncio.gather(*[fetch(url) for url in urls])
+
+        def worker():
+            try:
+                asyncio.run_coroutine_threadsafe(produce(), loop).result()
+            except Exception as e:
+                put(e)
+            finally:
+                put(done)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+
+        try:
+            while (item := buffer.get()) is not done:
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+    @component.output_types(streams=List[ByteStream])
+    def run(self, urls: List[str]):
+
+        loop, client, rate_limiter = self._session()
+
+        return {"streams": asyncio.run_coroutine_threadsafe(self._fetch_all(client, rate_limiter, urls), loop).result()}
+
+
+CARD_CLASS_REGEX = re.compile(r'item-card')
+SPECS_CLASS_REGEX = re.compile(r'BigCard-module_additional-info')
+PRICE_CLASS_REGEX = re.compile(r'price')
+SOLD_CLASS_REGEX = re.compile(r'item-sold-badge')
+TOWN_CLASS_REGEX = re.compile(r'town')
+CITY_CLASS_REGEX = re.compile(r'city')
+LOCATION_REGEX = re.compile(r"(.*) ([\W]+)")
+
+
+def _xpath_class(tag: str, class_name: str) -> str:
+    return f".//{tag}[contains(@class, '{class_name}')]"
+
+
+# subito.it pages are served as utf-8, lxml would otherwise fall back to latin-1 on pages without a charset
+LXML_PARSER = lxml_html.HTMLParser(encoding="utf-8")
+CARD_XPATH = etree.XPath(_xpath_class("div", "item-card"))
+TITLE_XPATH = etree.XPath(".//h2")
+SPECS_XPATH = etree.XPath(_xpath_class("div", "BigCard-module_additional-info"))
+PRICE_XPATH = etree.XPath(_xpath_class("p", "price"))
+LINK_XPATH = etree.XPath(".//a")
+SOLD_XPATH = etree.XPath(_xpath_class("span", "item-sold-badge"))
+TOWN_XPATH = etree.XPath(_xpath_class("span", "town"))
+CITY_XPATH = etree.XPath(_xpath_class("span", "city"))
+SPAN_XPATH = etree.XPath(".//span")
+
+
+def _str(value: Optional[str]) -> Optional[str]:
+    return str(value) if value is not None else None
+
+
+def _lxml_string(element) -> Optional[str]:
+    """
+    Same semantic of BeautifulSoup `Tag.string`: the text of the element if it has a single
+    (possibly nested) text child, None otherwise.
+    """
+
+    while True:
+        children = list(element)
+        if not children:
+            return element.text
+        if element.text or len(children) > 1 or children[0].tail:
+            return None
+        element = children[0]
 
 
 @component
 class SubitoItParser():
+    """
+    Converts subito.it listing pages into one Document per listing card.
+
+    Two backends are available:
+        - "html.parser": BeautifulSoup with the standard library parser
+        - "lxml": lxml tree with precompiled XPath selectors, several times faster on large crawls
+    Both return the same `house` metadata.
+
+    With `workers` > 1 the pages are parsed in parallel on a process pool, `chunk_size` pages at a
+    time per worker. Only the raw page bytes and the parsed `house` dicts cross process boundaries,
+    and documents are returned in the same order of the sources.
+    """
+
+    BACKENDS = ("html.parser", "lxml")
+
+    def __init__(self, backend: str = "html.parser", workers: int = 1, chunk_size: int = 4) -> None:
+
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unsupported parser backend: {backend}")
+
+        self.backend = backend
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self._pool = None
     
     @component.output_types(documents=List[Document])
     def run(self, sources: List[Union[str, ByteStream]], meta: Optional[Union[Dict[str, Any], List[Dict[str, Any]]]] = None, **kwargs):
@@ -22,123 +349,573 @@ class SubitoItParser():
 
         meta_list = normalize_metadata(meta=meta, sources_count=len(sources))
 
-        for source, metadata in zip(sources, meta_list):
+        for page_documents in self.iter_parse(sources, meta_list):
+            documents.extend(page_documents)
 
-            soup = BeautifulSoup(source.data, 'html.parser')
+        return {"documents": documents}
 
-            request_url = source.meta["url"]
+    def parse(self, source: ByteStream, metadata: Optional[Dict[str, Any]] = None) -> List[Document]:
+        """
+        Parses a single fetched page into one Document per listing card.
+        """
 
-            re_status = None
+        with timed("converter"):
+            return self._documents(*parse_listing_page(source.data, source.meta["url"], self.backend), metadata)
 
-            for status in REAL_ESTATE_STATUS:
+    def iter_parse(self, sources: Iterable[ByteStream], meta_list: Optional[List[Dict[str, Any]]] = None) -> Iterator[List[Document]]:
+        """
+        Yields the documents of each source page, in order. Sources are consumed lazily,
+        at most `workers * chunk_size` pages are held in memory at once.
+        """
 
-                if status in request_url:
+        pairs = zip(sources, meta_list if meta_list is not None else itertools.repeat({}))
 
-                    re_status = status
+        if self.workers <= 1:
+            for source, metadata in pairs:
+                yield self.parse(source, metadata)
+            return
 
-                    break
-            
-            if not re_status:
-                raise Exception("Could not find real estate status in request url")
-
-            product_list_items = soup.find_all('div', class_=re.compile(r'item-card'))
-
-            for product in product_list_items:
-                
-                # Initialize variables
-                house = {"mq": "NOT-FOUND", "n_rooms": "NOT-FOUND", "n_bathrooms": "NOT-FOUND", "floor": "NOT-FOUND"}
-
-                house["status"] = REAL_ESTATE_STATUS[re_status]
-
-                house["title"] = product.find('h2').string
-
-                specs = product.find('div', class_=re.compile(r'BigCard-module_additional-info')).contents
-                for spec in specs:
-                    if spec.string.endswith("mq"):
-                        house["mq"] = spec.string
-                    elif "Local" in spec.string:
-                        n_rooms = spec.string.split(" ")[0]
-                        house["n_rooms"] = n_rooms
-                    elif "Bagn" in spec.string:
-                        n_bathrooms = spec.string.split(" ")[0]
-                        house["n_bathrooms"] = n_bathrooms
-                    elif "Piano" in spec.string or any(x in spec.string for x in FLOOR_MAP):
-                        floor = spec.string
-                        if floor in FLOOR_MAP:
-                            house["floor"] = FLOOR_MAP[floor]
-                        else:
-                            house["floor"] = floor.split(" ")[0].replace("°", "")
-                    else:
-                        print("UNKNOWN SPEC: " + spec.string)
-                        continue
-                try:
-                    price = product.find('p',class_=re.compile(r'price')).contents[0]
-                    # check if the span tag exists
-                    price_soup = BeautifulSoup(price, 'html.parser')
-                    if type(price_soup) == Tag:
-                        continue
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
 
-                    price = int(price.replace('.','')[:-2])
-                except:
-                    price = "NOT-FOUND"
-                
-                house["price"] = price
+        while window := list(itertools.islice(pairs, self.workers * self.chunk_size)):
 
-                link = product.find('a').get('href')
-                sold = product.find('span',re.compile(r'item-sold-badge'))
-                
-                house["link"] = link
-                house["sold"] = True if sold else False
+            results = self._pool.map(
+                parse_listing_page,
+                [source.data for source, _ in window],
+                [source.meta["url"] for source, _ in window],
+                itertools.repeat(self.backend),
+                chunksize=self.chunk_size
+            )
 
-                try:
-                    location = product.find('span',re.compile(r'town')).string + product.find('span', re.compile(r'city')).string
+            for (houses, unknown_specs), (_, metadata) in zip(results, window):
+                yield self._documents(houses, unknown_specs, metadata)
+
+    def close(self):
+
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    @staticmethod
+    def _documents(houses: List[Dict[str, Any]], unknown_specs: int = 0, metadata: Optional[Dict[str, Any]] = None) -> List[Document]:
+
+        metadata = metadata or {}
+
+        # Counted here: the pages may have been parsed in another process
+        PARSE_FALLBACKS.labels(field="spec").inc(unknown_specs)
+
+        return [Document(content=house["title"], meta={**house, **metadata}) for house in houses]
 
-                    location_regex = re.compile(r"(.*) ([\W]+)")
-                    city = location_regex.search(location).groups()[0]
-                    province = location.split("(")[1].replace(")", "")
-                    house["city"] = city
-                    house["province"] = PROVINCE_MAP[province]
+    @staticmethod
+    def _real_estate_status(request_url: str) -> str:
 
-                except:
-                    house["city"] = "NOT-FOUND"
-                    house["province"] = "NOT-FOUND"
+        for status in REAL_ESTATE_STATUS:
 
+            if status in request_url:
+
+                return status
+
+        raise Exception("Could not find real estate status in request url")
+
+    @staticmethod
+    def _house(re_status: str, title: str, specs: List[str], price: Optional[str], link: str, sold: bool, town: Optional[str], city: Optional[str], is_real_estate_agency: bool) -> Tuple[Dict[str, Any], int]:
+        """
+        Builds the `house` metadata from the raw strings extracted by the backends,
+        returned with the number of specs that could not be recognized.
+        """
+
+        # Initialize variables
+        house = {"mq": "NOT-FOUND", "n_rooms": "NOT-FOUND", "n_bathrooms": "NOT-FOUND", "floor": "NOT-FOUND"}
+        unknown_specs = 0
+
+        house["status"] = REAL_ESTATE_STATUS[re_status]
+
+        house["title"] = title
+
+        for spec in specs:
+            if spec.endswith("mq"):
+                house["mq"] = spec
+            elif "Local" in spec:
+                n_rooms = spec.split(" ")[0]
+                house["n_rooms"] = n_rooms
+            elif "Bagn" in spec:
+                n_bathrooms = spec.split(" ")[0]
+                house["n_bathrooms"] = n_bathrooms
+            elif "Piano" in spec or any(x in spec for x in FLOOR_MAP):
+                floor = spec
+                if floor in FLOOR_MAP:
+                    house["floor"] = FLOOR_MAP[floor]
+                else:
+                    house["floor"] = floor.split(" ")[0].replace("°", "")
+            else:
+                logging.debug(f"Unknown spec: {spec}")
+                unknown_specs += 1
+                continue
+
+        # A missing price or a span tag in place of the amount (e.g. "price on request")
+        try:
+            house["price"] = int(price.replace('.','')[:-2])
+        except (AttributeError, ValueError):
+            house["price"] = "NOT-FOUND"
+
+        house["link"] = link
+        house["sold"] = sold
+
+        try:
+            location = town + city
+
+            city = LOCATION_REGEX.search(location).groups()[0]
+            province = location.split("(")[1].replace(")", "")
+            house["city"] = city
+            house["province"] = PROVINCE_MAP[province]
+
+        except (TypeError, AttributeError, IndexError, KeyError):
+            house["city"] = "NOT-FOUND"
+            house["province"] = "NOT-FOUND"
+
+        house["is_real_estate_agency"] = is_real_estate_agency
+
+        return house, unknown_specs
+
+    @staticmethod
+    def _parse_html_parser(data: bytes) -> List[Dict[str, Any]]:
+
+        soup = BeautifulSoup(data, 'html.parser')
+
+        cards = []
+
+        for product in soup.find_all('div', class_=CARD_CLASS_REGEX):
+
+            price = product.find('p', class_=PRICE_CLASS_REGEX)
+            price = price.contents[0] if price is not None and price.contents else None
+            town = product.find('span', TOWN_CLASS_REGEX)
+            city = product.find('span', CITY_CLASS_REGEX)
+
+            # NavigableString keeps a reference to the whole tree, only plain strings are kept
+            cards.append({
+                "title": _str(product.find('h2').string),
+                "specs": [_str(spec.string) for spec in product.find('div', class_=SPECS_CLASS_REGEX).contents],
+                "price": str(price) if isinstance(price, NavigableString) else None,
+                "link": _str(product.find('a').get('href')),
+                "sold": product.find('span', SOLD_CLASS_REGEX) is not None,
+                "town": _str(town.string) if town is not None else None,
+                "city": _str(city.string) if city is not None else None,
                 # Check if it managed by real estate agency
-                is_real_estate_agency = False
+                "is_real_estate_agency": any(span.string == "Agenzia" for span in product.find_all("span"))
+            })
 
-                for span in product.find_all("span"):
-                    if span.string == "Agenzia":
-                        is_real_estate_agency = True
+        return cards
 
-                house["is_real_estate_agency"] = is_real_estate_agency
+    @staticmethod
+    def _parse_lxml(data: bytes) -> List[Dict[str, Any]]:
 
-                document = Document(content=house["title"], meta={**house, **metadata})
-                documents.append(document)
+        tree = lxml_html.fromstring(data, parser=LXML_PARSER)
 
-        return {"documents": documents}
+        cards = []
+
+        for product in CARD_XPATH(tree):
+
+            specs = SPECS_XPATH(product)[0]
+            spec_strings = [specs.text] if specs.text else []
+            for spec in specs:
+                spec_strings.append(_lxml_string(spec))
+                if spec.tail:
+                    spec_strings.append(spec.tail)
+
+            price = PRICE_XPATH(product)
+            price = price[0].text if price else None
+            town = TOWN_XPATH(product)
+            city = CITY_XPATH(product)
+
+            cards.append({
+                "title": _lxml_string(TITLE_XPATH(product)[0]),
+                "specs": spec_strings,
+                "price": price,
+                "link": LINK_XPATH(product)[0].get("href"),
+                "sold": bool(SOLD_XPATH(product)),
+                "town": _lxml_string(town[0]) if town else None,
+                "city": _lxml_string(city[0]) if city else None,
+                # Check if it managed by real estate agency
+                "is_real_estate_agency": any(_lxml_string(span) == "Agenzia" for span in SPAN_XPATH(product))
+            })
+
+        return cards
+
+
+def parse_listing_page(data: bytes, url: str, backend: str = "html.parser") -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Parses a raw listing page into the `house` dicts of its cards and the number of specs that could not be recognized.
+    Defined at module level so that it can be shipped to a process pool.
+    """
+
+    # Pages not modified since the last crawl are empty
+    if not data:
+        return [], 0
+
+    re_status = SubitoItParser._real_estate_status(url)
+
+    if backend == "lxml":
+        cards = SubitoItParser._parse_lxml(data)
+    else:
+        cards = SubitoItParser._parse_html_parser(data)
+
+    houses = [SubitoItParser._house(re_status, **card) for card in cards]
+
+    return [house for house, _ in houses], sum(unknown_specs for _, unknown_specs in houses)
+
+
+@component
+class ListingNormalizer:
+    """
+    Converts the raw strings extracted by SubitoItParser into typed values:
+        - mq, n_rooms, n_bathrooms and price become integers
+        - floor is kept as label and its sortable numeric code is added as `floor_code`
+        - city and province are case-folded
+    The "NOT-FOUND" sentinel becomes None (NULL in the database).
+    """
+
+    NOT_FOUND = "NOT-FOUND"
+    INTEGER_FIELDS = ("mq", "n_rooms", "n_bathrooms", "price")
+    TEXT_FIELDS = ("city", "province")
+    INTEGER_REGEX = re.compile(r"-?\d+")
+
+    def _to_int(self, value: Any) -> Optional[int]:
+
+        if isinstance(value, int) or value is None:
+            return value
+
+        match = self.INTEGER_REGEX.search(str(value).replace(".", ""))
+
+        return int(match.group()) if match else None
+
+    def normalize(self, document: Document) -> Document:
+
+        CARDS.inc()
+
+        for field, value in document.meta.items():
+            if value == self.NOT_FOUND:
+                PARSE_FALLBACKS.labels(field=field).inc()
+
+        return Document(id=document.id, content=document.content, meta=self.normalize_meta(document.meta))
+
+    def normalize_meta(self, meta: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        The conversions without the metrics, also used to migrate the rows written before the normalizer.
+        """
+
+        meta = {k: (None if v == self.NOT_FOUND else v) for k, v in meta.items()}
+
+        for field in self.INTEGER_FIELDS:
+            meta[field] = self._to_int(meta.get(field))
+
+        for field in self.TEXT_FIELDS:
+            if meta.get(field) is not None:
+                meta[field] = meta[field].strip().casefold()
+
+        floor = meta.get("floor")
+        meta["floor_code"] = FLOOR_CODES[floor] if floor in FLOOR_CODES else self._to_int(floor)
+
+        return meta
+
+    @component.output_types(documents=List[Document])
+    def run(self, documents: List[Document]):
+
+        return {"documents": [self.normalize(document) for document in documents]}
+
+
+@component
+class NearDuplicateClusterer:
+    """
+    Gives the same `cluster_id` to the near-duplicate listings, e.g. the same apartment posted by several agencies
+    with slightly different titles.
+
+    Every cluster has a seed, its first listing, and a listing joins a cluster only if it matches the seed:
+    same city and rooms, mq within `mq_tolerance`, price within `price_tolerance` (relative) and titles with an
+    estimated Jaccard similarity of at least `min_similarity`. Listings are never compared with the other
+    members of a cluster, so a cluster cannot drift away from its seed through a chain of similar listings.
+
+    Candidate seeds are found with LSH: titles are compared through MinHash signatures of their character
+    shingles, split in `bands` bands, and every band of a seed is hashed into a bucket together with its city,
+    rooms and mq / price cells (as wide as the tolerances). A listing is looked up in the buckets of its cells
+    and of the neighbouring ones, which hold every seed within the tolerances.
+
+    Seeds, buckets and assignments are stored in the database, so new listings are clustered incrementally with
+    a fixed number of lookups. Known listings keep their cluster.
+    """
+
+    MERSENNE_PRIME = (1 << 61) - 1
+    MAX_HASH = (1 << 32) - 1
+    SEED_COLUMNS = ["cluster_id", "city", "n_rooms", "mq", "price", "signature"]
+
+    def __init__(
+        self, dbname: str, table_name: str = "listing_clusters", num_perm: int = 64, bands: int = 16, shingle_size: int = 4,
+        mq_tolerance: int = 5, price_tolerance: float = 0.05, min_similarity: float = 0.5, seed: int = 1
+    ) -> None:
+
+        if num_perm % bands != 0:
+            raise ValueError("num_perm must be a multiple of bands")
+
+        self.table_name = table_name
+        self.seeds_table = f"{table_name}_seeds"
+        self.buckets_table = f"{table_name}_buckets"
+        self.bands = bands
+        self.rows_per_band = num_perm // bands
+        self.shingle_size = shingle_size
+        self.mq_tolerance = mq_tolerance
+        self.price_tolerance = price_tolerance
+        self.min_similarity = min_similarity
+        self._pool = get_pool(dbname)
+
+        # Permutations h(x) = (a * x + b) mod p, x and a below 2^32 so that a * x + b fits 64 bits
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, self.MAX_HASH, size=num_perm, dtype=np.uint64)[:, None]
+        self._b = rng.randint(0, self.MAX_HASH, size=num_perm, dtype=np.uint64)[:, None]
+
+        with self._pool.writer() as connection:
+            with connection:
+                connection.execute("BEGIN")
+
+                # Clusters of the first version could chain different listings together: they are rebuilt as the listings are crawled again
+                tables = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+                if self.table_name in tables and self.seeds_table not in tables:
+                    connection.execute(f"DROP TABLE {self.table_name}")
+                    connection.execute(f"DROP TABLE IF EXISTS {self.buckets_table}")
+
+                connection.execute(f"CREATE TABLE IF NOT EXISTS {self.table_name} (link TEXT PRIMARY KEY, cluster_id INTEGER NOT NULL) WITHOUT ROWID")
+                connection.execute(f"CREATE INDEX IF NOT EXISTS ix_{self.table_name}_cluster ON {self.table_name} (cluster_id)")
+                connection.execute(
+                    f"""CREATE TABLE IF NOT EXISTS {self.seeds_table} (
+                        cluster_id INTEGER PRIMARY KEY, city TEXT, n_rooms INTEGER, mq INTEGER, price INTEGER, signature BLOB NOT NULL
+                    )"""
+                )
+                connection.execute(
+                    f"CREATE TABLE IF NOT EXISTS {self.buckets_table} (bucket INTEGER NOT NULL, cluster_id INTEGER NOT NULL, PRIMARY KEY (bucket, cluster_id)) WITHOUT ROWID"
+                )
+
+    @staticmethod
+    def _hash(text: str, signed: bool = False) -> int:
+
+        return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8 if signed else 4).digest(), "little", signed=signed)
+
+    def shingles(self, title: Optional[str]) -> List[str]:
+
+        title = " ".join((title or "").casefold().split())
+
+        return sorted({title[i:i + self.shingle_size] for i in range(max(1, len(title) - self.shingle_size + 1))}) if title else []
+
+    def signature(self, title: Optional[str]) -> Optional[np.ndarray]:
+
+        shingles = self.shingles(title)
+
+        if not shingles:
+            return None
+
+        x = np.array([self._hash(shingle) for shingle in shingles], dtype=np.uint64)[None, :]
+
+        return (((self._a * x + self._b) % np.uint64(self.MERSENNE_PRIME)) & np.uint64(self.MAX_HASH)).min(axis=1).astype(np.uint32)
+
+    @staticmethod
+    def _cells(position: Optional[float]) -> List[Optional[int]]:
+        """
+        Cell of a value followed by its two neighbouring cells, [None] when the value is missing.
+        """
+
+        if position is None:
+            return [None]
+
+        cell = math.floor(position)
+
+        return [cell, cell - 1, cell + 1]
+
+    def buckets(self, document: Document) -> Tuple[Optional[np.ndarray], List[int], List[int]]:
+        """
+        Returns the signature of the listing, its buckets as a seed (one per band) and the buckets to look up
+        (those of the neighbouring cells too).
+        """
+
+        signature = self.signature(document.content)
+
+        if signature is None:
+            return None, [], []
+
+        meta = document.meta
+        mq_cells = self._cells(meta["mq"] / self.mq_tolerance if meta.get("mq") else None)
+        price_cells = self._cells(math.log(meta["price"]) / math.log1p(self.price_tolerance) if meta.get("price") else None)
+        bands = [band.tobytes().hex() for band in signature.reshape(self.bands, self.rows_per_band)]
+
+        def bucket(i, band, mq_cell, price_cell):
+            return self._hash(f"{meta.get('city')}|{meta.get('n_rooms')}|{mq_cell}|{price_cell}|{i}|{band}", signed=True)
+
+        own = [bucket(i, band, mq_cells[0], price_cells[0]) for i, band in enumerate(bands)]
+        probes = [bucket(i, band, mq_cell, price_cell) for i, band in enumerate(bands) for mq_cell in mq_cells for price_cell in price_cells]
+
+        return signature, own, probes
+
+    def similarity(self, meta: Dict[str, Any], signature: np.ndarray, seed: tuple) -> float:
+        """
+        Estimated title similarity with the seed of a cluster, 0 when the attributes are out of tolerance.
+        """
+
+        _, city, n_rooms, mq, price, seed_signature = seed
+
+        if (meta.get("city"), meta.get("n_rooms")) != (city, n_rooms):
+            return 0.0
+
+        new_mq, new_price = meta.get("mq") or None, meta.get("price") or None
+
+        if (new_mq is None) != (mq is None) or (mq is not None and abs(new_mq - mq) > self.mq_tolerance):
+            return 0.0
+        if (new_price is None) != (price is None) or (price is not None and abs(math.log(new_price / price)) > math.log1p(self.price_tolerance)):
+            return 0.0
+
+        return float(np.mean(signature == np.frombuffer(seed_signature, dtype=np.uint32)))
+
+    def assign(self, documents: List[Document]) -> List[Document]:
+        """
+        Sets `cluster_id` in the metadata of the documents and saves the new listings, the new seeds and their buckets.
+        """
+
+        linked = [doc for doc in documents if doc.meta.get("link") is not None]
+
+        if not linked:
+            return documents
+
+        # Signatures are computed before taking the write lock
+        known = self.clusters_of([doc.meta["link"] for doc in linked])
+        new_documents = [(doc, self.buckets(doc)) for doc in linked if doc.meta["link"] not in known]
+
+        with self._pool.writer() as connection:
+            with timed("deduplicator"), connection:
+                # Taken at once: another process could pick the same new cluster ids otherwise
+                connection.execute("BEGIN IMMEDIATE")
+
+                # Listings saved by another process in the meantime
+                known.update(select_in(connection, self.table_name, ["link", "cluster_id"], "link", [doc.meta["link"] for doc, _ in new_documents]))
+                new_documents = [(doc, buckets) for doc, buckets in new_documents if doc.meta["link"] not in known]
+
+                candidates = {}
+                probed = list({b for _, (_, _, probes) in new_documents for b in probes})
+                for bucket, cluster_id in select_in(connection, self.buckets_table, ["bucket", "cluster_id"], "bucket", probed):
+                    candidates.setdefault(bucket, []).append(cluster_id)
+
+                seed_ids = list({cluster_id for cluster_ids in candidates.values() for cluster_id in cluster_ids})
+                seeds = {row[0]: row for row in select_in(connection, self.seeds_table, self.SEED_COLUMNS, "cluster_id", seed_ids)}
+
+                next_id = (connection.execute(f"SELECT MAX(cluster_id) FROM {self.table_name}").fetchone()[0] or 0) + 1
+                new_links, new_seeds, new_buckets = {}, [], []
+
+                for doc, (signature, own, probes) in new_documents:
+                    link = doc.meta["link"]
+                    if link in new_links:
+                        continue
+
+                    scores = {cluster_id: self.similarity(doc.meta, signature, seeds[cluster_id]) for cluster_id in {c for b in probes for c in candidates.get(b, ())}}
+                    scores = {cluster_id: score for cluster_id, score in scores.items() if score >= self.min_similarity}
+
+                    if scores:
+                        cluster_id = max(scores, key=lambda c: (scores[c], -c))
+                    else:
+                        # A new cluster seeded by this listing, found through its buckets by the next ones
+                        cluster_id, next_id = next_id, next_id + 1
+                        if signature is not None:
+                            seed = (cluster_id, doc.meta.get("city"), doc.meta.get("n_rooms"), doc.meta.get("mq") or None, doc.meta.get("price") or None, signature.tobytes())
+                            seeds[cluster_id] = seed
+                            new_seeds.append(seed)
+                            for bucket in own:
+                                candidates.setdefault(bucket, []).append(cluster_id)
+                                new_buckets.append((bucket, cluster_id))
+
+                    new_links[link] = cluster_id
+
+                connection.executemany(f"INSERT INTO {self.table_name} (link, cluster_id) VALUES (?, ?)", new_links.items())
+                connection.executemany(f"INSERT INTO {self.seeds_table} ({', '.join(self.SEED_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?)", new_seeds)
+                connection.executemany(f"INSERT INTO {self.buckets_table} (bucket, cluster_id) VALUES (?, ?)", new_buckets)
+
+        for doc in linked:
+            doc.meta["cluster_id"] = known.get(doc.meta["link"], new_links.get(doc.meta["link"]))
+
+        return documents
+
+    def clusters_of(self, links: List[str]) -> Dict[str, int]:
+
+        return dict(select_in(self._pool.reader(), self.table_name, ["link", "cluster_id"], "link", list(set(links))))
+
+    def collapse(self, rows: List[Any], link_index: Any = "link") -> List[Any]:
+        """
+        Keeps the first row of every cluster, `link_index` is the position (tuples) or key (dicts) of the link.
+        Rows of unknown listings are kept.
+        """
+
+        clusters = self.clusters_of([row[link_index] for row in rows if row[link_index] is not None])
+        seen, collapsed = set(), []
+
+        for row in rows:
+            cluster_id = clusters.get(row[link_index])
+            if cluster_id is not None:
+                if cluster_id in seen:
+                    continue
+                seen.add(cluster_id)
+            collapsed.append(row)
+
+        return collapsed
+
+    @component.output_types(documents=List[Document])
+    def run(self, documents: List[Document]):
+
+        return {"documents": self.assign(documents)}
 
 
 @component
 class SQLWriter:
+    """
+    Writes the documents into a SQLite table with incremental upserts.
+
+    Every row is identified by `key_column` (unique index) and carries a `content_hash` of its values:
+    new keys are inserted, changed rows are updated and unchanged rows are not written at all.
+
+    With `full_text_column` an FTS5 index of that column is kept in sync with the table (see SQLQuery).
+    With `history` the new listings and the changed fields are recorded in the ListingHistory of the table.
+    """
+
+    HASH_COLUMN = "content_hash"
+    MIGRATIONS_TABLE = "schema_migrations"
     
-    def __init__(self, dbname: str) -> None:
+    def __init__(self, dbname: str, key_column: str = "link", full_text_column: Optional[str] = None, history: Optional[ListingHistory] = None) -> None:
 
         self._dbname = dbname   
-        self.connection = sqlite3.connect(self._dbname)
+        self.key_column = key_column
+        self.full_text_column = full_text_column
+        self.history = history
+        self._pool = get_pool(self._dbname)
 
-    def _insert_query(self, table_name: str, table_schema: Dict[str, str], **kwargs):
+        # Tables already created and migrated by this writer
+        self._ensured = set()
 
-        insert_query = f"INSERT INTO {table_name} ({', '.join(table_schema.keys())}) VALUES ({', '.join(['?'] * len(table_schema))})"       
-        
+    def _upsert_query(self, table_name: str, table_schema: Dict[str, str], **kwargs):
 
-        return insert_query
+        columns = [*table_schema.keys(), self.HASH_COLUMN]
+        updates = ", ".join(f"{col} = excluded.{col}" for col in columns if col != self.key_column)
 
-    @component.output_types(rows_written=int)
-    def run(self, documents: List[Document], table_name: str, table_schema: Dict[str, str], create_table: bool = False,  **kwargs):
-        
-        insert_query = self._insert_query(table_name, table_schema)
+        upsert_query = (
+            f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({', '.join(['?'] * len(columns))}) "
+            f"ON CONFLICT({self.key_column}) DO UPDATE SET {updates} "
+            f"WHERE {table_name}.{self.HASH_COLUMN} IS NOT excluded.{self.HASH_COLUMN}"
+        )
+
+        return upsert_query
+
+    @staticmethod
+    def _content_hash(values: tuple) -> str:
 
-        data = []
+        return hashlib.blake2b(json.dumps(values, default=str).encode(), digest_size=16).hexdigest()
+
+    def _rows(self, documents: List[Document], table_schema: Dict[str, str]) -> Dict[Any, tuple]:
+        """
+        Returns the rows to write indexed by key, the last occurrence of a key wins.
+        """
+
+        data = {}
 
         for doc in documents:
             
@@ -149,9 +926,47 @@ class SQLWriter:
             for col in table_schema:
                 values.append(tmp[col])
 
-            data.append(tuple(values))
-            
-        cursor = self.connection.cursor()
+            values = tuple(values)
+
+            if tmp[self.key_column] is None:
+                logging.warning(f"Skipping document without {self.key_column}: {doc.content}")
+                continue
+
+            data[tmp[self.key_column]] = (*values, self._content_hash(values))
+
+        return data
+
+    def _stored_hashes(self, connection: sqlite3.Connection, table_name: str, keys: List[Any]) -> Dict[Any, str]:
+
+        return dict(select_in(connection, table_name, [self.key_column, self.HASH_COLUMN], self.key_column, keys))
+
+    def ensure_table(self, table_name: str, table_schema: Dict[str, str], create_table: bool = False, table_indexes: Optional[List[List[str]]] = None):
+        """
+        Creates the table if needed and the secondary indexes declared in `table_indexes`,
+        a list of column lists (e.g. [["city"], ["province", "price"]]).
+        Done once per table by every writer, later calls return at once.
+        """
+
+        key = (table_name, tuple(table_schema.items()), create_table, tuple(tuple(columns) for columns in table_indexes or []))
+
+        if key in self._ensured:
+            return
+
+        with self._pool.writer() as connection:
+            # All or nothing: a failed migration must not stay open on the shared writer connection.
+            # The explicit BEGIN makes the DDL part of the transaction too
+            with connection:
+                connection.execute("BEGIN")
+                self._ensure_table(connection, table_name, table_schema, create_table, table_indexes)
+
+            # Refresh the planner statistics so that the new indexes are used
+            connection.execute("PRAGMA optimize")
+
+        self._ensured.add(key)
+
+    def _ensure_table(self, connection: sqlite3.Connection, table_name: str, table_schema: Dict[str, str], create_table: bool, table_indexes: Optional[List[List[str]]]):
+
+        cursor = connection.cursor()
 
         # Check if table exists
   
@@ -164,12 +979,162 @@ class SQLWriter:
             if not create_table:
                 raise Exception(f"Table {table_name} not found")
 
-            cursor.execute(f"CREATE TABLE {table_name} ({', '.join([f'{k} {v}' for k, v in table_schema.items()])})")
+            cursor.execute(f"CREATE TABLE {table_name} ({', '.join([f'{k} {v}' for k, v in table_schema.items()])}, {self.HASH_COLUMN} VARCHAR(32))")
+
+        # Tables created by older versions: add the missing columns and drop the duplicated keys
+        columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table_name})").fetchall()]
+
+        for column, column_type in {**table_schema, self.HASH_COLUMN: "VARCHAR(32)"}.items():
+            if column not in columns:
+                cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column} {column_type}")
+
+        index_name = f"ux_{table_name}_{self.key_column}"
+
+        if not cursor.execute("SELECT name FROM sqlite_master WHERE type='index' AND name=?", (index_name,)).fetchall():
+            cursor.execute(
+                f"DELETE FROM {table_name} WHERE rowid NOT IN (SELECT MAX(rowid) FROM {table_name} GROUP BY {self.key_column})"
+            )
+            if cursor.rowcount > 0:
+                bump_generation(connection)
+            cursor.execute(f"CREATE UNIQUE INDEX {index_name} ON {table_name} ({self.key_column})")
+
+        self._normalize_rows(connection, table_name, table_schema)
 
-        cursor.executemany(insert_query, data)
-        self.connection.commit()
+        for columns in table_indexes or []:
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS ix_{table_name}_{'_'.join(columns)} ON {table_name} ({', '.join(columns)})")
+
+        if self.full_text_column is not None:
+            self._ensure_full_text(cursor, table_name)
+
+        if self._history_of(table_name) is not None:
+            self.history.ensure(connection, table_schema)
+
+    def _normalize_rows(self, connection: sqlite3.Connection, table_name: str, table_schema: Dict[str, str]):
+        """
+        One-time migration of the rows written before ListingNormalizer: the same rules are applied to them
+        ("85 mq" to 85, "NOT-FOUND" to NULL, case-folded city and province, floor_code filled) and their
+        content hash is recomputed, so that the listings that are not crawled again compare correctly too.
+        """
+
+        migration = f"{table_name}:normalize"
+
+        connection.execute(f"CREATE TABLE IF NOT EXISTS {self.MIGRATIONS_TABLE} (name TEXT PRIMARY KEY, applied_at REAL NOT NULL)")
+
+        if connection.execute(f"SELECT 1 FROM {self.MIGRATIONS_TABLE} WHERE name = ?", (migration,)).fetchone():
+            return
+
+        normalizer = ListingNormalizer()
+        columns = list(table_schema)
+        updates = []
+
+        for rowid, *values in connection.execute(f"SELECT rowid, {', '.join(columns)} FROM {table_name}"):
+            row = dict(zip(columns, values))
+            normalized = {**row, **{k: v for k, v in normalizer.normalize_meta(row).items() if k in row}}
+
+            if normalized != row:
+                new_values = tuple(normalized[column] for column in columns)
+                updates.append((*new_values, self._content_hash(new_values), rowid))
+
+        if updates:
+            connection.executemany(
+                f"UPDATE {table_name} SET {', '.join(f'{column} = ?' for column in columns)}, {self.HASH_COLUMN} = ? WHERE rowid = ?", updates
+            )
+            bump_generation(connection)
+            logging.info(f"Normalized {len(updates)} rows of {table_name}")
+
+        connection.execute(f"INSERT INTO {self.MIGRATIONS_TABLE} (name, applied_at) VALUES (?, ?)", (migration, time.time()))
+
+    def _ensure_full_text(self, cursor: sqlite3.Cursor, table_name: str):
+        """
+        Creates the FTS5 table indexing `full_text_column`. It is an external content table (the text is
+        not stored twice) keyed by the rowid of the listings, triggers keep it in sync with every write,
+        upserts included. It is filled from the existing rows when created.
+        """
+
+        fts_table = full_text_table(table_name)
+        column = self.full_text_column
+
+        if cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (fts_table,)).fetchall():
+            return
+
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE {fts_table} USING fts5({column}, content='{table_name}', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2')"
+        )
+        cursor.execute(
+            f"""CREATE TRIGGER {fts_table}_ai AFTER INSERT ON {table_name} BEGIN
+                INSERT INTO {fts_table} (rowid, {column}) VALUES (new.rowid, new.{column});
+            END"""
+        )
+        cursor.execute(
+            f"""CREATE TRIGGER {fts_table}_ad AFTER DELETE ON {table_name} BEGIN
+                INSERT INTO {fts_table} ({fts_table}, rowid, {column}) VALUES ('delete', old.rowid, old.{column});
+            END"""
+        )
+        cursor.execute(
+            f"""CREATE TRIGGER {fts_table}_au AFTER UPDATE OF {column} ON {table_name} BEGIN
+                INSERT INTO {fts_table} ({fts_table}, rowid, {column}) VALUES ('delete', old.rowid, old.{column});
+                INSERT INTO {fts_table} (rowid, {column}) VALUES (new.rowid, new.{column});
+            END"""
+        )
+        cursor.execute(f"INSERT INTO {fts_table} ({fts_table}) VALUES ('rebuild')")
+
+    def _history_of(self, table_name: str) -> Optional[ListingHistory]:
+
+        return self.history if self.history is not None and self.history.table_name == table_name else None
+
+    def write_batch(self, documents: List[Document], table_name: str, table_schema: Dict[str, str]) -> Dict[str, int]:
+        """
+        Upserts the documents in a single transaction: either the whole batch is committed or none of it.
+        Returns the number of inserted, updated and unchanged rows.
+        """
+
+        data = self._rows(documents, table_schema)
+
+        counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+        inserted, updated = {}, {}
+
+        with self._pool.writer() as connection:
+
+            stored_hashes = self._stored_hashes(connection, table_name, list(data.keys()))
+
+            for key, row in data.items():
+                if key not in stored_hashes:
+                    inserted[key] = row
+                elif stored_hashes[key] != row[-1]:
+                    updated[key] = row
+                else:
+                    counts["unchanged"] += 1
+
+            counts["inserted"], counts["updated"] = len(inserted), len(updated)
+            changed = [*inserted.values(), *updated.values()]
+
+            if changed:
+                with timed("document_store"), connection:
+                    # The stored rows are compared before being overwritten
+                    if self._history_of(table_name) is not None:
+                        self.history.record(connection, table_schema, inserted, updated)
+                    connection.executemany(self._upsert_query(table_name, table_schema), changed)
+                    # Invalidates the cached search results
+                    bump_generation(connection)
+
+        for outcome, count in counts.items():
+            ROWS.labels(outcome=outcome).inc(count)
+
+        return counts
+
+    @component.output_types(rows_written=int, inserted=int, updated=int, unchanged=int)
+    def run(self, documents: List[Document], table_name: str, table_schema: Dict[str, str], create_table: bool = False, table_indexes: Optional[List[List[str]]] = None, batch_size: Optional[int] = None, **kwargs):
+        
+        self.ensure_table(table_name, table_schema, create_table, table_indexes)
+
+        batch_size = batch_size or len(documents) or 1
+        counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+
+        for start in range(0, len(documents), batch_size):
+            for name, count in self.write_batch(documents[start:start + batch_size], table_name, table_schema).items():
+                counts[name] += count
     
-        return {"rows_written": len(data)}
+        return {"rows_written": counts["inserted"] + counts["updated"], **counts}
 
 
 @component
@@ -185,27 +1150,670 @@ class SQLValidator:
 
 
 @component
-class SQLQuery:
+class RuleBasedQueryParser:
+    """
+    Fast path of the search pipeline: translates simple filter questions
+    ("trilocale a Cagliari sotto 200.000 euro") into parameterized SQL without calling the LLM.
+
+    Cities come from the listings in the database, provinces, floors and statuses from the macros.
+    Every word of the question must be explained by a filter or be a stopword, otherwise
+    (confidence below `min_confidence`) the question is forwarded to the LLM.
+    """
+
+    NUMBER = r"(\d+(?:[.,]\d+)*)\s*(k|mila|mln|milion[ei])?"
+    LESS = r"(?:sotto|meno di|fino a|massimo|max|entro|inferiore a|non oltre)"
+    MORE = r"(?:sopra|più di|piu di|oltre|almeno|minimo|min|superiore a)"
+    PRICE_UNIT = r"(?:\s*(?:euro|€))?"
+    MQ_UNIT = r"\s*(?:mq|m2|metri quadri|metri quadrati|metri)"
+
+    PRICE_BETWEEN_REGEX = re.compile(rf"(?:tra|fra) (?:i )?{NUMBER}{PRICE_UNIT} e (?:i )?{NUMBER}{PRICE_UNIT}")
+    PRICE_LESS_REGEX = re.compile(rf"{LESS} (?:i |ai |a )?{NUMBER}{PRICE_UNIT}(?!{MQ_UNIT})")
+    PRICE_MORE_REGEX = re.compile(rf"{MORE} (?:i |ai |a )?{NUMBER}{PRICE_UNIT}(?!{MQ_UNIT})")
+    MQ_LESS_REGEX = re.compile(rf"{LESS} (?:i |ai |a )?(\d+){MQ_UNIT}")
+    MQ_MORE_REGEX = re.compile(rf"(?:{MORE} (?:i |ai |a )?|da )(\d+){MQ_UNIT}")
+    ROOMS_REGEX = re.compile(r"(\d+) (?:locali|stanze|vani)")
+    BATHROOMS_REGEX = re.compile(r"(\d+|un|uno|due|tre) bagn[oi]")
+    FLOOR_REGEX = re.compile(r"(?:(\d+)\s*° piano|piano (\d+)|(\d+)° piano)")
+    NOT_SOLD_REGEX = re.compile(r"non vendut[aeio]|disponibil[ei]")
+    PRIVATE_REGEX = re.compile(r"(?:da |di )?privat[io]|senza agenzia")
+    AGENCY_REGEX = re.compile(r"(?:da |di |con )?agenzi[ae]")
+    WORD_REGEX = re.compile(r"[\w€]+")
+
+    NUMBER_WORDS = {"un": 1, "uno": 1, "due": 2, "tre": 3}
+
+    def __init__(self, dbname: str, table_name: str = "real_estates", min_confidence: float = 1.0) -> None:
+
+        self._dbname = dbname
+        self.table_name = table_name
+        self.min_confidence = min_confidence
+        self._pool = get_pool(self._dbname)
+
+        self._generation = None
+        self._city_regex = None
+        self._province_regex = re.compile(
+            r"(?:(?:in |nella )?provincia di )?(?<!\w)(" + "|".join(
+                re.escape(p.casefold()) for p in sorted(PROVINCE_MAP.values(), key=len, reverse=True)
+            ) + r")(?!\w)"
+        )
+        self._rooms_regex = re.compile(r"(?<!\w)(" + "|".join(ROOMS_MAP) + r")(?!\w)")
+        self._status_map = {status.casefold(): status for status in REAL_ESTATE_STATUS.values()}
+        self._status_regex = re.compile(r"(?<!\w)(" + "|".join(re.escape(s) for s in self._status_map) + r")(?!\w)")
+        self._floor_map = {value.casefold(): FLOOR_CODES[value] for value in FLOOR_CODES if value != "Piano"}
+        self._floor_map.update({key.casefold().rstrip("."): FLOOR_CODES[value] for key, value in FLOOR_MAP.items()})
+        self._floor_words_regex = re.compile(r"(?<!\w)(" + "|".join(re.escape(f) for f in sorted(self._floor_map, key=len, reverse=True)) + r")\.?(?!\w)")
+
+        self.answered = 0
+        self.total = 0
+
+    def _load_cities(self):
+        """
+        (Re)builds the city lexicon when the index changed since the last time.
+        """
+
+        connection = self._pool.reader()
+        generation = read_generation(connection)
+
+        if generation == self._generation:
+            return
+
+        try:
+            cities = [row[0] for row in connection.execute(f"SELECT DISTINCT city FROM {self.table_name} WHERE city IS NOT NULL")]
+        except sqlite3.OperationalError:
+            cities = []
+
+        self._city_regex = re.compile(
+            r"(?<!\w)(" + "|".join(re.escape(c) for c in sorted(cities, key=len, reverse=True)) + r")(?!\w)"
+        ) if cities else None
+        self._generation = generation
+
+    def warm_up(self):
+
+        self._load_cities()
+
+    @classmethod
+    def _number(cls, value: str, unit: Optional[str]) -> int:
+
+        if unit in ("k", "mila"):
+            return int(float(value.replace(".", "").replace(",", ".")) * 1000)
+
+        if unit:
+            return int(float(value.replace(".", "").replace(",", ".")) * 1000000)
+
+        return int(value.replace(".", "").replace(",", ""))
+
+    def parse(self, question: str) -> Tuple[List[Tuple[str, str, Any]], float]:
+        """
+        Extracts the filters of the question as (column, operator, value).
+        Returns them with the share of the meaningful words that were understood.
+        """
+
+        text = question.casefold()
+        filters = []
+
+        def consume(regex, handler):
+            nonlocal text
+            for match in list(regex.finditer(text)):
+                filters.extend(handler(match))
+            text = regex.sub(" ", text)
+
+        words_before = [w for w in self.WORD_REGEX.findall(text) if w not in QUERY_STOPWORDS]
+
+        consume(self.PRICE_BETWEEN_REGEX, lambda m: [("price", ">=", self._number(*m.group(1, 2))), ("price", "<=", self._number(*m.group(3, 4)))])
+        consume(self.MQ_LESS_REGEX, lambda m: [("mq", "<=", int(m.group(1)))])
+        consume(self.MQ_MORE_REGEX, lambda m: [("mq", ">=", int(m.group(1)))])
+        consume(self.PRICE_LESS_REGEX, lambda m: [("price", "<=", self._number(*m.group(1, 2)))])
+        consume(self.PRICE_MORE_REGEX, lambda m: [("price", ">=", self._number(*m.group(1, 2)))])
+        consume(self.ROOMS_REGEX, lambda m: [("n_rooms", "=", int(m.group(1)))])
+        consume(self._rooms_regex, lambda m: [("n_rooms", "=", ROOMS_MAP[m.group(1)])])
+        consume(self.BATHROOMS_REGEX, lambda m: [("n_bathrooms", "=", self.NUMBER_WORDS.get(m.group(1)) or int(m.group(1)))])
+        consume(self._floor_words_regex, lambda m: [("floor_code", "=", self._floor_map[m.group(1)])])
+        consume(self.FLOOR_REGEX, lambda m: [("floor_code", "=", int(next(g for g in m.groups() if g)))])
+        consume(self._status_regex, lambda m: [("status", "=", self._status_map[m.group(1)])])
+        consume(self.NOT_SOLD_REGEX, lambda m: [("sold", "=", False)])
+        consume(self.PRIVATE_REGEX, lambda m: [("is_real_estate_agency", "=", False)])
+        consume(self.AGENCY_REGEX, lambda m: [("is_real_estate_agency", "=", True)])
+
+        # "provincia di X" is a province, a bare name is a city when there are listings there
+        def province(match):
+            if not match.group(0).strip().startswith(("provincia", "in provincia", "nella provincia")) and self._city_regex is not None and self._city_regex.fullmatch(match.group(1)):
+                return [("city", "=", match.group(1))]
+            return [("province", "=", match.group(1))]
+
+        consume(self._province_regex, province)
+
+        if self._city_regex is not None:
+            consume(self._city_regex, lambda m: [("city", "=", m.group(1))])
+
+        words_after = [w for w in self.WORD_REGEX.findall(text) if w not in QUERY_STOPWORDS]
+
+        if not filters or not words_before:
+            return filters, 0.0
+
+        return filters, 1 - len(words_after) / len(words_before)
+
+    def to_sql(self, filters: List[Tuple[str, str, Any]]) -> Tuple[str, List[Any]]:
+
+        conditions = " AND ".join(f"{column} {operator} ?" for column, operator, _ in filters)
+
+        return f"SELECT * FROM {self.table_name} WHERE {conditions}", [value for _, _, value in filters]
+
+    @component.output_types(question=str, queries=List[str], parameters=List[List[Any]])
+    def run(self, question: str):
+
+        self._load_cities()
+
+        filters, confidence = self.parse(question)
+
+        self.total += 1
+
+        if confidence < self.min_confidence:
+            logging.debug(f"Fast path skipped ({confidence:.2f}): {question}")
+            return {"question": question}
+
+        self.answered += 1
+
+        query, parameters = self.to_sql(filters)
+
+        return {"queries": [query], "parameters": [parameters]}
+
+    def stats(self) -> Dict[str, Any]:
+
+        return {"answered": self.answered, "total": self.total, "share": self.answered / self.total if self.total else 0.0}
+
+
+class QueryRejectedError(Exception):
+    """
+    Raised when a generated query is not allowed to run.
+    """
+
+
+class LLMBusyError(Exception):
+    """
+    Raised when the LLM backend can't take the request, `retry_after` is the estimated wait in seconds.
+    """
+
+    def __init__(self, message: str, retry_after: float) -> None:
+
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class FairLimiter:
+    """
+    Caps the concurrent calls to a backend: callers beyond `max_concurrency` wait in FIFO order
+    and, when `max_queue` callers are already waiting, new ones are rejected at once.
+    One limiter is shared by all the pipelines using the same backend (`for_backend`).
+    """
+
+    _backends: Dict[str, "FairLimiter"] = {}
+    _backends_lock = threading.Lock()
+
+    def __init__(self, max_concurrency: int, max_queue: int) -> None:
+
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.active = 0
+        self.rejected = 0
+
+        self._waiters = deque()
+        self._lock = threading.Lock()
+        # Moving average of the call durations, used for the retry hint
+        self._average_seconds = None
+
+    @classmethod
+    def for_backend(cls, backend: str, max_concurrency: int, max_queue: int) -> "FairLimiter":
+
+        with cls._backends_lock:
+            limiter = cls._backends.setdefault(backend, cls(max_concurrency, max_queue))
+            limiter.max_concurrency, limiter.max_queue = max_concurrency, max_queue
+
+        return limiter
+
+    def retry_after(self) -> float:
+
+        return (self._average_seconds or 1.0) * (len(self._waiters) + 1) / self.max_concurrency
+
+    def acquire(self, timeout: Optional[float] = None):
+
+        with self._lock:
+            if self.active < self.max_concurrency and not self._waiters:
+                self.active += 1
+                return
+
+            if len(self._waiters) >= self.max_queue:
+                self.rejected += 1
+                raise LLMBusyError("The LLM backend is busy", self.retry_after())
+
+            waiter = threading.Event()
+            self._waiters.append(waiter)
+
+        if waiter.wait(timeout):
+            return
+
+        with self._lock:
+            # The slot may have been handed over right after the timeout
+            if waiter.is_set():
+                return
+            self._waiters.remove(waiter)
+            self.rejected += 1
+            raise LLMBusyError("Timed out waiting for the LLM backend", self.retry_after())
+
+    def release(self, elapsed: float):
+
+        with self._lock:
+            self._average_seconds = elapsed if self._average_seconds is None else 0.8 * self._average_seconds + 0.2 * elapsed
+
+            if self._waiters:
+                # The slot goes straight to the oldest waiter
+                self._waiters.popleft().set()
+            else:
+                self.active -= 1
+
+    def stats(self) -> Dict[str, Any]:
+
+        return {
+            "active": self.active, "waiting": len(self._waiters), "rejected": self.rejected,
+            "max_concurrency": self.max_concurrency, "max_queue": self.max_queue,
+            "average_seconds": self._average_seconds
+        }
+
+
+SQL_OPENING_FENCE_REGEX = re.compile(r"\s*```(?:sql)?", re.IGNORECASE)
+
+# Words that can follow a table name without being its alias
+SQL_KEYWORDS = {
+    "WHERE", "JOIN", "LEFT", "RIGHT", "FULL", "INNER", "OUTER", "CROSS", "NATURAL", "ON", "USING", "GROUP", "ORDER",
+    "LIMIT", "HAVING", "WINDOW", "UNION", "EXCEPT", "INTERSECT", "INDEXED", "NOT", "SET", "VALUES"
+}
+
+# Generated text after these is never part of the query
+SQL_STOP_SEQUENCES = ["```", ";"]
+
+
+def extract_sql(text: str) -> Tuple[str, bool]:
+    """
+    Returns the SQL at the start of a generated reply (without code fences and final semicolon)
+    and whether it is complete, i.e. the closing fence or the end of the statement was reached.
+    """
+
+    match = SQL_OPENING_FENCE_REGEX.match(text)
+    start = match.end() if match else 0
+    in_string = False
+
+    for i in range(start, len(text)):
+        if text[i] == "'":
+            in_string = not in_string
+        elif not in_string and (text[i] == ";" or text.startswith("```", i)):
+            return text[start:i].strip(), True
+
+    return text[start:].strip(), False
+
+
+class _GenerationComplete(Exception):
+    """
+    Raised from the streaming callback to stop a generation once the SQL is complete.
+    """
+
+    def __init__(self, text: str) -> None:
 
-    def __init__(self, dbname: str) -> None:
+        super().__init__()
+        self.text = text
+
+
+class _Flight:
+
+    def __init__(self) -> None:
+
+        self.done = threading.Event()
+        self.replies = None
+        self.error = None
+
+
+@component
+class GenerationGateway:
+    """
+    Sits in front of the `sqlcoder` generator:
+        - identical prompts in flight at the same time (case and spacing apart) share a single generation
+        - the generations are limited per backend by a FairLimiter, a full queue fails fast with LLMBusyError
+        - with `stream` the tokens are streamed and the generation is dropped as soon as the SQL is complete,
+          `generation_kwargs` (e.g. the backend stop sequences) are added to every call
+    Takes a plain `prompt` or chat `messages` depending on the wrapped generator.
+    """
+
+    def __init__(
+        self, generator: Any, backend: str, max_concurrency: int = 2, max_queue: int = 16, queue_timeout: Optional[float] = 60.0,
+        stream: bool = False, generation_kwargs: Optional[Dict[str, Any]] = None
+    ) -> None:
+
+        self.generator = generator
+        self.limiter = FairLimiter.for_backend(backend, max_concurrency, max_queue)
+        self.queue_timeout = queue_timeout
+        self.stream = stream
+        self.generation_kwargs = generation_kwargs or {}
+
+        self.generations = 0
+        self.coalesced = 0
+        self.stopped_early = 0
+
+        self._flights: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+        self._parameters = inspect.signature(generator.run).parameters
+
+        # Generators taking the callback only at init (Ollama) share it, the text of each call is thread-local
+        if stream and "streaming_callback" not in self._parameters and hasattr(generator, "streaming_callback"):
+            generator.streaming_callback = self._on_chunk
+
+    def _on_chunk(self, chunk: StreamingChunk):
+
+        self._local.text += chunk.content
+        sql, complete = extract_sql(self._local.text)
+
+        if complete:
+            raise _GenerationComplete(sql)
+
+    def warm_up(self):
+
+        if hasattr(self.generator, "warm_up"):
+            self.generator.warm_up()
+
+    @staticmethod
+    def _key(prompt: Optional[str], messages: Optional[List[ChatMessage]]) -> str:
+
+        text = prompt if prompt is not None else "\n".join(f"{m.role.value}: {m.text}" for m in messages or [])
+
+        return hashlib.blake2b(" ".join(text.casefold().split()).encode(), digest_size=16).hexdigest()
+
+    def _generate(self, prompt: Optional[str], messages: Optional[List[ChatMessage]]) -> list:
+
+        self.limiter.acquire(self.queue_timeout)
+        started = time.monotonic()
+
+        inputs = {"prompt": prompt} if prompt is not None else {"messages": messages}
+
+        if self.generation_kwargs and "generation_kwargs" in self._parameters:
+            inputs["generation_kwargs"] = self.generation_kwargs
+        if self.stream and "streaming_callback" in self._parameters:
+            inputs["streaming_callback"] = self._on_chunk
+
+        self._local.text = ""
+
+        try:
+            self.generations += 1
+            return self.generator.run(**inputs)["replies"]
+        except _GenerationComplete as e:
+            # The rest of the reply would be explanations, the connection is dropped
+            self.stopped_early += 1
+            return [ChatMessage.from_assistant(e.text) if messages is not None else e.text]
+        finally:
+            self.limiter.release(time.monotonic() - started)
+
+    def stats(self) -> Dict[str, Any]:
+
+        return {
+            "generations": self.generations, "coalesced": self.coalesced, "stopped_early": self.stopped_early,
+            "in_flight": len(self._flights), **self.limiter.stats()
+        }
+
+    @component.output_types(replies=Union[List[str], List[ChatMessage]])
+    def run(self, prompt: Optional[str] = None, messages: Optional[List[ChatMessage]] = None):
+
+        key = self._key(prompt, messages)
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return {"replies": list(flight.replies)}
+
+        try:
+            flight.replies = self._generate(prompt, messages)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+        return {"replies": flight.replies}
+
+
+@component
+class SQLQuery:
+    """
+    Runs the generated queries behind an execution guard:
+        - only a single SELECT statement is accepted, the statement is compiled with an authorizer that
+          denies anything but reading tables and calling functions
+        - the plan is inspected with EXPLAIN QUERY PLAN: scans of a table bigger than `max_scan_rows`
+          are rejected, by index or not (only searches are accepted on big tables)
+        - a LIMIT of `max_rows` is added, or the one in the query is clamped to it
+        - the execution is interrupted after `time_budget` seconds
+    Results are fetched in chunks so that at most `max_rows` rows are held in memory.
+
+    With `full_text_column` the predicate `<column> MATCH 'words'` is run on the FTS5 index kept by SQLWriter
+    and, when the query has no ORDER BY, the rows are sorted by BM25 relevance.
+    """
+
+    # LIMIT count [OFFSET offset] or LIMIT offset, count
+    LIMIT_REGEX = re.compile(r"\s+LIMIT\s+(\d+)(?:\s*(,|OFFSET)\s*(\d+))?\s*$", re.IGNORECASE)
+    # Full text (virtual table, ranked matches) is not a full table scan, a scan of an index is
+    SCAN_REGEX = re.compile(r"^SCAN (?!CONSTANT ROW|fts_rank\b)(\w+)\b(?! VIRTUAL TABLE)")
+    # Actions a query may need when it is compiled, everything else (writes, ATTACH, PRAGMA...) is denied
+    ALLOWED_ACTIONS = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE}
+    ORDER_BY_REGEX = re.compile(r"\b(?:ORDER|GROUP)\s+BY\b", re.IGNORECASE)
+    PROGRESS_STEPS = 1000
+
+    def __init__(self, dbname: str, max_rows: int = 100, time_budget: float = 2.0, max_scan_rows: int = 50000, table_name: str = "real_estates", full_text_column: Optional[str] = None) -> None:
 
         self._dbname = dbname   
-        self.connection = sqlite3.connect(self._dbname)
+        self._pool = get_pool(self._dbname)
+        self.max_rows = max_rows
+        self.time_budget = time_budget
+        self.max_scan_rows = max_scan_rows
+        self.table_name = table_name
+        self.full_text_column = full_text_column
+
+        if full_text_column is not None:
+            self._match_regex = re.compile(rf"\b(?:(\w+)\.)?{full_text_column}\s+MATCH\s+'((?:[^']|'')*)'", re.IGNORECASE)
+            self._alias_regex = re.compile(rf"\b{table_name}\s+(?:AS\s+)?(\w+)", re.IGNORECASE)
+
+    @staticmethod
+    def _full_text_query(text: str) -> str:
+        """
+        Turns free words into an FTS5 query matching all of them. Words ending with a vowel match as prefixes
+        of their stem, which covers the Italian singular/plural forms (terrazza, terrazze, terrazzo).
+        """
+
+        terms = []
+
+        for word in re.findall(r"\w+", text.replace("''", "'")):
+            if len(word) > 4 and word[-1].lower() in "aeiou":
+                terms.append(f'"{word[:-1]}"*')
+            else:
+                terms.append(f'"{word}"')
+
+        return " ".join(terms)
+
+    def _alias(self, query: str) -> str:
+        """
+        Name of the listings table in the query: its alias if it has one (FROM real_estates r).
+        """
 
-    @component.output_types(results=List[str], queries=List[str])
-    def run(self, queries: List[str]):
+        for match in self._alias_regex.finditer(query):
+            if match.group(1).upper() not in SQL_KEYWORDS:
+                return match.group(1)
+
+        return self.table_name
+
+    def _rewrite_full_text(self, query: str) -> str:
+
+        match = self._match_regex.search(query) if self.full_text_column is not None else None
+
+        if match is None:
+            return query
+
+        fts_table = full_text_table(self.table_name)
+        fts_query = self._full_text_query(match.group(2))
+        table = match.group(1) or self._alias(query)
+
+        if not fts_query:
+            return query[:match.start()] + "1 = 1" + query[match.end():]
+
+        # Sorted by relevance unless the query has its own order (or is a paginated / nested one)
+        ranked = not self.ORDER_BY_REGEX.search(query) and query.split(None, 1)[0].upper() == "SELECT"
+        matches = "fts_rank" if ranked else f"{fts_table} WHERE {fts_table} MATCH '{fts_query}'"
+
+        query = query[:match.start()] + f"{table}.rowid IN (SELECT rowid FROM {matches})" + query[match.end():]
+
+        if not ranked:
+            return query
+
+        # The full-text query runs once: the CTE is materialized and its automatic index serves the ORDER BY lookups
+        query = query.strip().rstrip(";").strip()
+        order_by = f" ORDER BY (SELECT rank FROM fts_rank WHERE fts_rank.rowid = {table}.rowid)"
+        limit = self.LIMIT_REGEX.search(query)
+        query = query + order_by if limit is None else query[:limit.start()] + order_by + query[limit.start():]
+
+        return f"WITH fts_rank AS MATERIALIZED (SELECT rowid, rank FROM {fts_table} WHERE {fts_table} MATCH '{fts_query}') {query}"
+
+    def _limit(self, query: str) -> str:
+
+        match = self.LIMIT_REGEX.search(query)
+
+        if match is None:
+            return f"{query} LIMIT {self.max_rows}"
+
+        if match.group(2) == ",":
+            offset, limit = match.group(1), match.group(3)
+        else:
+            limit, offset = match.group(1), match.group(3)
+
+        limit = min(int(limit), self.max_rows)
+
+        return f"{query[:match.start()]} LIMIT {limit}" + (f" OFFSET {offset}" if offset is not None else "")
+
+    def _table_rows(self, cursor: sqlite3.Cursor, table_name: str) -> int:
+
+        try:
+            return cursor.execute(f"SELECT MAX(rowid) FROM {table_name}").fetchone()[0] or 0
+        except sqlite3.OperationalError:
+            # Aliases and views: size unknown, considered big
+            return self.max_scan_rows + 1
+
+    @classmethod
+    def _authorize(cls, action: int, arg1: Optional[str], *args) -> int:
+
+        if action in cls.ALLOWED_ACTIONS:
+            return sqlite3.SQLITE_OK
+
+        # Issued by SQLite itself: loading the schema, and FTS5 checking whether its index changed
+        if (action, arg1) in ((sqlite3.SQLITE_UPDATE, "sqlite_master"), (sqlite3.SQLITE_PRAGMA, "data_version")):
+            return sqlite3.SQLITE_OK
+
+        return sqlite3.SQLITE_DENY
+
+    def guard(self, cursor: sqlite3.Cursor, query: str, parameters: List[Any]) -> str:
+        """
+        Validates the query and returns it with the LIMIT applied. Raises QueryRejectedError.
+        """
+
+        query = self._rewrite_full_text(query.strip().rstrip(";").strip())
+
+        # A semicolon outside of the string literals ends the statement, anything after it is another one
+        if extract_sql(query)[1] or not sqlite3.complete_statement(query + ";"):
+            raise QueryRejectedError("Only a single statement is allowed")
+
+        if query.split(None, 1)[0].upper() not in ("SELECT", "WITH"):
+            raise QueryRejectedError("Only SELECT statements are allowed")
+
+        # e.g. WITH x AS (SELECT 1) DELETE FROM ...
+        cursor.connection.set_authorizer(self._authorize)
+
+        try:
+            plan = [row[3] for row in cursor.execute(f"EXPLAIN QUERY PLAN {query}", parameters).fetchall()]
+        except sqlite3.DatabaseError as e:
+            if "not authorized" in str(e):
+                raise QueryRejectedError("Only SELECT statements are allowed") from e
+            raise
+        finally:
+            cursor.connection.set_authorizer(None)
+
+        big_scans = [
+            match.group(1) for match in map(self.SCAN_REGEX.match, plan)
+            if match and self._table_rows(cursor, match.group(1)) > self.max_scan_rows
+        ]
+
+        if len(big_scans) > 1:
+            raise QueryRejectedError(f"Cross join of full table scans: {', '.join(big_scans)}")
+
+        if big_scans:
+            raise QueryRejectedError(f"Full scan of {big_scans[0]}, bigger than {self.max_scan_rows} rows")
+
+        return self._limit(query)
+
+    def _execute(self, cursor: sqlite3.Cursor, query: str, parameters: List[Any]) -> Tuple[List[str], List[tuple]]:
+
+        connection = cursor.connection
+        deadline = time.monotonic() + self.time_budget
+
+        # A non zero return value aborts the running statement
+        connection.set_progress_handler(lambda: int(time.monotonic() > deadline), self.PROGRESS_STEPS)
+        connection.set_authorizer(self._authorize)
+
+        try:
+            result = cursor.execute(query, parameters)
+            columns = [column[0] for column in result.description or []]
+
+            rows = []
+            while len(rows) < self.max_rows and (chunk := result.fetchmany(min(50, self.max_rows - len(rows)))):
+                rows.extend(chunk)
+
+        except sqlite3.DatabaseError as e:
+            if time.monotonic() > deadline:
+                raise QueryRejectedError(f"Query exceeded the time budget of {self.time_budget}s") from e
+            # Denied by the authorizer while running, e.g. a table-valued PRAGMA function
+            if "not authorized" in str(e):
+                raise QueryRejectedError("The query uses a function that is not allowed") from e
+            raise
+
+        finally:
+            connection.set_progress_handler(None, 0)
+            connection.set_authorizer(None)
+
+        return columns, rows
+
+    @component.output_types(results=List[str], queries=List[str], parameters=List[List[Any]], columns=List[str], executed_queries=List[str])
+    def run(self, queries: List[str], parameters: Optional[List[List[Any]]] = None):
         results = []
+        columns = []
+        # The queries as run by SQLite: full text rewritten and LIMIT applied
+        executed_queries = []
+
+        parameters = parameters or [[] for _ in queries]
 
-        cursor = self.connection.cursor()
+        # Read-only connection of the current thread, it never waits for a running index build
+        cursor = self._pool.reader().cursor()
 
-        for query in queries:
+        for query, query_parameters in zip(queries, parameters):
             
-            print(f"QUERY GENERATA: \t {query}")
-            result = cursor.execute(query)
+            logging.debug(f"Generated query: {query} {query_parameters}")
+            query = self.guard(cursor, query, query_parameters)
+            executed_queries.append(query)
             
-            results.extend(result.fetchall())
+            columns, rows = self._execute(cursor, query, query_parameters)
+            results.extend(rows)
 
-        return {"results": results, "queries": queries}
+        return {"results": results[:self.max_rows], "queries": queries, "parameters": parameters, "columns": columns, "executed_queries": executed_queries}
     
 
 
@@ -222,9 +1830,10 @@ class SQLQueryParser:
         for query in replies:
             
             if isinstance(query, ChatMessage):
-                query = query.content
+                query = query.text
 
-            results = [query.replace("\n", " ")]
+            # Only the statement is kept, the model may go on with explanations after it
+            results = [extract_sql(query)[0].replace("\n", " ")]
 
             # try:
             #     parsed_query = regex.search(query).groups()[0].lower()
@@ -0,0 +1,426 @@
+import os
+import time
+import socket
+import logging
+import argparse
+import threading
+import multiprocessing
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from internal_lib.database import get_pool
+from internal_lib.macros import REGIONS, REAL_ESTATE_STATUS
+
+
+SUBITO_SEARCH_URL = "https://www.subito.it/annunci-{region}/vendita/appartamenti/"
+
+
+class ValidatorStore:
+    """
+    Remembers the ETag / Last-Modified validators of every crawled url, so that the next crawl
+    can send conditional requests and skip the pages that did not change.
+    """
+
+    def __init__(self, dbname: str, table_name: str = "http_validators") -> None:
+
+        self.table_name = table_name
+        self._pool = get_pool(dbname)
+
+        with self._pool.writer() as connection:
+            with connection:
+                connection.execute(
+                    f"CREATE TABLE IF NOT EXISTS {self.table_name} (url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, updated_at REAL NOT NULL)"
+                )
+
+    def get(self, url: str) -> Tuple[Optional[str], Optional[str]]:
+
+        row = self._pool.reader().execute(
+            f"SELECT etag, last_modified FROM {self.table_name} WHERE url = ?", (url,)
+        ).fetchone()
+
+        return row if row else (None, None)
+
+    def set(self, url: str, etag: Optional[str], last_modified: Optional[str]):
+
+        if etag is None and last_modified is None:
+            return
+
+        with self._pool.writer() as connection:
+            with connection:
+                connection.execute(
+                    f"INSERT OR REPLACE INTO {self.table_name} (url, etag, last_modified, updated_at) VALUES (?, ?, ?, ?)",
+                    (url, etag, last_modified, time.time())
+                )
+
+
+class CrawlScheduler:
+    """
+    Submits an incremental crawl job every `interval` seconds, unless one is still queued or running.
+    """
+
+    def __init__(self, job_runner: Any, interval: float, params_factory: Callable[[], Dict[str, Any]]) -> None:
+
+        self.job_runner = job_runner
+        self.interval = interval
+        self.params_factory = params_factory
+
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+
+        self._thread = threading.Thread(target=self._loop, name="crawl-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+
+        self._stopping.set()
+
+        if self._thread is not None:
+            self._thread.join()
+
+    def _loop(self):
+
+        while not self._stopping.wait(self.interval):
+
+            if self.job_runner.store.active_count() > 0:
+                logging.info("Scheduled crawl skipped: an index job is still active")
+                continue
+
+            job_id = self.job_runner.submit(self.params_factory())
+            logging.info(f"Scheduled incremental crawl {job_id}")
+
+
+def search_url(region: str, status: str, page: int) -> str:
+    """
+    Url of a result page of subito.it, `status` is a key of REAL_ESTATE_STATUS (the parser reads it back from the url).
+    """
+
+    url = SUBITO_SEARCH_URL.format(region=region)
+
+    if status == "nuove-costruzioni":
+        return url + f"{status}/?o={page}"
+
+    return url + f"?{status}&o={page}"
+
+
+def plan_items(regions: Optional[List[str]] = None, statuses: Optional[List[str]] = None, pages: int = 5) -> Iterator[Tuple[str, str, int, str]]:
+    """
+    Expands regions x statuses x pages into (region, status, page, url), by default over the whole country.
+    """
+
+    regions = regions or list(REGIONS)
+    statuses = statuses or list(REAL_ESTATE_STATUS)
+
+    for name, values, known in (("region", regions, REGIONS), ("status", statuses, REAL_ESTATE_STATUS)):
+        unknown = [value for value in values if value not in known]
+        if unknown:
+            raise ValueError(f"Unknown {name}: {', '.join(unknown)}")
+
+    for region in regions:
+        for status in statuses:
+            for page in range(1, pages + 1):
+                yield region, status, page, search_url(region, status, page)
+
+
+class CrawlQueue:
+    """
+    Work queue of a sharded crawl, shared by several processes through SQLite.
+
+    A plan holds one item per result page, a shard being the pages of one (region, status).
+    Workers lease items for `lease_seconds` and renew the lease with heartbeats while they crawl:
+    the items of a crashed worker are leased again once their lease expires, the completed ones
+    are never crawled again, so a plan can be stopped and resumed at any time.
+    An item failing `max_attempts` times is marked failed. When a page has no listings the
+    following pages of its shard are skipped.
+    """
+
+    COUNTERS = ("documents", "inserted", "updated", "unchanged")
+
+    def __init__(self, dbname: str, table_name: str = "crawl_queue", max_attempts: int = 3) -> None:
+
+        self.table_name = table_name
+        self.max_attempts = max_attempts
+        self._pool = get_pool(dbname)
+
+        with self._pool.writer() as connection:
+            with connection:
+                connection.execute(
+                    f"""CREATE TABLE IF NOT EXISTS {self.table_name} (
+                        id INTEGER PRIMARY KEY, plan VARCHAR(100) NOT NULL, region VARCHAR(50) NOT NULL,
+                        status VARCHAR(50) NOT NULL, page INTEGER NOT NULL, url TEXT NOT NULL,
+                        state VARCHAR(20) NOT NULL DEFAULT 'pending', worker VARCHAR(100), lease_expires REAL,
+                        attempts INTEGER NOT NULL DEFAULT 0, error TEXT,
+                        {', '.join(f'{c} INTEGER NOT NULL DEFAULT 0' for c in self.COUNTERS)},
+                        updated_at REAL, UNIQUE (plan, url)
+                    )"""
+                )
+                connection.execute(f"CREATE INDEX IF NOT EXISTS ix_{self.table_name}_state ON {self.table_name} (plan, state, id)")
+
+    def plan(self, name: str, regions: Optional[List[str]] = None, statuses: Optional[List[str]] = None, pages: int = 5) -> int:
+        """
+        Adds the items of a plan, returns how many are new. Planning again is harmless: the known urls keep their state.
+        """
+
+        items = [(name, *item) for item in plan_items(regions, statuses, pages)]
+
+        with self._pool.writer() as connection:
+            with connection:
+                cursor = connection.executemany(
+                    f"INSERT OR IGNORE INTO {self.table_name} (plan, region, status, page, url) VALUES (?, ?, ?, ?, ?)", items
+                )
+
+        return cursor.rowcount
+
+    def lease(self, plan: str, worker: str, lease_seconds: float, limit: int = 1) -> List[Dict[str, Any]]:
+        """
+        Leases up to `limit` pending or expired items, a single UPDATE so that two workers never get the same item.
+        """
+
+        now = time.time()
+
+        with self._pool.writer() as connection:
+            with connection:
+                # Expired leases out of attempts will not be retried
+                connection.execute(
+                    f"UPDATE {self.table_name} SET state = 'failed', updated_at = ? WHERE plan = ? AND state = 'leased' AND lease_expires < ? AND attempts >= ?",
+                    (now, plan, now, self.max_attempts)
+                )
+                rows = connection.execute(
+                    f"""UPDATE {self.table_name} SET state = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1, updated_at = ?
+                    WHERE id IN (
+                        SELECT id FROM {self.table_name} WHERE plan = ? AND (state = 'pending' OR (state = 'leased' AND lease_expires < ?))
+                        ORDER BY id LIMIT ?
+                    )
+                    RETURNING id, region, status, page, url, attempts""",
+                    (worker, now + lease_seconds, now, plan, now, limit)
+                ).fetchall()
+
+        return [dict(zip(("id", "region", "status", "page", "url", "attempts"), row)) for row in rows]
+
+    def heartbeat(self, item_id: int, worker: str, lease_seconds: float) -> bool:
+        """
+        Extends the lease, returns False when the item is no longer leased by `worker`.
+        """
+
+        with self._pool.writer() as connection:
+            with connection:
+                cursor = connection.execute(
+                    f"UPDATE {self.table_name} SET lease_expires = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+                    (time.time() + lease_seconds, item_id, worker)
+                )
+
+        return cursor.rowcount > 0
+
+    def complete(self, item: Dict[str, Any], worker: str, stats: Dict[str, int]):
+
+        now = time.time()
+
+        with self._pool.writer() as connection:
+            with connection:
+                connection.execute(
+                    f"""UPDATE {self.table_name} SET state = 'done', lease_expires = NULL, error = NULL, updated_at = ?,
+                    {', '.join(f'{c} = ?' for c in self.COUNTERS)} WHERE id = ? AND worker = ?""",
+                    (now, *(stats.get(c, 0) for c in self.COUNTERS), item["id"], worker)
+                )
+
+                # A fetched page without listings is past the last page of results: the rest of the shard is empty too
+                if stats.get("pages", 0) == 1 and stats.get("documents", 0) == 0:
+                    connection.execute(
+                        f"""UPDATE {self.table_name} SET state = 'skipped', updated_at = ?
+                        WHERE plan = (SELECT plan FROM {self.table_name} WHERE id = ?) AND region = ? AND status = ? AND page > ? AND state = 'pending'""",
+                        (now, item["id"], item["region"], item["status"], item["page"])
+                    )
+
+    def fail(self, item: Dict[str, Any], worker: str, error: str):
+        """
+        The item goes back to the queue until it runs out of attempts.
+        """
+
+        with self._pool.writer() as connection:
+            with connection:
+                connection.execute(
+                    f"""UPDATE {self.table_name} SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                    lease_expires = NULL, error = ?, updated_at = ? WHERE id = ? AND worker = ?""",
+                    (self.max_attempts, error, time.time(), item["id"], worker)
+                )
+
+    def retry_failed(self, plan: str) -> int:
+
+        with self._pool.writer() as connection:
+            with connection:
+                cursor = connection.execute(
+                    f"UPDATE {self.table_name} SET state = 'pending', attempts = 0, error = NULL, updated_at = ? WHERE plan = ? AND state = 'failed'",
+                    (time.time(), plan)
+                )
+
+        return cursor.rowcount
+
+    def report(self, plan: str) -> Optional[Dict[str, Any]]:
+
+        connection = self._pool.reader()
+        rows = connection.execute(
+            f"SELECT state, COUNT(*), {', '.join(f'SUM({c})' for c in self.COUNTERS)} FROM {self.table_name} WHERE plan = ? GROUP BY state",
+            (plan,)
+        ).fetchall()
+
+        if not rows:
+            return None
+
+        states = {state: count for state, count, *_ in rows}
+        totals = [sum(row[2 + i] for row in rows) for i in range(len(self.COUNTERS))]
+        workers = connection.execute(
+            f"SELECT DISTINCT worker FROM {self.table_name} WHERE plan = ? AND state = 'leased' AND lease_expires >= ?", (plan, time.time())
+        ).fetchall()
+
+        return {
+            "plan": plan,
+            "items": sum(states.values()),
+            **{state: states.get(state, 0) for state in ("pending", "leased", "done", "skipped", "failed")},
+            **dict(zip(self.COUNTERS, totals)),
+            "active_workers": [row[0] for row in workers]
+        }
+
+
+class CrawlWorker:
+    """
+    Crawls the items of a plan one page at a time until the queue is empty.
+    A heartbeat thread keeps the lease of the current page alive, the crawl of the page is stopped
+    if the lease is lost (e.g. the process was suspended and another worker took the page).
+    """
+
+    def __init__(
+        self, queue: CrawlQueue, pipeline_factory: Callable[[], Any], plan: str, table_name: str, table_schema: Dict[str, str],
+        table_indexes: Optional[List[List[str]]] = None, worker_id: Optional[str] = None, lease_seconds: float = 120, heartbeat_interval: float = 30
+    ) -> None:
+
+        self.queue = queue
+        self.pipeline_factory = pipeline_factory
+        self.plan = plan
+        self.table_name = table_name
+        self.table_schema = table_schema
+        self.table_indexes = table_indexes
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self.heartbeat_interval = heartbeat_interval
+
+        self._stopping = threading.Event()
+
+    def stop(self):
+
+        self._stopping.set()
+
+    def _heartbeat(self, item: Dict[str, Any], done: threading.Event, lost: threading.Event):
+
+        while not done.wait(self.heartbeat_interval):
+            if not self.queue.heartbeat(item["id"], self.worker_id, self.lease_seconds):
+                logging.warning(f"Lease of {item['url']} lost by {self.worker_id}")
+                lost.set()
+                return
+
+    def run(self) -> Dict[str, int]:
+
+        pipeline = self.pipeline_factory()
+        totals = {"pages": 0, "failed": 0, **{c: 0 for c in CrawlQueue.COUNTERS}}
+
+        try:
+            while not self._stopping.is_set():
+
+                items = self.queue.lease(self.plan, self.worker_id, self.lease_seconds)
+
+                if not items:
+                    break
+
+                item = items[0]
+                done, lost = threading.Event(), threading.Event()
+                heartbeat = threading.Thread(target=self._heartbeat, args=(item, done, lost), name="crawl-heartbeat", daemon=True)
+                heartbeat.start()
+
+                try:
+                    stats = pipeline.run_streaming(
+                        urls=[item["url"]], table_name=self.table_name, table_schema=self.table_schema,
+                        table_indexes=self.table_indexes, create_table=True,
+                        should_stop=lambda: self._stopping.is_set() or lost.is_set()
+                    )
+                except Exception as e:
+                    logging.exception(f"Crawl of {item['url']} failed")
+                    self.queue.fail(item, self.worker_id, str(e))
+                    totals["failed"] += 1
+                    continue
+                finally:
+                    done.set()
+                    heartbeat.join()
+
+                # A stopped page is left to expire and will be crawled again
+                if stats["stopped"] or lost.is_set():
+                    continue
+
+                # Fetch errors are logged and the page is left out of the crawl, retry it later
+                if stats["pages"] != 1:
+                    self.queue.fail(item, self.worker_id, f"Could not fetch {item['url']}")
+                    totals["failed"] += 1
+                    continue
+
+                self.queue.complete(item, self.worker_id, stats)
+                totals["pages"] += 1
+                for c in CrawlQueue.COUNTERS:
+                    totals[c] += stats[c]
+
+        finally:
+            pipeline.close()
+
+        logging.info(f"Crawl worker {self.worker_id} done: {totals}")
+
+        return totals
+
+
+def _work(
+    pipeline_factory: Callable[[], Any], plan: str, dbname: str, table_name: str, table_schema: Dict[str, str],
+    table_indexes: Optional[List[List[str]]], lease_seconds: float, heartbeat_interval: float
+):
+    """
+    Entry point of the worker processes, `pipeline_factory` must be picklable (a module level function).
+    """
+
+    worker = CrawlWorker(
+        CrawlQueue(dbname=dbname), pipeline_factory, plan, table_name=table_name, table_schema=table_schema,
+        table_indexes=table_indexes, lease_seconds=lease_seconds, heartbeat_interval=heartbeat_interval
+    )
+
+    return worker.run()
+
+
+def main_cli(pipeline_factory: Callable[[], Any], dbname: str, table_name: str, table_schema: Dict[str, str], table_indexes: Optional[List[List[str]]] = None):
+    """
+        python crawl.py plan national --pages 20
+        python crawl.py work national --processes 4
+        python crawl.py report national
+    """
+
+    parser = argparse.ArgumentParser(description="Sharded crawl of subito.it over regions x statuses x pages", epilog=main_cli.__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["plan", "work", "report", "retry-failed"])
+    parser.add_argument("plan", help="Name of the plan")
+    parser.add_argument("--regions", nargs="*", choices=list(REGIONS), help="All the regions by default")
+    parser.add_argument("--statuses", nargs="*", choices=list(REAL_ESTATE_STATUS), help="All the statuses by default")
+    parser.add_argument("--pages", type=int, default=5, help="Result pages per region and status")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--lease-seconds", type=float, default=120)
+    parser.add_argument("--heartbeat-interval", type=float, default=30)
+    args = parser.parse_args()
+
+    queue = CrawlQueue(dbname=dbname)
+
+    match args.command:
+        case "plan":
+            added = queue.plan(args.plan, args.regions, args.statuses, args.pages)
+            print(f"{added} new pages planned")
+        case "retry-failed":
+            print(f"{queue.retry_failed(args.plan)} failed pages queued again")
+        case "work":
+            # Every process opens its own connections, they only share the database files
+            with multiprocessing.get_context("spawn").Pool(args.processes) as pool:
+                results = pool.starmap(
+                    _work, [(pipeline_factory, args.plan, dbname, table_name, table_schema, table_indexes, args.lease_seconds, args.heartbeat_interval)] * args.processes
+                )
+            print(results)
+
+    print(queue.report(args.plan))
@@ -0,0 +1,186 @@
+import sqlite3
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List
+
+
+class ConnectionPool:
+    """
+    Process-wide access to a SQLite database.
+
+    The database runs in WAL mode so that readers never wait for the writer:
+        - every thread gets its own read-only connection (used by SQLQuery)
+        - a single writer connection is shared and serialized by a lock (used by SQLWriter)
+    """
+
+    def __init__(self, dbname: str, cache_size_kb: int = 64000, mmap_size: int = 256 * 1024 * 1024, busy_timeout_ms: int = 5000) -> None:
+
+        self._dbname = dbname
+        self._pragmas = [
+            f"PRAGMA cache_size = -{cache_size_kb}",
+            f"PRAGMA mmap_size = {mmap_size}",
+            f"PRAGMA busy_timeout = {busy_timeout_ms}",
+            "PRAGMA temp_store = MEMORY"
+        ]
+
+        self._writer_lock = threading.RLock()
+        self._local = threading.local()
+        self._readers = []
+        self._readers_lock = threading.Lock()
+
+        # The writer is opened first: it creates the file and switches it to WAL,
+        # which is persistent so the read-only connections inherit it
+        self._writer = sqlite3.connect(self._dbname, check_same_thread=False)
+        self._writer.execute("PRAGMA journal_mode = WAL")
+        self._writer.execute("PRAGMA synchronous = NORMAL")
+        for pragma in self._pragmas:
+            self._writer.execute(pragma)
+
+    @contextmanager
+    def writer(self) -> Iterator[sqlite3.Connection]:
+        """
+        Gives exclusive access to the writer connection.
+        """
+
+        with self._writer_lock:
+            yield self._writer
+
+    def reader(self) -> sqlite3.Connection:
+        """
+        Returns the read-only connection of the calling thread.
+        """
+
+        connection = getattr(self._local, "connection", None)
+
+        if connection is None:
+            uri = f"{Path(self._dbname).resolve().as_uri()}?mode=ro"
+            # Only the owning thread uses it, the flag allows `close` to run from any thread
+            connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            for pragma in self._pragmas:
+                connection.execute(pragma)
+            connection.execute("PRAGMA query_only = ON")
+
+            self._local.connection = connection
+            with self._readers_lock:
+                self._readers.append(connection)
+
+        return connection
+
+    def close(self):
+
+        with self._readers_lock:
+            for connection in self._readers:
+                connection.close()
+            self._readers = []
+
+        with self._writer_lock:
+            self._writer.close()
+
+
+_POOLS: Dict[str, ConnectionPool] = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def get_pool(dbname: str) -> ConnectionPool:
+    """
+    Returns the pool of `dbname`, creating it on first use.
+    """
+
+    key = str(Path(dbname).resolve())
+
+    with _POOLS_LOCK:
+        if key not in _POOLS:
+            _POOLS[key] = ConnectionPool(dbname)
+
+        return _POOLS[key]
+
+
+def close_pools():
+
+    with _POOLS_LOCK:
+        for pool in _POOLS.values():
+            pool.close()
+        _POOLS.clear()
+
+
+GENERATION_TABLE = "index_generation"
+
+
+def full_text_table(table_name: str) -> str:
+    """
+    Name of the FTS5 index of a table.
+    """
+
+    return f"{table_name}_fts"
+
+
+def bump_generation(connection: sqlite3.Connection):
+    """
+    Increments the counter of index writes, must be called inside the writing transaction.
+    """
+
+    connection.execute(f"CREATE TABLE IF NOT EXISTS {GENERATION_TABLE} (id INTEGER PRIMARY KEY CHECK (id = 0), generation INTEGER NOT NULL)")
+    connection.execute(
+        f"INSERT INTO {GENERATION_TABLE} (id, generation) VALUES (0, 1) ON CONFLICT(id) DO UPDATE SET generation = generation + 1"
+    )
+
+
+def read_generation(connection: sqlite3.Connection) -> int:
+    """
+    Returns the counter of index writes, 0 if nothing was ever written.
+    """
+
+    try:
+        res = connection.execute(f"SELECT generation FROM {GENERATION_TABLE} WHERE id = 0").fetchone()
+    except sqlite3.OperationalError:
+        return 0
+
+    return res[0] if res else 0
+
+
+def indexed_columns(connection: sqlite3.Connection, table_name: str) -> List[str]:
+    """
+    Returns the sorted columns covered by an index of the table.
+    """
+
+    columns = set()
+
+    for index in connection.execute(f"PRAGMA index_list({table_name})").fetchall():
+        for info in connection.execute(f"PRAGMA index_info({index[1]})"):
+            columns.add(info[2])
+
+    return sorted(columns)
+
+
+def select_in(connection: sqlite3.Connection, table_name: str, columns: List[str], key_column: str, keys: List[Any], chunk_size: int = 500) -> List[tuple]:
+    """
+    Returns the `columns` of the rows whose `key_column` is one of `keys`.
+    """
+
+    rows = []
+
+    # Stay below the SQLite limit of host parameters
+    for start in range(0, len(keys), chunk_size):
+        chunk = keys[start:start + chunk_size]
+        rows.extend(connection.execute(
+            f"SELECT {', '.join(columns)} FROM {table_name} WHERE {key_column} IN ({', '.join(['?'] * len(chunk))})", chunk
+        ).fetchall())
+
+    return rows
+
+
+def frequent_values(connection: sqlite3.Connection, table_name: str, column: str, limit: int) -> List[Any]:
+    """
+    Returns the `limit` most frequent values of a column, empty if the table doesn't exist yet.
+    """
+
+    try:
+        rows = connection.execute(
+            f"SELECT {column} FROM {table_name} WHERE {column} IS NOT NULL GROUP BY {column} ORDER BY COUNT(*) DESC, {column} LIMIT ?",
+            (limit,)
+        ).fetchall()
+    except sqlite3.OperationalError:
+        return []
+
+    return [row[0] for row in rows]
@@ -0,0 +1,209 @@
+import time
+import sqlite3
+from typing import Any, Dict, List, Optional
+
+from internal_lib.database import get_pool, select_in
+
+
+class ListingHistory:
+    """
+    Append-only history of the listings of `table_name`, written by SQLWriter in the transaction of the upsert.
+
+    Only the fields that changed are recorded, one row per (listing, field, time) in a WITHOUT ROWID table
+    clustered by listing, so that storage grows with the number of changes and not with the number of crawls.
+    Rows are integer-coded: listings, field names and text values are stored once in dictionary tables and
+    referenced by id, the integer and boolean columns are stored as they are.
+    Listings found in the table when the history is created are recorded with their current values.
+
+    Times are stored in microseconds and taken from a clock that only moves forward, so two writes of the
+    same listing never share a key: history rows are only ever inserted. The methods take and return seconds.
+    """
+
+    INTEGER_TYPES = ("INTEGER", "BOOL")
+    MICROSECONDS = 1_000_000
+
+    def __init__(self, dbname: str, table_name: str = "real_estates", key_column: str = "link", price_column: str = "price") -> None:
+
+        self.table_name = table_name
+        self.key_column = key_column
+        self.price_column = price_column
+        self._pool = get_pool(dbname)
+
+        self.changes_table = f"{table_name}_history"
+        self.keys_table = f"{table_name}_history_keys"
+        self.fields_table = f"{table_name}_history_fields"
+        self.values_table = f"{table_name}_history_values"
+        self.clock_table = f"{table_name}_history_clock"
+
+    def ensure(self, connection: sqlite3.Connection, table_schema: Dict[str, str]):
+        """
+        Creates the history tables, to be called once the listings table exists.
+        """
+
+        tables = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        created = self.changes_table not in tables
+
+        connection.execute(f"CREATE TABLE IF NOT EXISTS {self.keys_table} (id INTEGER PRIMARY KEY, key TEXT NOT NULL UNIQUE)")
+        connection.execute(f"CREATE TABLE IF NOT EXISTS {self.fields_table} (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, coded BOOL NOT NULL)")
+        connection.execute(f"CREATE TABLE IF NOT EXISTS {self.values_table} (id INTEGER PRIMARY KEY, value TEXT NOT NULL UNIQUE)")
+        connection.execute(
+            f"""CREATE TABLE IF NOT EXISTS {self.changes_table} (
+                listing_id INTEGER NOT NULL, field_id INTEGER NOT NULL, changed_at INTEGER NOT NULL, value INTEGER,
+                PRIMARY KEY (listing_id, field_id, changed_at)
+            ) WITHOUT ROWID"""
+        )
+        # Price drops are looked up by field and time
+        connection.execute(f"CREATE INDEX IF NOT EXISTS ix_{self.changes_table}_field ON {self.changes_table} (field_id, changed_at)")
+
+        connection.execute(f"CREATE TABLE IF NOT EXISTS {self.clock_table} (id INTEGER PRIMARY KEY CHECK (id = 0), last INTEGER NOT NULL)")
+        connection.execute(f"INSERT OR IGNORE INTO {self.clock_table} (id, last) VALUES (0, 0)")
+
+        # Histories recorded before the clock have times in whole seconds
+        if not created and self.clock_table not in tables:
+            connection.execute(f"UPDATE {self.changes_table} SET changed_at = changed_at * {self.MICROSECONDS}")
+            connection.execute(f"UPDATE {self.clock_table} SET last = (SELECT IFNULL(MAX(changed_at), 0) FROM {self.changes_table})")
+
+        connection.executemany(
+            f"INSERT OR IGNORE INTO {self.fields_table} (name, coded) VALUES (?, ?)",
+            [(column, self._coded(column_type)) for column, column_type in table_schema.items() if column != self.key_column]
+        )
+
+        if created:
+            columns = list(table_schema)
+            rows = connection.execute(f"SELECT {', '.join(columns)} FROM {self.table_name}").fetchall()
+            self.record(connection, table_schema, {row[columns.index(self.key_column)]: row for row in rows}, {})
+
+    def _coded(self, column_type: str) -> bool:
+
+        return not column_type.upper().startswith(self.INTEGER_TYPES)
+
+    def _ids(self, connection: sqlite3.Connection, table: str, column: str, values: List[Any]) -> Dict[Any, int]:
+        """
+        Ids of `values` in a dictionary table, the missing ones are added.
+        """
+
+        values = list(set(values))
+
+        connection.executemany(f"INSERT OR IGNORE INTO {table} ({column}) VALUES (?)", [(v,) for v in values])
+
+        return dict(select_in(connection, table, [column, "id"], column, values))
+
+    def record(self, connection: sqlite3.Connection, table_schema: Dict[str, str], inserted: Dict[Any, tuple], updated: Dict[Any, tuple], changed_at: Optional[float] = None):
+        """
+        Records the new listings and the changed fields of the updated ones. `inserted` and `updated` map
+        each key to its row (values in the order of `table_schema`), the updated rows are compared with
+        the stored ones, so this must run before the upsert and inside its transaction.
+        """
+
+        columns = list(table_schema)
+        tracked = [(i, column) for i, column in enumerate(columns) if column != self.key_column]
+        changes = []
+
+        for key, row in inserted.items():
+            changes.extend((key, column, row[i]) for i, column in tracked if row[i] is not None)
+
+        for old in select_in(connection, self.table_name, columns, self.key_column, list(updated)):
+            key = old[columns.index(self.key_column)]
+            new = updated[key]
+            changes.extend((key, column, new[i]) for i, column in tracked if new[i] != old[i])
+
+        if not changes:
+            return
+
+        # Later than every recorded change, also when two writes fall in the same microsecond
+        last = connection.execute(f"SELECT last FROM {self.clock_table}").fetchone()[0]
+        changed_at = max(int((changed_at if changed_at is not None else time.time()) * self.MICROSECONDS), last + 1)
+        connection.execute(f"UPDATE {self.clock_table} SET last = ?", (changed_at,))
+
+        field_ids = dict(connection.execute(f"SELECT name, id FROM {self.fields_table}").fetchall())
+        coded = {column for column, column_type in table_schema.items() if self._coded(column_type)}
+        listing_ids = self._ids(connection, self.keys_table, "key", [key for key, _, _ in changes])
+        value_ids = self._ids(connection, self.values_table, "value", [str(v) for _, column, v in changes if column in coded and v is not None])
+
+        def encode(column, value):
+            if value is None:
+                return None
+            if column in coded:
+                return value_ids[str(value)]
+            # Text left in an integer column by old versions (e.g. "85 mq") is recorded as unknown
+            return int(value) if isinstance(value, (int, float)) else None
+
+        connection.executemany(
+            f"INSERT INTO {self.changes_table} (listing_id, field_id, changed_at, value) VALUES (?, ?, ?, ?)",
+            [(listing_ids[key], field_ids[column], changed_at, encode(column, value)) for key, column, value in changes]
+        )
+
+    def _decoded_changes(self, where: str) -> str:
+
+        return f"""SELECT f.name, h.changed_at, CASE WHEN f.coded THEN v.value ELSE h.value END
+            FROM {self.changes_table} h
+            JOIN {self.keys_table} k ON k.id = h.listing_id
+            JOIN {self.fields_table} f ON f.id = h.field_id
+            LEFT JOIN {self.values_table} v ON f.coded AND v.id = h.value
+            WHERE {where}"""
+
+    def changes(self, key: str) -> List[Dict[str, Any]]:
+        """
+        Every recorded change of a listing, oldest first.
+        """
+
+        rows = self._pool.reader().execute(
+            self._decoded_changes("k.key = ?") + " ORDER BY h.changed_at, f.name", (key,)
+        ).fetchall()
+
+        return [{"field": field, "changed_at": changed_at / self.MICROSECONDS, "value": value} for field, changed_at, value in rows]
+
+    def as_of(self, key: str, at: float) -> Optional[Dict[str, Any]]:
+        """
+        Values of a listing at time `at`, None if it was not known yet.
+        """
+
+        # The bare columns of a MAX() aggregate come from the row holding the maximum
+        rows = self._pool.reader().execute(
+            f"""SELECT name, value FROM (
+                SELECT f.name AS name, MAX(h.changed_at), CASE WHEN f.coded THEN v.value ELSE h.value END AS value
+                FROM {self.changes_table} h
+                JOIN {self.keys_table} k ON k.id = h.listing_id
+                JOIN {self.fields_table} f ON f.id = h.field_id
+                LEFT JOIN {self.values_table} v ON f.coded AND v.id = h.value
+                WHERE k.key = ? AND h.changed_at <= ?
+                GROUP BY h.field_id
+            )""",
+            (key, int(at * self.MICROSECONDS))
+        ).fetchall()
+
+        return dict(rows) if rows else None
+
+    def price_drops(self, days: float, limit: int = 50, min_drop_pct: float = 0.0) -> List[Dict[str, Any]]:
+        """
+        Listings whose price went down in the last `days` days, biggest drop (in percent) first.
+        """
+
+        since = int((time.time() - days * 86400) * self.MICROSECONDS)
+
+        rows = self._pool.reader().execute(
+            f"""SELECT k.key, l.content, l.city, prev AS old_price, h.value AS new_price, h.changed_at
+            FROM (
+                SELECT c.listing_id, c.value, c.changed_at, (
+                    SELECT p.value FROM {self.changes_table} p
+                    WHERE p.listing_id = c.listing_id AND p.field_id = c.field_id AND p.changed_at < c.changed_at
+                    ORDER BY p.changed_at DESC LIMIT 1
+                ) AS prev
+                FROM {self.changes_table} c
+                WHERE c.field_id = (SELECT id FROM {self.fields_table} WHERE name = ?) AND c.changed_at >= ?
+            ) h
+            JOIN {self.keys_table} k ON k.id = h.listing_id
+            LEFT JOIN {self.table_name} l ON l.{self.key_column} = k.key
+            WHERE prev > h.value AND 100.0 * (prev - h.value) / prev >= ?
+            ORDER BY 1.0 * (prev - h.value) / prev DESC
+            LIMIT ?""",
+            (self.price_column, since, min_drop_pct, limit)
+        ).fetchall()
+
+        return [
+            {
+                "link": key, "content": content, "city": city, "old_price": old_price, "new_price": new_price,
+                "drop_pct": round(100.0 * (old_price - new_price) / old_price, 2), "changed_at": changed_at / self.MICROSECONDS
+            }
+            for key, content, city, old_price, new_price, changed_at in rows
+        ]
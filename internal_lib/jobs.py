@@ -0,0 +1,337 @@
+import json
+import time
+import uuid
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+from internal_lib.database import get_pool
+
+
+class JobStore:
+    """
+    Index build jobs persisted in SQLite.
+
+    A job crawls a list of urls in chunks: after every chunk `checkpoint` is moved forward so that a
+    cancelled, failed or interrupted job resumes from the first page of the chunk it was working on.
+    Re-crawling those pages is harmless because SQLWriter skips the unchanged listings.
+    Jobs with `incremental` in their params stop at the first page without new or changed listings,
+    `offline` ones re-index the urls from their snapshots.
+    """
+
+    COUNTERS = ("pages", "documents", "rows_written", "inserted", "updated", "unchanged")
+
+    def __init__(self, dbname: str, table_name: str = "index_jobs") -> None:
+
+        self.table_name = table_name
+        self._pool = get_pool(dbname)
+
+        with self._pool.writer() as connection:
+            with connection:
+                connection.execute(
+                    f"""CREATE TABLE IF NOT EXISTS {self.table_name} (
+                        id VARCHAR(32) PRIMARY KEY, status VARCHAR(20) NOT NULL, params TEXT NOT NULL,
+                        checkpoint INTEGER NOT NULL DEFAULT 0, total_pages INTEGER NOT NULL,
+                        {', '.join(f'{c} INTEGER NOT NULL DEFAULT 0' for c in self.COUNTERS)},
+                        error TEXT, created_at REAL NOT NULL, started_at REAL, updated_at REAL, finished_at REAL,
+                        elapsed REAL NOT NULL DEFAULT 0
+                    )"""
+                )
+                connection.execute(f"CREATE INDEX IF NOT EXISTS ix_{self.table_name}_status ON {self.table_name} (status, created_at)")
+
+    def _update(self, job_id: str, **fields):
+
+        fields["updated_at"] = time.time()
+
+        with self._pool.writer() as connection:
+            with connection:
+                connection.execute(
+                    f"UPDATE {self.table_name} SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?",
+                    [*fields.values(), job_id]
+                )
+
+    def create(self, params: Dict[str, Any]) -> str:
+
+        job_id = uuid.uuid4().hex
+
+        with self._pool.writer() as connection:
+            with connection:
+                connection.execute(
+                    f"INSERT INTO {self.table_name} (id, status, params, total_pages, created_at) VALUES (?, 'queued', ?, ?, ?)",
+                    (job_id, json.dumps(params), len(params["urls"]), time.time())
+                )
+
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+
+        connection = self._pool.reader()
+        cursor = connection.execute(f"SELECT * FROM {self.table_name} WHERE id = ?", (job_id,))
+        row = cursor.fetchone()
+
+        if row is None:
+            return None
+
+        job = dict(zip([column[0] for column in cursor.description], row))
+        job["params"] = json.loads(job["params"])
+
+        return job
+
+    def status(self, job_id: str) -> Optional[str]:
+
+        row = self._pool.reader().execute(f"SELECT status FROM {self.table_name} WHERE id = ?", (job_id,)).fetchone()
+
+        return row[0] if row else None
+
+    def active_count(self) -> int:
+
+        return self._pool.reader().execute(
+            f"SELECT COUNT(*) FROM {self.table_name} WHERE status IN ('queued', 'running', 'cancelling')"
+        ).fetchone()[0]
+
+    def next_queued(self) -> Optional[Dict[str, Any]]:
+
+        row = self._pool.reader().execute(
+            f"SELECT id FROM {self.table_name} WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+        ).fetchone()
+
+        return self.get(row[0]) if row else None
+
+    def start(self, job_id: str) -> bool:
+        """
+        Marks a queued job as running, False if it is no longer queued (e.g. cancelled in the meantime).
+        """
+
+        with self._pool.writer() as connection:
+            with connection:
+                cursor = connection.execute(
+                    f"UPDATE {self.table_name} SET status = 'running', error = NULL, updated_at = ? WHERE id = ? AND status = 'queued'",
+                    (time.time(), job_id)
+                )
+
+        return cursor.rowcount > 0
+
+    def progress(self, job_id: str, stats: Dict[str, int], elapsed: float, checkpoint: Optional[int] = None):
+
+        fields = {name: stats[name] for name in self.COUNTERS}
+        fields["elapsed"] = elapsed
+
+        if checkpoint is not None:
+            fields["checkpoint"] = checkpoint
+
+        self._update(job_id, **fields)
+
+    def finish(self, job_id: str, status: str, error: Optional[str] = None):
+
+        self._update(job_id, status=status, error=error, finished_at=time.time())
+
+    def requeue(self, job_id: str):
+
+        self._update(job_id, status="queued")
+
+    def request_cancel(self, job_id: str) -> bool:
+        """
+        Queued jobs are cancelled at once, running ones at the end of the page being processed.
+        """
+
+        with self._pool.writer() as connection:
+            with connection:
+                cursor = connection.execute(
+                    f"""UPDATE {self.table_name} SET status = CASE status WHEN 'running' THEN 'cancelling' ELSE 'cancelled' END,
+                    updated_at = ? WHERE id = ? AND status IN ('queued', 'running')""",
+                    (time.time(), job_id)
+                )
+
+        return cursor.rowcount > 0
+
+    def resume(self, job_id: str) -> bool:
+
+        with self._pool.writer() as connection:
+            with connection:
+                cursor = connection.execute(
+                    f"UPDATE {self.table_name} SET status = 'queued', finished_at = NULL, updated_at = ? WHERE id = ? AND status IN ('cancelled', 'failed')",
+                    (time.time(), job_id)
+                )
+
+        return cursor.rowcount > 0
+
+    def requeue_interrupted(self):
+        """
+        Jobs left running by a previous process are queued again and resume from their checkpoint.
+        """
+
+        with self._pool.writer() as connection:
+            with connection:
+                connection.execute(f"UPDATE {self.table_name} SET status = 'queued' WHERE status IN ('running', 'cancelling')")
+
+
+class IndexJobRunner:
+    """
+    Runs the index build jobs one at a time on a background thread, so that there is never
+    more than one crawl writing to the database and searches are not starved.
+    """
+
+    def __init__(self, store: JobStore, pipeline_factory: Callable[[], Any], table_name: str, table_schema: Dict[str, str], table_indexes: Optional[List[List[str]]] = None, chunk_size: int = 20, poll_interval: float = 1.0, on_done: Optional[Callable[[str], None]] = None) -> None:
+
+        self.store = store
+        self.pipeline_factory = pipeline_factory
+        self.table_name = table_name
+        self.table_schema = table_schema
+        self.table_indexes = table_indexes
+        self.chunk_size = chunk_size
+        self.poll_interval = poll_interval
+        # Called with the job id once a job is done, e.g. to rebuild what derives from the index
+        self.on_done = on_done
+
+        self._wake_up = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+
+        self.store.requeue_interrupted()
+
+        self._thread = threading.Thread(target=self._loop, name="index-job-runner", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+
+        self._stopping.set()
+        self._wake_up.set()
+
+        if self._thread is not None:
+            self._thread.join()
+
+    def submit(self, params: Dict[str, Any]) -> str:
+
+        job_id = self.store.create(params)
+        self._wake_up.set()
+
+        return job_id
+
+    def resume(self, job_id: str) -> bool:
+
+        resumed = self.store.resume(job_id)
+        self._wake_up.set()
+
+        return resumed
+
+    def _loop(self):
+
+        while not self._stopping.is_set():
+
+            job = self.store.next_queued()
+
+            if job is None:
+                self._wake_up.wait(self.poll_interval)
+                self._wake_up.clear()
+                continue
+
+            try:
+                self._run(job)
+            except Exception as e:
+                logging.exception(f"Index job {job['id']} failed")
+                self.store.finish(job["id"], "failed", error=str(e))
+
+    def _should_stop(self, job_id: str) -> bool:
+
+        return self._stopping.is_set() or self.store.status(job_id) == "cancelling"
+
+    def _run(self, job: Dict[str, Any]):
+
+        job_id = job["id"]
+        urls = job["params"]["urls"]
+
+        if not self.store.start(job_id):
+            logging.info(f"Index job {job_id} was cancelled before it started")
+            return
+
+        logging.info(f"Index job {job_id} started from page {job['checkpoint']}/{len(urls)}")
+
+        pipeline = self.pipeline_factory()
+
+        try:
+            checkpoint = self._crawl(job, pipeline)
+        finally:
+            pipeline.close()
+
+        if checkpoint >= len(urls):
+            self.store.finish(job_id, "done")
+            if self.on_done is not None:
+                self.on_done(job_id)
+        elif self.store.status(job_id) == "cancelling":
+            self.store.finish(job_id, "cancelled")
+        else:
+            # The app is shutting down: the job will resume at the next start
+            self.store.requeue(job_id)
+
+        logging.info(f"Index job {job_id} ended at page {checkpoint}/{len(urls)}")
+
+    def _crawl(self, job: Dict[str, Any], pipeline: Any) -> int:
+        """
+        Crawls the pages of the job from its checkpoint, returns the new checkpoint.
+        """
+
+        job_id = job["id"]
+        urls = job["params"]["urls"]
+        checkpoint = job["checkpoint"]
+
+        # Counters continue from the previous runs of the job
+        totals = {name: job[name] for name in JobStore.COUNTERS}
+        elapsed = job["elapsed"]
+
+        # Incremental crawls stop by themselves at the first unchanged page, they run as a single chunk
+        incremental = job["params"].get("incremental", False)
+
+        if incremental:
+            crawl = pipeline.run_incremental
+        elif job["params"].get("offline", False):
+            crawl = pipeline.run_offline
+        else:
+            crawl = pipeline.run_streaming
+
+        while checkpoint < len(urls):
+
+            chunk = urls[checkpoint:] if incremental else urls[checkpoint:checkpoint + self.chunk_size]
+            started = time.monotonic()
+
+            def on_progress(stats):
+                self.store.progress(job_id, {k: totals[k] + stats[k] for k in totals}, elapsed + time.monotonic() - started)
+
+            stats = crawl(
+                urls=chunk, table_name=self.table_name, table_schema=self.table_schema,
+                table_indexes=self.table_indexes, create_table=True,
+                should_stop=lambda: self._should_stop(job_id), on_progress=on_progress
+            )
+
+            totals = {k: totals[k] + stats[k] for k in totals}
+            elapsed += time.monotonic() - started
+
+            if stats["stopped"]:
+                self.store.progress(job_id, totals, elapsed)
+                break
+
+            checkpoint += len(chunk)
+            self.store.progress(job_id, totals, elapsed, checkpoint=checkpoint)
+
+        return checkpoint
+
+
+def job_report(job: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Public view of a job with its throughput.
+    """
+
+    elapsed = job["elapsed"] or 0.0
+
+    return {
+        "id": job["id"],
+        "status": job["status"],
+        "checkpoint": job["checkpoint"],
+        "total_pages": job["total_pages"],
+        **{name: job[name] for name in JobStore.COUNTERS},
+        "elapsed_seconds": round(elapsed, 3),
+        "pages_per_second": round(job["pages"] / elapsed, 3) if elapsed else 0.0,
+        "listings_per_second": round(job["documents"] / elapsed, 3) if elapsed else 0.0,
+        "error": job["error"]
+    }
@@ -5,6 +5,17 @@ FLOOR_MAP = {
 }
 
 
+# Sortable code of the floor, numeric floors are stored as they are.
+# "Piano" is what is left of "Piano terra" after the parser keeps the first word.
+FLOOR_CODES = {
+    "Piano interrato": -2,
+    "Piano seminterrato": -1,
+    "Piano terra": 0,
+    "Piano": 0,
+    "Piano rialzato": 0
+}
+
+
 REAL_ESTATE_STATUS = {
     "nuove-costruzioni": "Nuova costruzione",
     "bc=20": "Ottimo",
@@ -121,4 +132,53 @@ PROVINCE_MAP = {
     "VV": "Vibo valentia",
     "VI": "Vicenza",
     "VT": "Viterbo"
-  }
\ No newline at end of file
+  }
+
+# Regions as they are named in the subito.it urls, with the codes of their provinces
+REGIONS = {
+    "abruzzo": ["AQ", "CH", "PE", "TE"],
+    "basilicata": ["MT", "PZ"],
+    "calabria": ["CS", "CZ", "KR", "RC", "VV"],
+    "campania": ["AV", "BN", "CE", "NA", "SA"],
+    "emilia-romagna": ["BO", "FC", "FE", "MO", "PC", "PR", "RA", "RE", "RN"],
+    "friuli-venezia-giulia": ["GO", "PN", "TS", "UD"],
+    "lazio": ["FR", "LT", "RI", "RM", "VT"],
+    "liguria": ["GE", "IM", "SP", "SV"],
+    "lombardia": ["BG", "BS", "CO", "CR", "LC", "LO", "MB", "MI", "MN", "PV", "SO", "VA"],
+    "marche": ["AN", "AP", "FM", "MC", "PU"],
+    "molise": ["CB", "IS"],
+    "piemonte": ["AL", "AT", "BI", "CN", "NO", "TO", "VB", "VC"],
+    "puglia": ["BA", "BR", "BT", "FG", "LE", "TA"],
+    "sardegna": ["CA", "NU", "OR", "SS", "SU"],
+    "sicilia": ["AG", "CL", "CT", "EN", "ME", "PA", "RG", "SR", "TP"],
+    "toscana": ["AR", "FI", "GR", "LI", "LU", "MS", "PI", "PO", "PT", "SI"],
+    "trentino-alto-adige": ["BZ", "TN"],
+    "umbria": ["PG", "TR"],
+    "valle-d-aosta": ["AO"],
+    "veneto": ["BL", "PD", "RO", "TV", "VE", "VI", "VR"]
+}
+
+
+# Italian lexicon used by the rule based query parser
+
+ROOMS_MAP = {
+    "monolocale": 1,
+    "monolocali": 1,
+    "bilocale": 2,
+    "bilocali": 2,
+    "trilocale": 3,
+    "trilocali": 3,
+    "quadrilocale": 4,
+    "quadrilocali": 4,
+    "pentalocale": 5,
+    "pentalocali": 5
+}
+
+
+QUERY_STOPWORDS = {
+    "casa", "case", "appartamento", "appartamenti", "immobile", "immobili", "abitazione", "abitazioni",
+    "cerco", "cerca", "voglio", "trova", "trovami", "mostrami", "elenca", "vorrei", "ci", "sono", "quali",
+    "un", "uno", "una", "il", "lo", "la", "i", "gli", "le", "l", "di", "del", "della", "dei", "delle",
+    "a", "ad", "al", "alla", "in", "nel", "nella", "con", "e", "ed", "o", "per", "da", "che",
+    "vendita", "comune", "città", "zona", "euro", "€", "prezzo", "costo", "annunci", "annuncio"
+}
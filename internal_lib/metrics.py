@@ -0,0 +1,115 @@
+import time
+import logging
+import sqlite3
+import contextlib
+from typing import Any, Dict, Iterator, List, Optional
+
+from haystack import tracing
+from haystack.tracing import Span, Tracer
+from prometheus_client import Counter, Histogram
+
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+PIPELINE_SECONDS = Histogram("house_finder_pipeline_seconds", "Duration of the pipeline runs", ["pipeline"], buckets=LATENCY_BUCKETS)
+COMPONENT_SECONDS = Histogram("house_finder_component_seconds", "Duration of the component runs", ["component"], buckets=LATENCY_BUCKETS)
+
+PAGES = Counter("house_finder_pages", "Listing pages indexed")
+CARDS = Counter("house_finder_cards", "Listing cards parsed")
+PARSE_FALLBACKS = Counter("house_finder_parse_fallbacks", "Fields of the cards that could not be parsed", ["field"])
+ROWS = Counter("house_finder_rows", "Rows seen by SQLWriter by outcome", ["outcome"])
+CACHE_REQUESTS = Counter("house_finder_cache_requests", "Query cache lookups", ["kind", "result"])
+
+
+class TimingSpan(Span):
+
+    def __init__(self) -> None:
+
+        self.tags: Dict[str, Any] = {}
+
+    def set_tag(self, key: str, value: Any) -> None:
+
+        self.tags[key] = value
+
+
+class PrometheusTracer(Tracer):
+    """
+    Haystack tracer recording the duration of every pipeline and component run in the Prometheus histograms.
+    The spans are forwarded to `inner` (e.g. an OpenTelemetry tracer) when there is one.
+    """
+
+    def __init__(self, inner: Optional[Tracer] = None) -> None:
+
+        self.inner = inner
+
+    @contextlib.contextmanager
+    def trace(self, operation_name: str, tags: Optional[Dict[str, Any]] = None, parent_span: Optional[Span] = None) -> Iterator[Span]:
+
+        tags = tags or {}
+        started = time.perf_counter()
+
+        try:
+            if self.inner is not None:
+                with self.inner.trace(operation_name, tags, parent_span) as span:
+                    yield span
+            else:
+                span = TimingSpan()
+                span.set_tags(tags)
+                yield span
+        finally:
+            elapsed = time.perf_counter() - started
+
+            if operation_name == "haystack.component.run":
+                COMPONENT_SECONDS.labels(component=tags.get("haystack.component.name", "unknown")).observe(elapsed)
+            elif operation_name == "haystack.pipeline.run":
+                metadata = tags.get("haystack.pipeline.metadata") or {}
+                PIPELINE_SECONDS.labels(pipeline=metadata.get("name", "unknown")).observe(elapsed)
+
+    def current_span(self) -> Optional[Span]:
+
+        return self.inner.current_span() if self.inner is not None else None
+
+
+def enable_metrics():
+    """
+    Installs the PrometheusTracer in front of the tracer already configured, if any.
+    """
+
+    if isinstance(tracing.tracer.actual_tracer, PrometheusTracer):
+        return
+
+    inner = tracing.tracer.actual_tracer if tracing.is_tracing_enabled() else None
+    tracing.enable_tracing(PrometheusTracer(inner))
+
+
+@contextlib.contextmanager
+def timed(component: str) -> Iterator[None]:
+    """
+    Times a component called outside of `Pipeline.run` (e.g. by the streaming index builds).
+    """
+
+    started = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        COMPONENT_SECONDS.labels(component=component).observe(time.perf_counter() - started)
+
+
+def log_slow_request(connection: sqlite3.Connection, question: str, sql: str, executed_sql: Optional[str], parameters: List[Any], elapsed: float):
+    """
+    Logs a slow search with its SQL and the query plan of the SQL actually executed (after the full text
+    rewrite and the LIMIT of the execution guard). `executed_sql` is None when the results came from the cache.
+    """
+
+    if executed_sql is None:
+        plan = ["not executed, results from the cache"]
+    else:
+        try:
+            plan = [row[-1] for row in connection.execute(f"EXPLAIN QUERY PLAN {executed_sql}", parameters or [])]
+        except sqlite3.Error as e:
+            plan = [f"unavailable: {e}"]
+
+    executed = f"\n    Executed: {executed_sql}" if executed_sql is not None and executed_sql != sql else ""
+
+    logging.warning(f"Slow search ({elapsed:.3f}s): {question!r}\n    SQL: {sql} {parameters}{executed}\n    Plan: {' | '.join(plan)}")
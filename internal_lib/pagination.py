@@ -0,0 +1,87 @@
+import os
+import hmac
+import json
+import base64
+import hashlib
+import secrets
+from typing import Any, Dict, List, Optional, Tuple
+
+
+# Cursors carry SQL that will be executed again, they are signed so that clients can't forge them.
+# Without CURSOR_SECRET the cursors are valid until the process restarts.
+_SECRET = os.getenv("CURSOR_SECRET", "").encode() or secrets.token_bytes(32)
+
+# Sort keys available for pagination, NULL values go last. `link` is unique and breaks ties.
+ORDER_KEYS = {
+    "link": "link",
+    "price": "IFNULL(price, 9223372036854775807)",
+    "mq": "IFNULL(mq, 9223372036854775807)",
+    "n_rooms": "IFNULL(n_rooms, 9223372036854775807)"
+}
+
+
+class InvalidCursorError(Exception):
+    """
+    Raised when a cursor was not issued by this server or is malformed.
+    """
+
+
+def encode_cursor(state: Dict[str, Any]) -> str:
+
+    payload = json.dumps(state, separators=(",", ":")).encode()
+    signature = hmac.new(_SECRET, payload, hashlib.sha256).digest()[:16]
+
+    return base64.urlsafe_b64encode(signature + payload).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Dict[str, Any]:
+
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+    except ValueError as e:
+        raise InvalidCursorError("Malformed cursor") from e
+
+    signature, payload = raw[:16], raw[16:]
+
+    if not hmac.compare_digest(signature, hmac.new(_SECRET, payload, hashlib.sha256).digest()[:16]):
+        raise InvalidCursorError("Invalid cursor signature")
+
+    return json.loads(payload)
+
+
+def page_query(sql: str, parameters: List[Any], order_by: str, page_size: int, last: Optional[List[Any]] = None) -> Tuple[str, List[Any]]:
+    """
+    Wraps the generated SQL into a keyset paginated query: rows are sorted by `order_by` and `link`,
+    the page starts right after `last` ([sort value, link] of the previous page).
+    """
+
+    if order_by not in ORDER_KEYS:
+        raise ValueError(f"Unsupported sort key: {order_by}")
+
+    key = ORDER_KEYS[order_by]
+    sort = "link" if order_by == "link" else f"{key}, link"
+
+    query = f"SELECT * FROM ({sql.strip().rstrip(';')})"
+    parameters = list(parameters)
+
+    if last is not None:
+        if order_by == "link":
+            query += " WHERE link > ?"
+            parameters.append(last[1])
+        else:
+            query += f" WHERE ({key}, link) > (?, ?)"
+            parameters.extend(last)
+
+    query += f" ORDER BY {sort} LIMIT {page_size}"
+
+    return query, parameters
+
+
+def sort_value(row: Dict[str, Any], order_by: str) -> Any:
+
+    if order_by == "link":
+        return row["link"]
+
+    value = row.get(order_by)
+
+    return 9223372036854775807 if value is None else value
@@ -1,10 +1,14 @@
 import os
+import time
 import logging
+import sqlite3
+import threading
 from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
 from haystack import Pipeline
 from haystack.utils import Secret
-from haystack.dataclasses import ChatMessage
+from haystack.dataclasses import ByteStream, ChatMessage
 from haystack.components.writers import DocumentWriter
 from haystack.document_stores.types import DuplicatePolicy
 from haystack_integrations.document_stores.chroma import ChromaDocumentStore
@@ -20,13 +24,17 @@ from haystack.components.readers import ExtractiveReader
 
 from haystack.components.converters import PyPDFToDocument, TextFileToDocument
 from haystack.components.routers import FileTypeRouter
-from haystack.components.joiners import DocumentJoiner
+from haystack.components.joiners import DocumentJoiner, BranchJoiner
 from haystack.components.preprocessors import DocumentSplitter, DocumentCleaner
 from haystack.components.fetchers import LinkContentFetcher
 
-from internal_lib.components import SubitoItParser, SQLQueryParser, SQLValidator, SQLQuery
-from internal_lib.prompts import sql_prompt
+from internal_lib.components import SubitoItParser, SQLQueryParser, SQLValidator, SQLQuery, AsyncLinkContentFetcher, ListingNormalizer, RuleBasedQueryParser, GenerationGateway, SQL_STOP_SEQUENCES
+from internal_lib.prompts import sql_prompt, sql_question_prompt, build_sql_prompt
 from internal_lib.schema import GeneratorConfig
+from internal_lib.cache import QueryCache
+from internal_lib.database import get_pool, read_generation, indexed_columns, frequent_values
+from internal_lib.pagination import decode_cursor, encode_cursor, page_query, sort_value
+from internal_lib.metrics import PAGES, log_slow_request
 
 from haystack_integrations.components.generators.mistral import MistralChatGenerator
 
@@ -109,28 +117,248 @@ class SubitoScraperPipeline(Pipeline):
         
 
         def __init__(self, document_store, **kwargs):
-            super().__init__()
+            super().__init__(metadata={"name": "index"})
             """
             
             """
 
-            fetcher = LinkContentFetcher(user_agents=["Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/89.0.142.86 Safari/537.36"])
-            converter = SubitoItParser()
+            fetcher = AsyncLinkContentFetcher(
+                user_agents=["Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/89.0.142.86 Safari/537.36"],
+                max_concurrency=kwargs.get("max_concurrency", 8),
+                requests_per_second=kwargs.get("requests_per_second", 2.0),
+                retry_attempts=kwargs.get("retry_attempts", 3),
+                transport=kwargs.get("transport"),
+                validator_store=kwargs.get("validator_store")
+            )
+            converter = SubitoItParser(
+                backend=kwargs.get("parser_backend", "lxml"),
+                workers=kwargs.get("parser_workers", 1),
+                chunk_size=kwargs.get("parser_chunk_size", 4)
+            )
 
             self.add_component("fetcher", fetcher)
             self.add_component("converter", converter)
+            self.add_component("normalizer", ListingNormalizer())
             self.add_component("document_store", document_store)
 
             self.connect("fetcher.streams", "converter.sources")
-            self.connect("converter.documents", "document_store.documents")
+            self.connect("converter.documents", "normalizer.documents")
+
+            # Optional near-duplicate clustering between the normalizer and the document store
+            self.deduplicator = kwargs.get("deduplicator")
+
+            if self.deduplicator is not None:
+                self.add_component("deduplicator", self.deduplicator)
+                self.connect("normalizer.documents", "deduplicator.documents")
+                self.connect("deduplicator.documents", "document_store.documents")
+            else:
+                self.connect("normalizer.documents", "document_store.documents")
+
+            self.snapshot_store = kwargs.get("snapshot_store")
+
+        def close(self):
+            """
+            Stops the parser processes and closes the connections of the fetcher.
+            """
+
+            self.get_component("converter").close()
+            self.get_component("fetcher").close()
+
+        def run_streaming(
+            self, urls: List[str], table_name: str, table_schema: Dict[str, str], create_table: bool = False,
+            table_indexes: Optional[List[List[str]]] = None, batch_size: int = 500,
+            should_stop: Optional[Callable[[], bool]] = None, on_progress: Optional[Callable[[Dict[str, int]], None]] = None
+        ) -> Dict[str, int]:
+            """
+            Streaming alternative to `run`: every page is parsed as soon as it is downloaded and
+            the listings are flushed to the document store in batches of `batch_size`, each one
+            committed in its own transaction. Memory is bounded by the batch size and not by the
+            number of crawled pages, and the batches committed before a failure are kept.
+
+            `should_stop` is checked after every page: when it returns True the pending listings are
+            flushed and the crawl ends with `stopped` set. `on_progress` receives the stats after every page.
+            """
+
+            fetcher = self.get_component("fetcher")
+            streams = fetcher.iter_streams(urls)
+
+            try:
+                return self._index_streams(
+                    self.snapshot_store.record(streams) if self.snapshot_store is not None else streams,
+                    table_name, table_schema, create_table, table_indexes, batch_size, should_stop, on_progress
+                )
+            finally:
+                # Stops the downloads still running
+                streams.close()
+
+        def run_offline(
+            self, urls: List[str], table_name: str, table_schema: Dict[str, str], create_table: bool = False,
+            table_indexes: Optional[List[List[str]]] = None, batch_size: int = 500,
+            should_stop: Optional[Callable[[], bool]] = None, on_progress: Optional[Callable[[Dict[str, int]], None]] = None
+        ) -> Dict[str, int]:
+            """
+            Same as `run_streaming` but the pages are read from the latest snapshot of each url, no request is sent.
+            Used to re-index after a change of the parser.
+            """
+
+            return self._index_streams(
+                self.snapshot_store.iter_streams(urls),
+                table_name, table_schema, create_table, table_indexes, batch_size, should_stop, on_progress
+            )
+
+        def _index_streams(
+            self, streams: Iterator[ByteStream], table_name: str, table_schema: Dict[str, str], create_table: bool,
+            table_indexes: Optional[List[List[str]]], batch_size: int,
+            should_stop: Optional[Callable[[], bool]], on_progress: Optional[Callable[[Dict[str, int]], None]]
+        ) -> Dict[str, int]:
+
+            converter = self.get_component("converter")
+            normalizer = self.get_component("normalizer")
+            document_store = self.get_component("document_store")
+
+            document_store.ensure_table(table_name, table_schema, create_table, table_indexes)
+
+            stats = {"pages": 0, "documents": 0, "rows_written": 0, "inserted": 0, "updated": 0, "unchanged": 0, "stopped": False}
+            batch = []
+
+            def flush(batch):
+                if self.deduplicator is not None:
+                    self.deduplicator.assign(batch)
+                counts = document_store.write_batch(batch, table_name, table_schema)
+                for name, count in counts.items():
+                    stats[name] += count
+                stats["rows_written"] += counts["inserted"] + counts["updated"]
+
+            pages = converter.iter_parse(streams)
+
+            try:
+                for page_documents in pages:
+
+                    stats["pages"] += 1
+                    PAGES.inc()
+
+                    for document in page_documents:
+                        stats["documents"] += 1
+                        batch.append(normalizer.normalize(document))
+
+                        if len(batch) >= batch_size:
+                            flush(batch)
+                            batch = []
+
+                    if on_progress is not None:
+                        on_progress(stats)
+
+                    if should_stop is not None and should_stop():
+                        stats["stopped"] = True
+                        break
+            finally:
+                pages.close()
+
+            if batch:
+                flush(batch)
+
+            return stats
+
+        def run_incremental(
+            self, urls: List[str], table_name: str, table_schema: Dict[str, str], create_table: bool = False,
+            table_indexes: Optional[List[List[str]]] = None, min_pages: int = 1,
+            should_stop: Optional[Callable[[], bool]] = None, on_progress: Optional[Callable[[Dict[str, int]], None]] = None
+        ) -> Dict[str, int]:
+            """
+            Refresh of an already indexed search: `urls` are the result pages sorted newest first and
+            are crawled one at a time, each page committed on its own. Paging stops at the first page
+            (after `min_pages`) that is not modified or that only holds known, unchanged listings.
+
+            The ETag / Last-Modified of a page are saved once its listings are committed, so that the
+            next refresh sends a conditional request for it. Returns the same stats as `run_streaming`
+            plus `not_modified` and `early_stopped`.
+            """
+
+            fetcher = self.get_component("fetcher")
+            converter = self.get_component("converter")
+            normalizer = self.get_component("normalizer")
+            document_store = self.get_component("document_store")
+
+            document_store.ensure_table(table_name, table_schema, create_table, table_indexes)
+
+            stats = {
+                "pages": 0, "documents": 0, "rows_written": 0, "inserted": 0, "updated": 0, "unchanged": 0,
+                "not_modified": 0, "stopped": False, "early_stopped": False
+            }
+
+            for url in urls:
+
+                if should_stop is not None and should_stop():
+                    stats["stopped"] = True
+                    break
+
+                streams = fetcher.run(urls=[url])["streams"]
+
+                # A page that could not be downloaded says nothing about the following ones
+                if not streams:
+                    continue
+
+                stream = streams[0]
+                stats["pages"] += 1
+                PAGES.inc()
+
+                if stream.meta.get("not_modified"):
+                    stats["not_modified"] += 1
+                    changed = False
+                else:
+                    if self.snapshot_store is not None:
+                        self.snapshot_store.put(stream)
+
+                    documents = [normalizer.normalize(document) for document in converter.parse(stream)]
+                    stats["documents"] += len(documents)
+
+                    if self.deduplicator is not None:
+                        self.deduplicator.assign(documents)
+
+                    counts = document_store.write_batch(documents, table_name, table_schema)
+                    for name, count in counts.items():
+                        stats[name] += count
+                    stats["rows_written"] += counts["inserted"] + counts["updated"]
+
+                    if fetcher.validator_store is not None:
+                        fetcher.validator_store.set(url, stream.meta.get("etag"), stream.meta.get("last_modified"))
+
+                    changed = counts["inserted"] + counts["updated"] > 0
+
+                if on_progress is not None:
+                    on_progress(stats)
+
+                if not changed and stats["pages"] >= min_pages:
+                    stats["early_stopped"] = True
+                    break
+
+            logging.info(f"Incremental crawl: {stats}")
+
+            return stats
 
 
 class SubitoSearchPipeline(Pipeline):
 
 
-    def __init__(self, generator_config: GeneratorConfig,  dbname: str, **kwargs):
+    def __init__(self, generator_config: GeneratorConfig,  dbname: str, cache: Optional[QueryCache] = None, **kwargs):
         
-        super().__init__() 
+        # The name labels the pipeline duration in the metrics
+        super().__init__(metadata={"name": "search"})
+
+        self._pool = get_pool(dbname)
+
+        # Without the table schema the static prompt is used
+        self.table_name = kwargs.get("table_name", "real_estates")
+        self.table_schema = kwargs.get("table_schema")
+        self.prompt_value_columns = kwargs.get("prompt_value_columns", ["city", "province", "floor", "status"])
+        self.max_prompt_tokens = kwargs.get("max_prompt_tokens", 600)
+        self.full_text_column = kwargs.get("full_text_column")
+        # NearDuplicateClusterer of the index, used to collapse the results
+        self.deduplicator = kwargs.get("deduplicator")
+
+        self._prompt_lock = threading.Lock()
+        self._prompt_generation = read_generation(self._pool.reader())
+        self.system_prompt = self._build_system_prompt()
 
         match generator_config.service:
             case "hugging-face":
@@ -140,17 +368,21 @@ class SubitoSearchPipeline(Pipeline):
                     generation_kwargs=generator_config.generation_kwargs,
                     token=Secret.from_token(generator_config.token)
                 )
+                prompt_builder = PromptBuilder(
+                    template=self._template(self.system_prompt) + "\n" + sql_question_prompt, required_variables=["question"]
+                )
             case "ollama":
                 sqlcoder = OllamaChatGenerator(
                     url=generator_config.url, 
                     model=generator_config.model, 
                     generation_kwargs=generator_config.generation_kwargs, 
-                    timeout=generator_config.timeout
+                    timeout=generator_config.timeout,
+                    keep_alive=generator_config.keep_alive
                 )
                 prompt_builder = ChatPromptBuilder(
                     template=[
-                        ChatMessage.from_system(sql_prompt),
-                        ChatMessage.from_user("""### Response:\nBased on your instructions, here is the SQL query I have generated to answer the question `{{question}}`:\n```sql""")
+                        ChatMessage.from_system(self._template(self.system_prompt)),
+                        ChatMessage.from_user(sql_question_prompt)
                         ],
                     variables=["question"]
                         
@@ -162,22 +394,324 @@ class SubitoSearchPipeline(Pipeline):
                     generation_kwargs=generator_config.generation_kwargs
                 )
                 prompt_builder = ChatPromptBuilder(
-                    template=[ChatMessage.from_system(sql_prompt)]
+                    template=[ChatMessage.from_system(self._template(self.system_prompt)), ChatMessage.from_user(sql_question_prompt)],
+                    variables=["question"]
+                )
+            case "local":
+                # Chat generator built by the caller, e.g. the stand-in used by the benchmarks
+                sqlcoder = kwargs["sqlcoder"]
+                prompt_builder = ChatPromptBuilder(
+                    template=[ChatMessage.from_system(self._template(self.system_prompt)), ChatMessage.from_user(sql_question_prompt)],
+                    variables=["question"]
                 )
             case _:
                 raise ValueError(f"Unsupported service: {generator_config.service}")
 
+        # Concurrent identical prompts share one generation and the calls are limited per backend
+        sqlcoder = GenerationGateway(
+            sqlcoder,
+            backend=f"{generator_config.service}:{generator_config.url or generator_config.model}",
+            max_concurrency=kwargs.get("llm_max_concurrency", 2),
+            max_queue=kwargs.get("llm_max_queue", 16),
+            queue_timeout=kwargs.get("llm_queue_timeout", generator_config.timeout),
+            stream=kwargs.get("llm_stream", True),
+            generation_kwargs={"stop": SQL_STOP_SEQUENCES}
+        )
+        prompt_input = "sqlcoder.prompt" if isinstance(prompt_builder, PromptBuilder) else "sqlcoder.messages"
+
+        # Simple filter questions are answered by the fast path, the others go to the LLM
+        fast_path = RuleBasedQueryParser(dbname=dbname, min_confidence=kwargs.get("fast_path_min_confidence", 1.0))
+        queries_joiner = BranchJoiner(List[str])
         sql_query_parser = SQLQueryParser()
         sql_validator = SQLValidator()
-        sql_query = SQLQuery(dbname=dbname)
+        sql_query = SQLQuery(dbname=dbname, table_name=self.table_name, full_text_column=self.full_text_column)
 
+        self.add_component("fast_path", fast_path)
         self.add_component("prompt_builder", prompt_builder)
         self.add_component("sqlcoder", sqlcoder)
         self.add_component("sql_query_parser", sql_query_parser)
         # self.add_component("sql_validator", sql_validator)
+        self.add_component("queries_joiner", queries_joiner)
         self.add_component("sql_query", sql_query)
 
-        self.connect("prompt_builder.prompt", "sqlcoder")
+        self.connect("fast_path.question", "prompt_builder.question")
+        self.connect("fast_path.queries", "queries_joiner")
+        self.connect("fast_path.parameters", "sql_query.parameters")
+        self.connect("prompt_builder.prompt", prompt_input)
         self.connect("sqlcoder.replies", "sql_query_parser.replies")
-        self.connect("sql_query_parser.replies", "sql_query.queries")
+        self.connect("sql_query_parser.replies", "queries_joiner")
+        self.connect("queries_joiner.value", "sql_query.queries")
+
+        self.generator_config = generator_config
+        self.cache = cache
+        self.slow_request_seconds = kwargs.get("slow_request_seconds")
+
+    @staticmethod
+    def _template(text: str) -> str:
+
+        # The prompt holds values from the database, they must not be read as jinja syntax
+        return "{% raw %}" + text + "{% endraw %}"
+
+    def _build_system_prompt(self) -> str:
+
+        if self.table_schema is None:
+            return sql_prompt
+
+        connection = self._pool.reader()
+        values = {column: frequent_values(connection, self.table_name, column, 40) for column in self.prompt_value_columns}
+
+        return build_sql_prompt(
+            self.table_name, self.table_schema, indexed_columns(connection, self.table_name), values,
+            self.max_prompt_tokens, self.full_text_column
+        )
+
+    def refresh_prompt(self):
+        """
+        Rebuilds the system prompt when the index changed. The prompt builder is updated only if the text
+        differs, so that the prompt prefix cached by the backend stays valid as long as possible.
+        """
+
+        generation = read_generation(self._pool.reader())
+
+        if generation == self._prompt_generation:
+            return
+
+        with self._prompt_lock:
+            if generation == self._prompt_generation:
+                return
+
+            system_prompt = self._build_system_prompt()
+
+            if system_prompt != self.system_prompt:
+                prompt_builder = self.get_component("prompt_builder")
+
+                if isinstance(prompt_builder, PromptBuilder):
+                    prompt_builder.template = PromptBuilder(template=self._template(system_prompt) + "\n" + sql_question_prompt).template
+                else:
+                    prompt_builder.template = [
+                        ChatMessage.from_system(self._template(system_prompt)), ChatMessage.from_user(sql_question_prompt)
+                    ]
+
+                self.system_prompt = system_prompt
+                logging.info("System prompt updated")
+
+            self._prompt_generation = generation
+
+    def search(self, question: str) -> Dict[str, Any]:
+        """
+        Runs the pipeline behind the query cache: the LLM is called only for questions never seen
+        before and the SQL is executed again only if the index changed since it was cached.
+        Returns the executed queries with their parameters and results.
+
+        Searches slower than `slow_request_seconds` are logged with their SQL and query plan.
+        """
+
+        self.refresh_prompt()
+
+        started = time.perf_counter()
+        response = self._search(question)
+        elapsed = time.perf_counter() - started
+
+        if self.slow_request_seconds is not None and elapsed >= self.slow_request_seconds:
+            executed_sql = (response.get("executed_queries") or [None])[0]
+            log_slow_request(self._pool.reader(), question, response["queries"][0], executed_sql, response["parameters"][0], elapsed)
+
+        return response
+
+    def _search(self, question: str) -> Dict[str, Any]:
+
+        if self.cache is None:
+            return self.run({"fast_path": {"question": question}})["sql_query"]
+
+        namespace = f"{self.generator_config.service}:{self.generator_config.model}"
+        generation = read_generation(self._pool.reader())
+
+        cached = self.cache.get_sql(namespace, question)
+
+        if cached is None:
+            response = self.run({"fast_path": {"question": question}})["sql_query"]
+
+            sql, parameters = response["queries"][0], response["parameters"][0]
+            self.cache.set_sql(namespace, question, sql, parameters)
+            self.cache.set_results(generation, sql, parameters, response["results"])
+
+            return response
+
+        sql, parameters = cached
+        results = self.cache.get_results(generation, sql, parameters)
+
+        if results is None:
+            response = self.get_component("sql_query").run(queries=[sql], parameters=[parameters])
+            self.cache.set_results(generation, sql, parameters, response["results"])
+
+            return {"results": response["results"], "queries": [sql], "parameters": [parameters], "executed_queries": response["executed_queries"]}
+
+        return {"results": results, "queries": [sql], "parameters": [parameters], "executed_queries": []}
+
+    def collapse_duplicates(self, rows: List[Any]) -> List[Any]:
+        """
+        Keeps the first listing of every cluster of near-duplicates. Rows are dicts, or tuples of SELECT * queries.
+        """
+
+        if self.deduplicator is None or not rows:
+            return rows
+
+        if isinstance(rows[0], dict):
+            return self.deduplicator.collapse(rows, "link") if "link" in rows[0] else rows
+
+        columns = [row[1] for row in self._pool.reader().execute(f"PRAGMA table_info({self.table_name})")]
+
+        if "link" not in columns or len(rows[0]) != len(columns):
+            return rows
+
+        return self.deduplicator.collapse(rows, columns.index("link"))
+
+    def resolve_sql(self, question: str) -> Tuple[str, List[Any]]:
+        """
+        Returns the SQL and parameters answering the question, from the cache when possible.
+        """
+
+        if self.cache is not None:
+            cached = self.cache.get_sql(f"{self.generator_config.service}:{self.generator_config.model}", question)
+            if cached is not None:
+                return cached
+
+        response = self.search(question)
+
+        return response["queries"][0], response["parameters"][0]
+
+    def search_page(self, question: Optional[str] = None, cursor: Optional[str] = None, page_size: int = 20, order_by: str = "link", collapse_duplicates: bool = False) -> Dict[str, Any]:
+        """
+        Returns a page of results as dicts with the cursor of the next page.
+        The first page needs the question, the following ones only the cursor and never call the LLM.
+        With `collapse_duplicates` the near-duplicates are removed from the page (pages can then be shorter).
+        """
+
+        if cursor is not None:
+            state = decode_cursor(cursor)
+        else:
+            sql, parameters = self.resolve_sql(question)
+            state = {"sql": sql, "parameters": parameters, "order_by": order_by, "page_size": page_size, "last": None}
+
+        sql_query = self.get_component("sql_query")
+        query, parameters = page_query(state["sql"], state["parameters"], state["order_by"], state["page_size"], state["last"])
+
+        try:
+            response = sql_query.run(queries=[query], parameters=[parameters])
+            paginated = True
+        except sqlite3.OperationalError:
+            # Queries without the listing columns (e.g. aggregations) are returned in a single page
+            response = sql_query.run(queries=[state["sql"]], parameters=[state["parameters"]])
+            paginated = False
+
+        rows = [dict(zip(response["columns"], row)) for row in response["results"]]
+
+        next_cursor = None
+
+        if paginated and rows and len(rows) == state["page_size"]:
+            last = rows[-1]
+            next_cursor = encode_cursor({**state, "last": [sort_value(last, state["order_by"]), last["link"]]})
+
+        if collapse_duplicates:
+            rows = self.collapse_duplicates(rows)
+
+        return {"sql": state["sql"], "parameters": state["parameters"], "rows": rows, "next_cursor": next_cursor}
+
+    def iter_rows(self, question: str, order_by: str = "link", max_rows: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Yields all the results of the question page by page, only one page is held in memory.
+        """
+
+        page_size = self.get_component("sql_query").max_rows
+        page = self.search_page(question=question, page_size=page_size, order_by=order_by)
+        count = 0
+
+        while True:
+            for row in page["rows"]:
+                if max_rows is not None and count >= max_rows:
+                    return
+                count += 1
+                yield row
+
+            if page["next_cursor"] is None:
+                return
+
+            page = self.search_page(cursor=page["next_cursor"])
+
+    def preload(self):
+        """
+        Loads the model in the Ollama server so that the first request doesn't pay for it.
+        Other services are remote APIs and don't need it.
+        """
+
+        if self.generator_config.service != "ollama":
+            return
+
+        sqlcoder = self.get_component("sqlcoder").generator
+
+        try:
+            # A chat request without messages only loads the model
+            sqlcoder._client.chat(model=sqlcoder.model, messages=[], keep_alive=sqlcoder.keep_alive)
+        except Exception as e:
+            logging.warning(f"Could not preload {sqlcoder.model}: {e}")
+
+
+class PipelineRegistry:
+    """
+    Builds every registered pipeline once and shares it across requests.
+
+    A pipeline is rebuilt only when its configuration changes (`reload`): the new instance is
+    warmed up before being swapped in, requests already running keep using the old one.
+    """
+
+    def __init__(self) -> None:
+
+        self._entries: Dict[str, Tuple[Callable[[Any], Pipeline], Any, Pipeline]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _build(factory: Callable[[Any], Pipeline], config: Any) -> Pipeline:
+
+        pipeline = factory(config)
+        pipeline.warm_up()
+
+        if hasattr(pipeline, "preload"):
+            pipeline.preload()
+
+        return pipeline
+
+    def register(self, name: str, factory: Callable[[Any], Pipeline], config: Any):
+
+        pipeline = self._build(factory, config)
+
+        with self._lock:
+            self._entries[name] = (factory, config, pipeline)
+
+    def get(self, name: str) -> Pipeline:
+
+        if name not in self._entries:
+            raise KeyError(f"Pipeline {name} is not registered")
+
+        return self._entries[name][2]
+
+    def config(self, name: str) -> Any:
+
+        return self._entries[name][1]
+
+    def reload(self, name: str, config: Any) -> bool:
+        """
+        Rebuilds the pipeline if `config` differs from the current one. Returns True if it was rebuilt.
+        """
+
+        with self._lock:
+            factory, current_config, _ = self._entries[name]
+
+            if config == current_config:
+                return False
+
+            self._entries[name] = (factory, config, self._build(factory, config))
+
+        logging.info(f"Pipeline {name} reloaded")
+
+        return True
 
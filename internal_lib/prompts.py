@@ -1,3 +1,6 @@
+from typing import Any, Dict, List, Optional
+
+
 rag_prompt = """
 ### Instructions ###
 You are an assistant for question-answering tasks. Use the following pieces of retrieved context to answer the question. 
@@ -37,10 +40,75 @@ CREATE TABLE real_estates (
   sold BOOL,  -- Flag that said if the house is sold or not
   city VARCHAR(255), -- City where the house is located
   province VARCHAR(255), -- Province where the house is located
-  is_real_estate_agency BOOLm -- If it is owner by an agency
+  is_real_estate_agency BOOL, -- If it is owner by an agency
   mq INTEGER, -- Square meters of the house
   n_rooms INTEGER, -- Number of rooms in the house
   n_bathrooms INTEGER, -- Number of bathrooms in the house
-  floor VARCHAR(50) -- Floor of the house
+  floor VARCHAR(50), -- Floor of the house
+  floor_code INTEGER, -- Floor as number (-2 basement, -1 semi-basement, 0 ground floor), use it to compare floors
+  status VARCHAR(50) -- Condition of the house: 'Nuova costruzione', 'Ottimo', 'Buono' or 'Da ristrutturare'
 );
+
+City and province values are lowercase, always compare them with lowercase strings.
 """
+
+
+# Short descriptions of the columns used by the generated system prompt
+COLUMN_NOTES = {
+    "content": "title of the ad",
+    "price": "euro",
+    "link": "url of the ad",
+    "sold": "1 if sold",
+    "is_real_estate_agency": "1 if sold by an agency, 0 if private",
+    "mq": "square meters",
+    "n_rooms": "rooms",
+    "n_bathrooms": "bathrooms",
+    "floor": "floor as written in the ad",
+    "floor_code": "floor number: -2 basement, -1 semi-basement, 0 ground floor; use it to compare floors",
+    "status": "condition of the house"
+}
+
+
+def build_sql_prompt(table_name: str, table_schema: Dict[str, str], indexed_columns: List[str], values: Dict[str, List[Any]], max_tokens: int = 600, full_text_column: Optional[str] = None) -> str:
+    """
+    Compact system prompt generated from the live table: columns, indexed columns and the valid values
+    of the categorical columns (ordered by frequency, the most frequent are kept and sorted).
+    The text only depends on its arguments so that it stays byte for byte the same across requests
+    and the backend can reuse the cached prompt prefix.
+    Value lists are shortened until the prompt fits `max_tokens` (estimated as 4 characters per token).
+    With `full_text_column` the model is told to look for words with MATCH (run on the FTS5 index).
+    """
+
+    columns = "\n".join(
+        f"  {column} {column_type}" + ("," if i < len(table_schema) - 1 else "") + (f" -- {COLUMN_NOTES[column]}" if column in COLUMN_NOTES else "")
+        for i, (column, column_type) in enumerate(table_schema.items())
+    )
+
+    header = (
+        "### Instructions:\n"
+        "Convert the question into one SQLite query on the table below.\n"
+        "- Always use SELECT *\n"
+        "- Answer with the query only, no explanations\n"
+        "- Compare text columns with the exact spelling and case of the values listed below\n"
+        + (f"- To look for words in the title use {full_text_column} MATCH 'word1 word2' instead of LIKE\n" if full_text_column else "")
+        + "\n"
+        f"### Schema:\nCREATE TABLE {table_name} (\n{columns}\n);\n"
+        f"Indexed columns: {', '.join(indexed_columns)}\n"
+    )
+
+    limit = max((len(v) for v in values.values()), default=0)
+
+    while True:
+        lines = [
+            f"{column}: {', '.join(sorted(str(v) for v in column_values[:limit]))}" + (", ..." if len(column_values) > limit else "")
+            for column, column_values in values.items() if column_values
+        ]
+        prompt = header + ("\n### Values:\n" + "\n".join(lines) + "\n" if lines else "")
+
+        if len(prompt) / 4 <= max_tokens or limit <= 5:
+            return prompt
+
+        limit = max(5, limit // 2)
+
+
+sql_question_prompt = """### Response:\nBased on your instructions, here is the SQL query I have generated to answer the question `{{question}}`:\n```sql"""
@@ -1,8 +1,71 @@
-from pydantic import BaseModel
+from typing import Dict, List, Literal
+
+from pydantic import BaseModel, ConfigDict, Field
 
 
 class SearchQuery(BaseModel):
     query: str
+    collapse_duplicates: bool = False
+
+
+
+class SearchRequest(BaseModel):
+    query: str
+    page_size: int = Field(default=20, ge=1, le=100)
+    order_by: Literal["link", "price", "mq", "n_rooms"] = "link"
+    collapse_duplicates: bool = False
+
+
+
+class Listing(BaseModel):
+    # Generated queries can select any column, the unknown ones are kept as they are
+    model_config = ConfigDict(extra="allow")
+
+    content: str | None = None
+    price: int | None = None
+    link: str | None = None
+    sold: bool | None = None
+    city: str | None = None
+    province: str | None = None
+    is_real_estate_agency: bool | None = None
+    mq: int | None = None
+    n_rooms: int | None = None
+    n_bathrooms: int | None = None
+    floor: str | None = None
+    floor_code: int | None = None
+    status: str | None = None
+
+
+
+class SearchPage(BaseModel):
+    sql: str
+    results: List[Listing]
+    next_cursor: str | None = None
+
+
+
+class IndexJobRequest(BaseModel):
+    base_url: str = "https://www.subito.it/annunci-sardegna/vendita/appartamenti/nuove-costruzioni/"
+    pages: int = Field(default=5, ge=1)
+    incremental: bool = False
+    offline: bool = False
+
+
+
+class CrawlPlanRequest(BaseModel):
+    name: str = "national"
+    regions: List[str] | None = None
+    statuses: List[str] | None = None
+    pages: int = Field(default=5, ge=1)
+
+
+
+class StatsRequest(BaseModel):
+    group_by: List[Literal["city", "province", "n_rooms", "status"]] = []
+    metric: Literal["price", "mq", "price_per_mq"] = "price"
+    filters: Dict[Literal["city", "province", "n_rooms", "status"], str | int] = {}
+    percentiles: List[float] = Field(default=[25, 50, 75], max_length=10)
+    include_sold: bool = False
 
 
 
@@ -12,4 +75,5 @@ class GeneratorConfig(BaseModel):
     token: str | None = None
     url: str | None = None
     generation_kwargs: dict = {}
-    timeout: int = 60
\ No newline at end of file
+    timeout: int = 60
+    keep_alive: str | int | None = None
\ No newline at end of file
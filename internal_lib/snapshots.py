@@ -0,0 +1,109 @@
+import os
+import gzip
+import time
+import hashlib
+import tempfile
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional
+
+from haystack.dataclasses import ByteStream
+
+from internal_lib.database import get_pool
+
+
+class SnapshotStore:
+    """
+    Raw copies of the fetched pages, used to re-index without the network.
+
+    Pages are stored once per content as gzip blobs named after their sha256 (`blobs/ab/abcd….html.gz`),
+    a SQLite manifest records every fetch as (url, fetched_at, hash, content_type).
+    """
+
+    def __init__(self, root: str, compresslevel: int = 6) -> None:
+
+        self.root = Path(root)
+        self.compresslevel = compresslevel
+
+        (self.root / "blobs").mkdir(parents=True, exist_ok=True)
+        self._pool = get_pool(str(self.root / "manifest.db"))
+
+        with self._pool.writer() as connection:
+            with connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS snapshots (url TEXT NOT NULL, fetched_at REAL NOT NULL, hash VARCHAR(64) NOT NULL, content_type VARCHAR(100))"
+                )
+                connection.execute("CREATE INDEX IF NOT EXISTS ix_snapshots_url ON snapshots (url, fetched_at)")
+
+    def _path(self, digest: str) -> Path:
+
+        return self.root / "blobs" / digest[:2] / f"{digest}.html.gz"
+
+    def put(self, stream: ByteStream) -> str:
+        """
+        Saves a fetched page, returns its hash. The blob is written only if the content is new.
+        """
+
+        digest = hashlib.sha256(stream.data).hexdigest()
+        path = self._path(digest)
+
+        if not path.exists():
+            path.parent.mkdir(exist_ok=True)
+            # Written aside and renamed, so that a crash never leaves a truncated blob
+            with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as f:
+                f.write(gzip.compress(stream.data, compresslevel=self.compresslevel))
+            os.replace(f.name, path)
+
+        with self._pool.writer() as connection:
+            with connection:
+                connection.execute(
+                    "INSERT INTO snapshots (url, fetched_at, hash, content_type) VALUES (?, ?, ?, ?)",
+                    (stream.meta["url"], time.time(), digest, stream.meta.get("content_type", "text/html"))
+                )
+
+        return digest
+
+    def record(self, streams: Iterable[ByteStream]) -> Iterator[ByteStream]:
+        """
+        Saves the pages while they go through, the not modified ones are skipped.
+        """
+
+        for stream in streams:
+            if not stream.meta.get("not_modified"):
+                self.put(stream)
+            yield stream
+
+    def urls(self, prefix: str = "") -> List[str]:
+
+        rows = self._pool.reader().execute(
+            "SELECT DISTINCT url FROM snapshots WHERE url LIKE ? ESCAPE '\\' ORDER BY url", (prefix.replace("%", r"\%").replace("_", r"\_") + "%",)
+        )
+
+        return [row[0] for row in rows]
+
+    def latest(self, url: str, as_of: Optional[float] = None) -> Optional[ByteStream]:
+        """
+        Returns the last snapshot of `url` taken before `as_of` (default: the last one).
+        """
+
+        row = self._pool.reader().execute(
+            "SELECT hash, content_type, fetched_at FROM snapshots WHERE url = ? AND fetched_at <= ? ORDER BY fetched_at DESC LIMIT 1",
+            (url, as_of if as_of is not None else float("inf"))
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        digest, content_type, fetched_at = row
+        data = gzip.decompress(self._path(digest).read_bytes())
+
+        return ByteStream(data=data, meta={"url": url, "content_type": content_type, "fetched_at": fetched_at}, mime_type=content_type)
+
+    def iter_streams(self, urls: Iterable[str], as_of: Optional[float] = None) -> Iterator[ByteStream]:
+        """
+        Yields the latest snapshot of every url, the urls never fetched are skipped.
+        """
+
+        for url in urls:
+            stream = self.latest(url, as_of)
+            if stream is not None:
+                yield stream
@@ -0,0 +1,243 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from internal_lib.database import get_pool, read_generation
+
+
+class StatsQueryError(Exception):
+    pass
+
+
+class ColumnarSnapshot:
+    """
+    Columnar copy of the listings: the group-by columns are dictionary encoded (int32 codes plus their
+    sorted categories, None last), the numeric ones are float64 arrays with NaN for NULL.
+    `by_value` holds the row order of every numeric column sorted by value (NaN last).
+    """
+
+    def __init__(self, generation: int, codes: Dict[str, np.ndarray], categories: Dict[str, List[Any]], numbers: Dict[str, np.ndarray], sold: np.ndarray) -> None:
+
+        self.generation = generation
+        self.codes = codes
+        self.categories = categories
+        self.numbers = numbers
+        self.by_value = {metric: np.argsort(values, kind="stable") for metric, values in numbers.items()}
+        self.sold = sold
+        self.size = len(sold)
+
+        # Filter values are matched case-insensitively on their text
+        self._lookup = {column: {str(v).casefold(): i for i, v in enumerate(values)} for column, values in categories.items()}
+
+    def code_of(self, column: str, value: Any) -> Optional[int]:
+
+        return self._lookup[column].get(str(value).casefold())
+
+
+class MarketStats:
+    """
+    Market statistics (mean, median, percentiles) of price, mq and price per mq grouped by city, province,
+    rooms or status, computed with NumPy on a columnar snapshot of the listings table.
+
+    The snapshot is rebuilt when the index generation changes, the aggregates of `common_group_bys`
+    are computed at every rebuild and every result is cached until the next one.
+    Rows are taken in value order (sorted once per snapshot) and stably sorted by group key, which leaves
+    every group contiguous and sorted by value: means come from `np.add.reduceat` and percentiles are read
+    at their position inside every group, so there is no per-group loop.
+    """
+
+    GROUP_COLUMNS = ("city", "province", "n_rooms", "status")
+    METRICS = ("price", "mq", "price_per_mq")
+    PERCENTILES = (25, 50, 75)
+
+    def __init__(
+        self, dbname: str, table_name: str = "real_estates", cache_size: int = 256,
+        common_group_bys: Sequence[Tuple[str, ...]] = (("city",), ("province",), ("n_rooms",), ("status",), ("province", "n_rooms"))
+    ) -> None:
+
+        self.table_name = table_name
+        self.cache_size = cache_size
+        self.common_group_bys = common_group_bys
+        self._pool = get_pool(dbname)
+
+        self._snapshot: Optional[ColumnarSnapshot] = None
+        self._cache: OrderedDict = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _encode(values: List[Any]) -> Tuple[np.ndarray, List[Any]]:
+
+        # Old rows may mix text and numbers in the same column
+        categories = sorted(set(values), key=lambda v: (v is None, str(v)))
+        index = {v: i for i, v in enumerate(categories)}
+
+        return np.fromiter((index[v] for v in values), dtype=np.int32, count=len(values)), categories
+
+    def _build(self, generation: int) -> ColumnarSnapshot:
+
+        started = time.perf_counter()
+
+        try:
+            # Non-numeric prices and surfaces left by old versions (e.g. "85 mq") count as unknown
+            rows = self._pool.reader().execute(
+                f"""SELECT {', '.join(self.GROUP_COLUMNS)},
+                CASE WHEN typeof(price) IN ('integer', 'real') THEN price END,
+                CASE WHEN typeof(mq) IN ('integer', 'real') THEN mq END,
+                sold FROM {self.table_name}"""
+            ).fetchall()
+        except Exception as e:
+            # No index built yet
+            logging.warning(f"Market stats snapshot is empty: {e}")
+            rows = []
+
+        columns = list(zip(*rows)) if rows else [[] for _ in range(len(self.GROUP_COLUMNS) + 3)]
+        codes, categories = {}, {}
+
+        for i, column in enumerate(self.GROUP_COLUMNS):
+            codes[column], categories[column] = self._encode(list(columns[i]))
+
+        offset = len(self.GROUP_COLUMNS)
+        price = np.array(columns[offset], dtype=np.float64)
+        mq = np.array(columns[offset + 1], dtype=np.float64)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            price_per_mq = np.where(mq > 0, price / mq, np.nan)
+
+        sold = np.array([bool(v) for v in columns[offset + 2]], dtype=bool)
+
+        snapshot = ColumnarSnapshot(generation, codes, categories, {"price": price, "mq": mq, "price_per_mq": price_per_mq}, sold)
+        logging.info(f"Market stats snapshot of {snapshot.size} listings built in {time.perf_counter() - started:.3f}s")
+
+        return snapshot
+
+    def refresh(self) -> ColumnarSnapshot:
+        """
+        Returns the snapshot of the current index generation, rebuilding it (and the common aggregates) if needed.
+        """
+
+        generation = read_generation(self._pool.reader())
+        snapshot = self._snapshot
+
+        if snapshot is not None and snapshot.generation == generation:
+            return snapshot
+
+        with self._lock:
+            if self._snapshot is None or self._snapshot.generation != generation:
+                snapshot = self._build(generation)
+                self._snapshot = snapshot
+                with self._cache_lock:
+                    self._cache.clear()
+
+                for group_by in self.common_group_bys:
+                    for metric in self.METRICS:
+                        self._cached(snapshot, list(group_by), metric, {}, self.PERCENTILES, False)
+
+            return self._snapshot
+
+    def _cached(self, snapshot: ColumnarSnapshot, group_by: List[str], metric: str, filters: Dict[str, Any], percentiles: Sequence[float], include_sold: bool) -> List[Dict[str, Any]]:
+
+        key = (snapshot.generation, tuple(group_by), metric, tuple(sorted((k, str(v).casefold()) for k, v in filters.items())), tuple(percentiles), include_sold)
+
+        with self._cache_lock:
+            result = self._cache.get(key)
+            if result is not None:
+                self._cache.move_to_end(key)
+                return result
+
+        result = self._aggregate(snapshot, group_by, metric, filters, percentiles, include_sold)
+
+        with self._cache_lock:
+            self._cache[key] = result
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        return result
+
+    @staticmethod
+    def _aggregate(snapshot: ColumnarSnapshot, group_by: List[str], metric: str, filters: Dict[str, Any], percentiles: Sequence[float], include_sold: bool) -> List[Dict[str, Any]]:
+
+        mask = ~np.isnan(snapshot.numbers[metric])
+
+        if not include_sold:
+            mask &= ~snapshot.sold
+
+        for column, value in filters.items():
+            code = snapshot.code_of(column, value)
+            if code is None:
+                return []
+            mask &= snapshot.codes[column] == code
+
+        rows = snapshot.by_value[metric]
+        rows = rows[mask[rows]]
+
+        if len(rows) == 0:
+            return []
+
+        values = snapshot.numbers[metric][rows]
+
+        # One int64 key per row combining the codes of the group-by columns
+        key = np.zeros(len(rows), dtype=np.int64)
+        for column in group_by:
+            key = key * len(snapshot.categories[column]) + snapshot.codes[column][rows]
+
+        if group_by:
+            # Stable: the rows of a group stay sorted by value. NumPy radix sorts keys of 16 bits or less
+            groups = int(np.prod([len(snapshot.categories[column]) for column in group_by]))
+            order = np.argsort(key.astype(np.uint16) if groups <= 2 ** 16 else key, kind="stable")
+            key, values = key[order], values[order]
+
+        starts = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+        counts = np.diff(np.r_[starts, len(key)])
+        means = np.add.reduceat(values, starts) / counts
+
+        stats = {"count": counts, "mean": means}
+
+        # Linear interpolation between the closest ranks, like np.percentile
+        for q in percentiles:
+            position = starts + (q / 100) * (counts - 1)
+            lower = np.floor(position).astype(np.int64)
+            upper = np.ceil(position).astype(np.int64)
+            stats["median" if q == 50 else f"p{q:g}"] = values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+        stats["min"] = values[starts]
+        stats["max"] = values[starts + counts - 1]
+
+        # Back from the combined key to the values of every group-by column
+        group_keys = key[starts]
+        groups = {}
+        for column in reversed(group_by):
+            n = len(snapshot.categories[column])
+            groups[column] = [snapshot.categories[column][c] for c in (group_keys % n)]
+            group_keys = group_keys // n
+
+        return [
+            {
+                **{column: groups[column][i] for column in group_by},
+                **{name: int(column[i]) if name == "count" else round(float(column[i]), 2) for name, column in stats.items()}
+            }
+            for i in range(len(starts))
+        ]
+
+    def aggregate(self, group_by: List[str], metric: str = "price", filters: Optional[Dict[str, Any]] = None, percentiles: Sequence[float] = PERCENTILES, include_sold: bool = False) -> Dict[str, Any]:
+        """
+        Statistics of `metric` for every group of `group_by` (no grouping: one row for all the listings).
+        `filters` keeps the listings whose group-by column equals the value (e.g. {"city": "cagliari"}).
+        """
+
+        unknown = [c for c in [*group_by, *(filters or {})] if c not in self.GROUP_COLUMNS]
+        if unknown:
+            raise StatsQueryError(f"Unknown column: {', '.join(unknown)}, allowed: {', '.join(self.GROUP_COLUMNS)}")
+        if metric not in self.METRICS:
+            raise StatsQueryError(f"Unknown metric: {metric}, allowed: {', '.join(self.METRICS)}")
+        if any(not 0 <= q <= 100 for q in percentiles):
+            raise StatsQueryError("Percentiles must be between 0 and 100")
+
+        snapshot = self.refresh()
+        results = self._cached(snapshot, list(group_by), metric, filters or {}, percentiles, include_sold)
+
+        return {"generation": snapshot.generation, "listings": snapshot.size, "metric": metric, "group_by": list(group_by), "groups": results}
@@ -1,18 +1,34 @@
 import os
+import math
 import logging
+import itertools
 
 import uvicorn
 import gradio as gr
 
 from dotenv import load_dotenv
 from ast import literal_eval
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
-from fastapi.responses import JSONResponse
-
-from internal_lib.pipelines import SubitoScraperPipeline, SubitoSearchPipeline
-from internal_lib.components import SQLWriter
-from internal_lib.schema import SearchQuery, GeneratorConfig
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+
+from internal_lib.pipelines import SubitoScraperPipeline, SubitoSearchPipeline, PipelineRegistry
+from internal_lib.components import NearDuplicateClusterer, QueryRejectedError, LLMBusyError
+from internal_lib.schema import SearchQuery, SearchRequest, SearchPage, Listing, GeneratorConfig, IndexJobRequest, CrawlPlanRequest, StatsRequest
+from internal_lib.jobs import JobStore, IndexJobRunner, job_report
+from internal_lib.crawler import CrawlScheduler, CrawlQueue
+from internal_lib.snapshots import SnapshotStore
+from internal_lib.history import ListingHistory
+from internal_lib.stats import MarketStats, StatsQueryError
+from internal_lib.pagination import InvalidCursorError
+from internal_lib.database import close_pools
+from internal_lib.cache import QueryCache
+from internal_lib.metrics import enable_metrics
+
+import settings
+from settings import DB_NAME, CACHE_DB_NAME, SNAPSHOT_DIR, TABLE_NAME, TABLE_SCHEMA, TABLE_INDEXES
 
 
 load_dotenv("config.env")
@@ -25,64 +41,262 @@ logging.basicConfig(
 )
 
 
-app = FastAPI()
+# Searches slower than this are logged with their SQL and query plan (disabled when unset)
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS")) if os.getenv("SLOW_REQUEST_SECONDS") else None
 
 
-@app.post("/build-index")
-def build_index():
+pipelines = PipelineRegistry()
+query_cache = None
+snapshot_store = None
+job_runner = None
+crawl_scheduler = None
+crawl_queue = None
+listing_history = None
+market_stats = None
+
+
+def load_generator_config() -> GeneratorConfig:
+
+    return GeneratorConfig(
+        service=os.getenv("SERVICE"),
+        model=os.getenv("MODEL"),
+        token=os.getenv("TOKEN"),
+        url=os.getenv("URL"),
+        generation_kwargs=literal_eval(os.getenv("GENERATION_KWARGS")),
+        timeout=int(os.getenv("TIMEOUT")),
+        keep_alive=os.getenv("KEEP_ALIVE")
+    )
+
+
+def build_scraper_pipeline() -> SubitoScraperPipeline:
+
+    return settings.build_scraper_pipeline(snapshot_store)
+
+
+def index_job_params(request: IndexJobRequest) -> dict:
+
+    # Offline re-index: every page ever fetched under base_url, read from the snapshots
+    if request.offline:
+        return {"urls": snapshot_store.urls(prefix=request.base_url), "offline": True}
 
-    document_store = SQLWriter(dbname="subito.db")
+    urls = [request.base_url + "/?o={x}".format(x=x) for x in range(request.pages)]
 
-    # Creating preprocessing pipeline
+    return {"urls": urls, "incremental": request.incremental}
 
-    pipe = SubitoScraperPipeline(document_store=document_store)
 
-    table_schema = {
-        "content": "VARCHAR(255)", "price": "INTEGER", 
-        "link": "VARCHAR(255)", "sold": "BOOL", "city": "VARCHAR(255)",
-        "province": "VARCHAR(255)", "is_real_estate_agency": "BOOL",
-        "mq": "INTEGER", "n_rooms": "INTEGER", "n_bathrooms": "INTEGER",
-        "floor": "VARCHAR(50)"
-        }
+def build_search_pipeline(generator_config: GeneratorConfig) -> SubitoSearchPipeline:
 
-        
-    base_url = "https://www.subito.it/annunci-sardegna/vendita/appartamenti/nuove-costruzioni/"
+    return SubitoSearchPipeline(
+        generator_config=generator_config, dbname=DB_NAME, cache=query_cache, slow_request_seconds=SLOW_REQUEST_SECONDS,
+        table_name=TABLE_NAME, table_schema=TABLE_SCHEMA, full_text_column="content", deduplicator=NearDuplicateClusterer(dbname=DB_NAME),
+        llm_max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", 2)), llm_max_queue=int(os.getenv("LLM_MAX_QUEUE", 16))
+    )
+
+
+def busy_response(error: LLMBusyError) -> JSONResponse:
+
+    retry_after = max(1, math.ceil(error.retry_after))
+
+    return JSONResponse(
+        content={"detail": str(error), "retry_after": retry_after}, status_code=503, headers={"Retry-After": str(retry_after)}
+    )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
 
-    urls = [base_url + "/?o={x}" for x in range(5)]
-    res = pipe.run(
-        {
-            "fetcher": {"urls": urls},
-            "document_store": {"table_name": "real_estates", "table_schema": table_schema, "create_table": True},
-        }
+    global query_cache, snapshot_store, job_runner, crawl_scheduler, crawl_queue, listing_history, market_stats
+
+    # Times every pipeline and component run for /metrics
+    enable_metrics()
+
+    query_cache = QueryCache(dbname=CACHE_DB_NAME)
+    snapshot_store = SnapshotStore(root=SNAPSHOT_DIR)
+
+    # Sharded crawls are planned here and run by `python crawl.py work <plan>`
+    crawl_queue = CrawlQueue(dbname=DB_NAME)
+
+    # Filled by the index builds, read by the history endpoints
+    listing_history = ListingHistory(dbname=DB_NAME, table_name=TABLE_NAME)
+
+    # Columnar snapshot of the listings for /stats, rebuilt after every index build
+    market_stats = MarketStats(dbname=DB_NAME, table_name=TABLE_NAME)
+    market_stats.refresh()
+
+    # Index builds run one at a time in the background, interrupted ones are resumed
+    job_runner = IndexJobRunner(
+        JobStore(dbname=DB_NAME), build_scraper_pipeline,
+        table_name=TABLE_NAME, table_schema=TABLE_SCHEMA, table_indexes=TABLE_INDEXES,
+        on_done=lambda job_id: market_stats.refresh()
     )
+    job_runner.start()
+
+    # Periodic refresh of the index: only the first pages with new or changed listings are crawled
+    crawl_interval = float(os.getenv("CRAWL_INTERVAL", 0))
+    if crawl_interval > 0:
+        crawl_request = IndexJobRequest(pages=int(os.getenv("CRAWL_MAX_PAGES", 50)), incremental=True)
+        crawl_scheduler = CrawlScheduler(job_runner, crawl_interval, lambda: index_job_params(crawl_request))
+        crawl_scheduler.start()
+
+    # Pipelines are built and warmed up once, then shared by all the requests
+    pipelines.register("search", build_search_pipeline, load_generator_config())
+
+    yield
+
+    if crawl_scheduler is not None:
+        crawl_scheduler.stop()
+    job_runner.stop()
+    close_pools()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.post("/build-index")
+def build_index(request: IndexJobRequest | None = None):
+
+    # The crawl runs in the background, the job id is returned at once
+    request = request or IndexJobRequest()
+    params = index_job_params(request)
+
+    if not params["urls"]:
+        return JSONResponse(content={"detail": "No snapshot found for this url"}, status_code=404)
+
+    job_id = job_runner.submit(params)
+
+    return JSONResponse(content={"job_id": job_id}, status_code=202)
+
+
+@app.get("/build-index/{job_id}")
+def build_index_status(job_id: str):
+
+    job = job_runner.store.get(job_id)
+
+    if job is None:
+        return JSONResponse(content={"detail": "Job not found"}, status_code=404)
+
+    return JSONResponse(content=job_report(job), status_code=200)
+
+
+@app.post("/build-index/{job_id}/cancel")
+def cancel_build_index(job_id: str):
+
+    if not job_runner.store.request_cancel(job_id):
+        return JSONResponse(content={"detail": "Job is not queued or running"}, status_code=409)
+
+    return JSONResponse(content={"job_id": job_id}, status_code=202)
+
+
+@app.post("/build-index/{job_id}/resume")
+def resume_build_index(job_id: str):
+
+    if not job_runner.resume(job_id):
+        return JSONResponse(content={"detail": "Job is not cancelled or failed"}, status_code=409)
+
+    return JSONResponse(content={"job_id": job_id}, status_code=202)
+
+
+@app.post("/crawl-plans")
+def create_crawl_plan(request: CrawlPlanRequest | None = None):
+
+    request = request or CrawlPlanRequest()
+
+    try:
+        planned = crawl_queue.plan(request.name, request.regions, request.statuses, request.pages)
+    except ValueError as e:
+        return JSONResponse(content={"detail": str(e)}, status_code=422)
+
+    return JSONResponse(content={"planned": planned, **crawl_queue.report(request.name)}, status_code=201)
+
+
+@app.get("/crawl-plans/{name}")
+def crawl_plan_status(name: str):
 
-    return JSONResponse(content="Index built", status_code=200)
+    report = crawl_queue.report(name)
 
+    if report is None:
+        return JSONResponse(content={"detail": "Plan not found"}, status_code=404)
+
+    return JSONResponse(content=report, status_code=200)
+
+
+@app.post("/crawl-plans/{name}/retry-failed")
+def retry_crawl_plan(name: str):
+
+    return JSONResponse(content={"requeued": crawl_queue.retry_failed(name)}, status_code=202)
+
+
+@app.get("/listings/history")
+def listing_changes(link: str):
+
+    changes = listing_history.changes(link)
+
+    if not changes:
+        return JSONResponse(content={"detail": "Listing not found"}, status_code=404)
+
+    return JSONResponse(content={"link": link, "changes": changes}, status_code=200)
+
+
+@app.get("/listings/as-of")
+def listing_as_of(link: str, at: float):
+
+    values = listing_history.as_of(link, at)
+
+    if values is None:
+        return JSONResponse(content={"detail": "Listing not known at this time"}, status_code=404)
+
+    return JSONResponse(content={"link": link, "at": at, **values}, status_code=200)
+
+
+@app.get("/price-drops")
+def price_drops(days: float = 7, limit: int = 50, min_drop_pct: float = 0.0):
+
+    return JSONResponse(content=listing_history.price_drops(days, limit, min_drop_pct), status_code=200)
+
+
+@app.post("/stats")
+def stats(request: StatsRequest | None = None):
+
+    request = request or StatsRequest()
+
+    try:
+        result = market_stats.aggregate(request.group_by, request.metric, request.filters, request.percentiles, request.include_sold)
+    except StatsQueryError as e:
+        return JSONResponse(content={"detail": str(e)}, status_code=422)
+
+    return JSONResponse(content=result, status_code=200)
 
 
 @app.post("/search")
 def search(query: SearchQuery):
 
-    document_store = SQLWriter(dbname="subito.db")
     # retriever = ChromaEmbeddingRetriever(document_store=document_store, top_k=15)
 
     # Querying pipeline
 
-    rag_pipeline = SubitoSearchPipeline(
-        generator_config=generator_config, dbname="subito.db"
-    )
+    rag_pipeline = pipelines.get("search")
 
-    response = rag_pipeline.run(
-        {"prompt_builder": 
-            {
-                "question": query
-            },
-        }
-    )
+    # The gradio interface sends the plain text
+    question = query.query if isinstance(query, SearchQuery) else query
 
-    logging.info(f"SQL Query: *** {response['sql_query']['queries'][0]} ***")
+    try:
+        response = rag_pipeline.search(question)
+    except QueryRejectedError as e:
+        logging.warning(f"Query rejected: {e}")
+        return "La ricerca richiesta è troppo costosa, prova ad aggiungere dei filtri (città, prezzo, numero di locali)."
+    except LLMBusyError as e:
+        logging.warning(f"Search rejected: {e}")
+        if isinstance(query, SearchQuery):
+            return busy_response(e)
+        return f"Il servizio è sovraccarico, riprova tra {max(1, math.ceil(e.retry_after))} secondi."
 
-    results = response["sql_query"]["results"]
+    logging.info(f"SQL Query: *** {response['queries'][0]} ***")
+
+    results = response["results"]
+
+    # On request, the same apartment posted by several agencies is shown once
+    if isinstance(query, SearchQuery) and query.collapse_duplicates:
+        results = rag_pipeline.collapse_duplicates(results)
 
     msg = "Ecco i risultati trovati:\n\n"
 
@@ -92,16 +306,98 @@ def search(query: SearchQuery):
 
 
 
-if __name__ == "__main__":
+@app.post("/search/results")
+def search_results(request: SearchRequest):
 
-    generator_config = GeneratorConfig(
-        service=os.getenv("SERVICE"),
-        model=os.getenv("MODEL"),
-        token=os.getenv("TOKEN"),
-        generation_kwargs=literal_eval(os.getenv("GENERATION_KWARGS")),
-        timeout=int(os.getenv("TIMEOUT"))
+    try:
+        page = pipelines.get("search").search_page(
+            question=request.query, page_size=request.page_size, order_by=request.order_by,
+            collapse_duplicates=request.collapse_duplicates
+        )
+    except QueryRejectedError as e:
+        return JSONResponse(content={"detail": str(e)}, status_code=422)
+    except LLMBusyError as e:
+        return busy_response(e)
+
+    return SearchPage(sql=page["sql"], results=page["rows"], next_cursor=page["next_cursor"])
+
+
+@app.get("/search/results")
+def search_results_page(cursor: str, collapse_duplicates: bool = False):
+
+    # Following pages only run the SQL stored in the cursor, the LLM is not called
+    try:
+        page = pipelines.get("search").search_page(cursor=cursor, collapse_duplicates=collapse_duplicates)
+    except InvalidCursorError as e:
+        return JSONResponse(content={"detail": str(e)}, status_code=400)
+    except QueryRejectedError as e:
+        return JSONResponse(content={"detail": str(e)}, status_code=422)
+
+    return SearchPage(sql=page["sql"], results=page["rows"], next_cursor=page["next_cursor"])
+
+
+@app.post("/search/stream")
+def search_stream(request: SearchRequest):
+
+    rows = pipelines.get("search").iter_rows(request.query, order_by=request.order_by)
+
+    # The first page is fetched here so that errors are returned before the stream starts
+    try:
+        first = list(itertools.islice(rows, 1))
+    except QueryRejectedError as e:
+        return JSONResponse(content={"detail": str(e)}, status_code=422)
+    except LLMBusyError as e:
+        return busy_response(e)
+
+    return StreamingResponse(
+        (Listing(**row).model_dump_json() + "\n" for row in itertools.chain(first, rows)),
+        media_type="application/x-ndjson"
     )
 
+
+@app.get("/cache-stats")
+def cache_stats():
+
+    return JSONResponse(content=query_cache.stats(), status_code=200)
+
+
+@app.get("/fast-path-stats")
+def fast_path_stats():
+
+    return JSONResponse(content=pipelines.get("search").get_component("fast_path").stats(), status_code=200)
+
+
+@app.get("/llm-stats")
+def llm_stats():
+
+    search_pipeline = pipelines.get("search")
+    stats = {**search_pipeline.get_component("sqlcoder").stats(), "system_prompt_chars": len(search_pipeline.system_prompt)}
+
+    return JSONResponse(content=stats, status_code=200)
+
+
+@app.get("/metrics")
+def metrics():
+
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.post("/reload-pipelines")
+def reload_pipelines(generator_config: GeneratorConfig | None = None):
+
+    # Without a body the configuration is read again from config.env
+    if generator_config is None:
+        load_dotenv("config.env", override=True)
+        generator_config = load_generator_config()
+
+    reloaded = pipelines.reload("search", generator_config)
+
+    return JSONResponse(content={"reloaded": reloaded}, status_code=200)
+
+
+
+if __name__ == "__main__":
+
     io = gr.Interface(search, "textbox", "textbox")
     app = gr.mount_gradio_app(app, io, path="/")
     
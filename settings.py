@@ -0,0 +1,43 @@
+import os
+from typing import Optional
+
+from dotenv import load_dotenv
+
+from internal_lib.pipelines import SubitoScraperPipeline
+from internal_lib.components import SQLWriter, NearDuplicateClusterer
+from internal_lib.crawler import ValidatorStore
+from internal_lib.snapshots import SnapshotStore
+from internal_lib.history import ListingHistory
+
+
+load_dotenv("config.env")
+
+
+DB_NAME = "subito.db"
+CACHE_DB_NAME = "subito_cache.db"
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "snapshots")
+
+
+TABLE_NAME = "real_estates"
+
+TABLE_SCHEMA = {
+    "content": "VARCHAR(255)", "price": "INTEGER",
+    "link": "VARCHAR(255)", "sold": "BOOL", "city": "VARCHAR(255)",
+    "province": "VARCHAR(255)", "is_real_estate_agency": "BOOL",
+    "mq": "INTEGER", "n_rooms": "INTEGER", "n_bathrooms": "INTEGER",
+    "floor": "VARCHAR(50)", "floor_code": "INTEGER", "status": "VARCHAR(50)"
+    }
+
+TABLE_INDEXES = [["city"], ["province"], ["price"], ["mq"], ["n_rooms"], ["sold"]]
+
+
+def build_scraper_pipeline(snapshot_store: Optional[SnapshotStore] = None) -> SubitoScraperPipeline:
+    """
+    Index pipeline of the web app and of the crawl workers, with its own snapshot store if none is given.
+    """
+
+    return SubitoScraperPipeline(
+        document_store=SQLWriter(dbname=DB_NAME, full_text_column="content", history=ListingHistory(dbname=DB_NAME, table_name=TABLE_NAME)),
+        validator_store=ValidatorStore(dbname=DB_NAME), snapshot_store=snapshot_store or SnapshotStore(root=SNAPSHOT_DIR),
+        deduplicator=NearDuplicateClusterer(dbname=DB_NAME)
+    )